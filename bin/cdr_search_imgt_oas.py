@@ -6,39 +6,14 @@ import re
 import numpy as np
 import argparse
 from abnumber import Chain, Position
-import gzip
-import json
+from bin.oas_units import read_unit, is_encoded_unit, iterate_oas_records, read_oas_json_metadata
+from bin.oas_store import OASStore
+from bin.oas_hit_store import HitStore
+from bin import oas_search
 
 def iterate_oas_json(path, limit=None):
-    if path.endswith('.json.gz'):
-        gzipped = True
-    elif path.endswith('.json'):
-        gzipped = False
-    else:
-        raise ValueError(f'Expected .json or .json.gz file, got: {path}')
-    with (gzip.open(path) if gzipped else open(path)) as f:
-        i = 0
-        for line in f:
-            if limit and i > limit:
-                break
-            item = json.loads(line)
-            if 'seq' not in item:
-                # skip metadata row
-                continue
-            i += 1
-            data = json.loads(item['data'])
-            v_germline = item['v']
-            if v_germline.startswith('IGHV'):
-                chain_type = 'H'
-            elif v_germline.startswith('IGLV'):
-                chain_type = 'L'
-            elif v_germline.startswith('IGKV'):
-                chain_type = 'K'
-            else:
-                raise ValueError(f'Invalid germline "{v_germline}": {path}')
-            aa_dict = {Position.from_string(pos, chain_type=chain_type, scheme='imgt'): aa \
-                       for region, region_data in data.items() for pos, aa in region_data.items()}
-            yield Chain(sequence=None, aa_dict=aa_dict, name=item['original_name'], scheme='imgt', chain_type=chain_type, tail='')
+    for record in iterate_oas_records(path, limit=limit):
+        yield record.to_chain()
 
 def evaluate_cdr_hit(query, target, result={}, same_length=False):
     """
@@ -104,6 +79,39 @@ def evaluate_framework_hit(query, target, result={}, same_length=False):
     
     return num_cdr_matches, num_fw_matches
 
+def get_hit_key(hit, framework_first=False):
+    """
+    Get sortable key of hit, comparing CDR matches first (or framework matches first)
+    """
+    if framework_first:
+        return hit['num_fw_matches'] * oas_search.KEY_BASE + hit['num_cdr_matches']
+    return hit['num_cdr_matches'] * oas_search.KEY_BASE + hit['num_fw_matches']
+
+def search_encoded_unit(engine, unit, results, framework_first=False, same_length=False):
+    """
+    Compare queries with all sequences of an EncodedUnit, saving improvements to TopHits 'results' in place
+
+    Produces the same results as running evaluate_cdr_hit or evaluate_framework_hit on each pair,
+    but compares blocks of targets with all queries at once using the RegionMatchEngine.
+    """
+    for offset, region_matches, valid in engine.iterate_region_matches(unit, same_length=same_length, same_cdr_positions=same_length and not framework_first):
+        num_cdr_matches = oas_search.get_cdr_matches(region_matches)
+        num_fw_matches = oas_search.get_fw_matches(region_matches)
+        if framework_first:
+            keys = num_fw_matches * oas_search.KEY_BASE + num_cdr_matches
+        else:
+            keys = num_cdr_matches * oas_search.KEY_BASE + num_fw_matches
+        keys[~valid] = -1
+        thresholds = np.array([results.get_threshold_key(name) for name in engine.names])
+        for q, rows in oas_search.select_candidates(keys, thresholds, results.k):
+            for i in rows:
+                # save improvement
+                results.add(engine.names[q], {
+                    'num_cdr_matches': int(num_cdr_matches[i, q]),
+                    'num_fw_matches': int(num_fw_matches[i, q]),
+                    **oas_search.get_unit_hit(unit, offset + i)
+                }, key=keys[i, q])
+
 def get_fr1_matches(query, target):
     return sum(aa == target.fr1_dict.get(pos) for pos, aa in query.fr1_dict.items())
 
@@ -134,54 +142,147 @@ def get_cdr_matches(query, target):
 def get_matches(query, target):
     return get_fw_matches(query, target) + get_cdr_matches(query, target)
 
+def create_results(queries, top_k=1, framework_first=False):
+    """
+    Create empty TopHits for all queries
+    """
+    return oas_search.TopHits(queries.index, key=lambda hit: get_hit_key(hit, framework_first=framework_first), k=top_k)
+
+def debug_search_unit(queries, json_path, results, limit=None, same_length=False, framework_first=False):
+    """
+    Compare queries with each target Chain one by one, printing out each alignment
+    """
+    evaluate_hit = evaluate_framework_hit if framework_first else evaluate_cdr_hit
+    if is_encoded_unit(json_path):
+        unit = read_unit(json_path, limit=limit)
+        hits = (unit.get_chain(i) for i in range(len(unit)))
+        species = unit.species
+    else:
+        hits = iterate_oas_json(json_path, limit=limit)
+        species = read_oas_json_metadata(json_path).get('Species')
+    for hit in hits:
+        for query in queries:
+            num_cdr_matches, num_fw_matches = evaluate_hit(query, hit, results.get_threshold_hit(query.name), same_length=same_length)
+            print(f'{hit.name} VS {query.name}:')
+            print(hit.align(query))
+            print('CDR:', num_cdr_matches, 'FW:', num_fw_matches)
+            if num_cdr_matches is None:
+                continue
+            # save improvement
+            results.add(query.name, {
+                'num_cdr_matches': num_cdr_matches,
+                'num_fw_matches': num_fw_matches,
+                **oas_search.get_chain_hit(hit, species=species)
+            })
+
+def search_units(queries, paths, limit=None, debug=False, same_length=False, framework_first=False, top_k=1, block_size=oas_search.DEFAULT_BLOCK_SIZE, results=None, checkpoint=None):
+    """
+    Search for best hits of each query in given OAS data units, return TopHits
+
+    If existing TopHits 'results' are provided, they are updated in place.
+    If SearchCheckpoint is provided, data units that were already searched are skipped.
+    """
+    if results is None:
+        results = create_results(queries, top_k=top_k, framework_first=framework_first)
+    engine = oas_search.RegionMatchEngine(queries, block_size=block_size)
+    for json_path in paths:
+        if checkpoint is not None and checkpoint.is_done(json_path, engine.names):
+            continue
+        if debug:
+            debug_search_unit(queries, json_path, results, limit=limit, same_length=same_length, framework_first=framework_first)
+        else:
+            unit = read_unit(json_path, limit=limit)
+            search_encoded_unit(engine, unit, results, same_length=same_length, framework_first=framework_first)
+        if checkpoint is not None:
+            checkpoint.mark_done(json_path, engine.names)
+    return results
+
+def get_hits_table(queries, results):
+    ranked = [(name, rank, hit) for name in queries.index for rank, hit in enumerate(results.get_ranked(name), start=1)]
+    table = oas_search.get_numbering_table([name for name, rank, hit in ranked], [hit for name, rank, hit in ranked])
+    if not table.empty:
+        table.insert(1, 'num_cdr_matches', [hit['num_cdr_matches'] for name, rank, hit in ranked])
+        table.insert(2, 'num_fw_matches', [hit['num_fw_matches'] for name, rank, hit in ranked])
+        table.insert(3, 'num_full_matches', table['num_cdr_matches'] + table['num_fw_matches'])
+        table.insert(4, 'hit_name', [hit['hit_name'] for name, rank, hit in ranked])
+        if results.k > 1:
+            table.insert(5, 'hit_rank', [rank for name, rank, hit in ranked])
+    return table
+
+def search_unit_to_csv(path, output_path, queries, **kwargs):
+    """
+    Search single OAS data unit and save hits to CSV, return hits table
+    """
+    results = search_units(queries, [path], **kwargs)
+    table = get_hits_table(queries, results)
+    oas_search.save_csv(table, output_path)
+    return table
+
 
 if __name__ == "__main__":
     # Parse command line
     parser = argparse.ArgumentParser()
-    parser.add_argument("targets", nargs='+', help="Target OAS data-unit (gzipped) JSON file path(s).")
+    parser.add_argument("targets", nargs='*', help="Target OAS data-unit (gzipped) JSON file path(s) or encoded unit(s) created using bin/oas_units.py.")
     parser.add_argument("--query", required=True, help="Input query sequences as ANARCI CSV (IMGT-aligned) file path.")
-    parser.add_argument("--output", required=True, help="Output CSV file path.")
+    parser.add_argument("--store", help="Target OAS store created using bin/oas_store.py, instead of data units.")
+    parser.add_argument("--v-family", nargs='+', help="Only search --store targets from given V gene families (e.g. IGHV3).")
+    parser.add_argument("--output", help="Output CSV file path.")
+    parser.add_argument("--manifest", help="Text file with one target data-unit path per line, to be searched separately (use with --output-dir).")
+    parser.add_argument("--output-dir", help="Output directory for one CSV file per data unit in --manifest.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of data units from --manifest to search in parallel.")
+    parser.add_argument("--resume", action='store_true', help="Skip data units from --manifest that already have a CSV file in --output-dir.")
+    parser.add_argument("--hit-store", help="Also append hits of each data unit from --manifest to this hit store (see bin/oas_hit_store.py).")
+    parser.add_argument("--checkpoint", help="Pickle file for saving best hits and searched data units at intervals. "
+                                             "If it exists, its hits are kept and its data units are skipped (resume or add new data units).")
+    parser.add_argument("--checkpoint-interval", type=int, default=oas_search.DEFAULT_CHECKPOINT_INTERVAL, help="Minimum number of seconds between saving two checkpoints.")
     parser.add_argument("--limit", type=int, help="Check only first N rows in each JSON file.")
     parser.add_argument("--debug", action='store_true', help="Print out each alignment.")
     parser.add_argument("--same-length", action='store_true', help="Only consider pairs with same sequence length.")
     parser.add_argument("--framework-first", action='store_true', help="Prioritize framework identity over CDR identity.")
+    parser.add_argument("--top-k", type=int, default=1, help="Number of best hits to save for each query.")
+    parser.add_argument("--block-size", type=int, default=oas_search.DEFAULT_BLOCK_SIZE, help="Number of target sequences compared with all queries at once.")
     options = parser.parse_args()
     
     if options.debug and not options.limit:
         raise ValueError('Only use --debug with --limit')
+    oas_search.validate_target_options(parser, options)
+    if options.top_k < 1:
+        parser.error('--top-k needs to be at least 1')
     
     queries = Chain.from_anarci_csv(options.query, scheme='imgt', as_series=True)
-        
-    evaluate_hit = evaluate_framework_hit if options.framework_first else evaluate_cdr_hit   
-    
-    print(f'Searching {len(queries)} antibodies in {len(options.targets)} JSON files...')
-    results = {name: {} for name in queries.index}
-    for json_path in options.targets:
-        for hit in iterate_oas_json(json_path, limit=options.limit):
-            for query in queries:
-                num_cdr_matches, num_fw_matches = evaluate_hit(query, hit, results[query.name], same_length=options.same_length) 
-                if options.debug:
-                    print(f'{hit.name} VS {query.name}:')
-                    print(hit.align(query))
-                    print('CDR:', num_cdr_matches, 'FW:', num_fw_matches)
-                if num_cdr_matches is None:
-                    continue
-                # save improvement
-                results[query.name] = {
-                    'num_cdr_matches': num_cdr_matches,
-                    'num_fw_matches': num_fw_matches,
-                    'hit_name': hit.name,
-                    'hit_seq': hit.seq
-                }
-    
-    sorted_index = [name for name in queries.index if results[name]]
-    sorted_hits = [Chain(results[name]['hit_seq'], scheme='imgt', name=name) for name in sorted_index]
-    table = Chain.to_dataframe(sorted_hits)
-    if not table.empty:
-        table.insert(1, 'num_cdr_matches', [results[name]['num_cdr_matches'] for name in sorted_index])
-        table.insert(2, 'num_fw_matches', [results[name]['num_fw_matches'] for name in sorted_index])
-        table.insert(3, 'num_full_matches', table['num_cdr_matches'] + table['num_fw_matches'])
-        table.insert(4, 'hit_name', [results[name]['hit_name'] for name in sorted_index])
-        
-    table.to_csv(options.output)
-    print(f'Saved {len(table)} hits to: {options.output}')
+    search_kwargs = dict(
+        limit=options.limit,
+        debug=options.debug,
+        same_length=options.same_length,
+        framework_first=options.framework_first,
+        top_k=options.top_k,
+        block_size=options.block_size
+    )
+
+    settings = oas_search.get_search_settings(queries, **search_kwargs)
+
+    if options.manifest:
+        paths = oas_search.read_manifest(options.manifest)
+        print(f'Searching {len(queries)} antibodies in {len(paths)} data units using {options.workers} workers...')
+        oas_search.search_units_parallel(search_unit_to_csv, paths, options.output_dir, workers=options.workers,
+                                         resume=options.resume, settings=settings, queries=queries,
+                                         hit_store=HitStore(options.hit_store) if options.hit_store else None, **search_kwargs)
+    else:
+        results = create_results(queries, top_k=options.top_k, framework_first=options.framework_first)
+        checkpoint = None
+        if options.checkpoint:
+            checkpoint = oas_search.SearchCheckpoint(options.checkpoint, results, settings, interval=options.checkpoint_interval)
+            print(f'Skipping {len(checkpoint)} data units that were already searched according to: {options.checkpoint}')
+        if options.store:
+            print(f'Searching {len(queries)} antibodies in store: {options.store}')
+            store = OASStore(options.store)
+            oas_search.search_store(search_units, queries, store, results, same_cdr_lengths=options.same_length and not options.framework_first,
+                                    v_families=options.v_family, checkpoint=checkpoint, **search_kwargs)
+        else:
+            print(f'Searching {len(queries)} antibodies in {len(options.targets)} data units...')
+            search_units(queries, options.targets, results=results, checkpoint=checkpoint, **search_kwargs)
+        if checkpoint is not None:
+            checkpoint.save()
+        table = get_hits_table(queries, results)
+        table.to_csv(options.output)
+        print(f'Saved {len(table)} hits to: {options.output}')
@@ -7,38 +7,332 @@ import os
 import numpy as np
 from collections import OrderedDict
 from tqdm import tqdm
-from abnumber import Chain
+from abnumber import Chain, Position
+from abnumber.alignment import is_similar_residue
+import itertools
+import multiprocessing
+from collections import deque
 import re
 import requests
 import time
+from bin.utils import AMINO_ACIDS, AMINO_ACID_CODES, GAP_CODE, encode_chains
 
-def get_seq_germline_content(seq, scheme='imgt', per_position=False):
-    chain = Chain(seq, scheme=scheme)
-    germline_chain = chain.find_merged_human_germline().renumber(scheme)
-    aligned = chain.align(germline_chain)
-    if per_position:
-        return [(pos, aa == bb) for pos, (aa, bb) in aligned]
-    num_identical = len(aligned) - aligned.num_mutations()
-    return num_identical / len(chain)
-
-def get_seqs_germline_content(queries, scheme='imgt', per_position=False):
-    results = []
-    for query in tqdm(queries):
-        if per_position:
-            for pos, is_germline in get_seq_germline_content(query.seq, scheme=scheme, per_position=True):
-                results.append({
-                    'id': query.id,
-                    'description': query.description,
-                    scheme+'_pos': pos,
-                    'is_germline': is_germline
-                })
+GERMLINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'germlines', 'imgt_human_variable_germlines.fa')
+FUNCTIONAL = ['F', '(F)', '[F]']
+# Conserved J-region residue (W or F of the W/F-G-X-G motif) is at IMGT position 118
+J_ANCHOR_REGEX = re.compile('[WF]G.G')
+J_ANCHOR_POSITION = 118
+DEFAULT_BATCH_SIZE = 256
+# Germline score is IDENTICAL_WEIGHT * identical + similar residues, same ranking as identical + 0.01 * similar in abnumber
+IDENTICAL_WEIGHT = 100
+
+def get_j_positions(seq):
+    """
+    Get IMGT positions of J-region residues, counted from the conserved W/F at position 118 in both directions
+    """
+    match = J_ANCHOR_REGEX.search(seq)
+    if not match:
+        return None
+    anchor = match.start()
+    after = [str(J_ANCHOR_POSITION + i) for i in range(len(seq) - anchor)]
+    # CDR3 positions are filled from its end: 117, ..., 113, 112, 112A, 112B, ...
+    before = [str(J_ANCHOR_POSITION - 1 - i) for i in range(min(anchor, 6))] + [f'112{chr(ord("A") + i)}' for i in range(anchor - 6)]
+    return before[::-1] + after
+
+def read_germlines(path=GERMLINES_PATH, functional=FUNCTIONAL):
+    """
+    Read complete human V and J germlines from IMGT FASTA file with IMGT-gapped V-regions
+
+    :return: dict of chain type -> dict of 'V' or 'J' -> dict of germline name -> dict of IMGT position -> residue
+    """
+    germlines = {}
+    for record in SeqIO.parse(path, 'fasta'):
+        fields = record.description.split('|')
+        name, species, functionality, region = fields[1], fields[2], fields[3], fields[4]
+        # skip partial germlines, their missing residues would not count as germline
+        partial = any(field.startswith('partial') for field in fields[5:])
+        if species != 'Homo sapiens' or functionality not in functional or region not in ['V-REGION', 'J-REGION'] or partial:
+            continue
+        seq = str(record.seq).upper()
+        chain_type = name[2]
+        if region == 'V-REGION':
+            # position in IMGT-gapped sequence is the IMGT position, CDR3 residues after 111 are insertions 111A, 111B, ...
+            residues = {(str(i + 1) if i < 111 else f'111{chr(ord("A") + i - 111)}'): aa for i, aa in enumerate(seq) if aa != '.'}
         else:
-            results.append(dict(
-                id=query.id,
-                description=query.description,
-                germline_content=get_seq_germline_content(query.seq)
-            ))
-    return pd.DataFrame(results)
+            positions = get_j_positions(seq)
+            if positions is None:
+                continue
+            residues = dict(zip(positions, seq))
+        germlines.setdefault(chain_type, {}).setdefault(region[0], {})[name] = residues
+    return germlines
+
+class GermlineAssigner:
+    """
+    Vectorized assignment of nearest human V and J germlines, same ranking as Chain.find_merged_human_germline,
+    over the IMGT FASTA germline set (read_germlines)
+
+    The IMGT FASTA germline set differs from the germlines bundled with abnumber (a few alleles are missing or added,
+    IGLV4-3 and IGLV9-49 are numbered differently), so the assigned germline can differ for some chains.
+
+    Germlines of each chain type are encoded once as a (germlines x IMGT positions) matrix, queries are encoded
+    on the same positions and compared with all germlines at once. Germlines are ranked by number of identical residues
+    plus 0.01 times number of similar residues (summed from a precomputed position x residue x germline score table),
+    ties are resolved in favor of the first germline by name.
+    Results are cached by the residues at V germline positions (V gene) and J germline positions (J gene),
+    so repeated variants of the same antibody are only compared with the germlines once.
+    """
+    def __init__(self, germlines=None, batch_size=DEFAULT_BATCH_SIZE):
+        germlines = germlines if germlines is not None else read_germlines()
+        self.batch_size = batch_size
+        self.similar = np.zeros((GAP_CODE + 1, GAP_CODE + 1), dtype=bool)
+        for a, aa in enumerate(AMINO_ACIDS):
+            for b, bb in enumerate(AMINO_ACIDS):
+                self.similar[a, b] = is_similar_residue(aa, bb)
+        self.positions = {}
+        self.position_index = {}
+        self.names = {}
+        self.matrices = {}
+        self.gene_positions = {}
+        self.cache = {}
+        self.score_tables = {}
+        for chain_type, genes in germlines.items():
+            positions = sorted({pos for gene in genes.values() for residues in gene.values() for pos in residues},
+                               key=lambda pos: Position.from_string(pos, chain_type=chain_type, scheme='imgt'))
+            self.positions[chain_type] = positions
+            self.position_index[chain_type] = {pos: i for i, pos in enumerate(positions)}
+            for gene, named_residues in genes.items():
+                matrix, names = [], []
+                for name in sorted(named_residues):
+                    codes = np.full(len(positions), GAP_CODE, dtype=np.int64)
+                    for pos, aa in named_residues[name].items():
+                        codes[self.position_index[chain_type][pos]] = AMINO_ACID_CODES[ord(aa)]
+                    # skip germlines with duplicate sequence
+                    if not any(np.array_equal(codes, other) for other in matrix):
+                        matrix.append(codes)
+                        names.append(name)
+                self.matrices[(chain_type, gene)] = np.array(matrix)
+                self.names[(chain_type, gene)] = names
+                self.gene_positions[(chain_type, gene)] = np.flatnonzero((self.matrices[(chain_type, gene)] != GAP_CODE).any(axis=0))
+                # score of each (position, query residue, germline)
+                matrix = self.matrices[(chain_type, gene)].T[:, None, :]
+                residues = np.arange(GAP_CODE + 1)[None, :, None]
+                identical = (matrix == residues) & (residues != GAP_CODE)
+                similar = self.similar[residues, matrix] | identical
+                self.score_tables[(chain_type, gene)] = (identical * IDENTICAL_WEIGHT + similar).astype(np.int32)
+
+    def encode(self, chain):
+        """
+        Encode residues of IMGT-numbered Chain at germline positions, residues at other positions are ignored
+        """
+        return encode_chains([chain], self.position_index[chain.chain_type])[0]
+
+    def _rank(self, codes, chain_type, gene):
+        """
+        Get index of best germline for each row of encoded queries
+        """
+        table = self.score_tables[(chain_type, gene)]
+        position_idx = np.arange(codes.shape[1])[None, :]
+        best = []
+        for start in range(0, len(codes), self.batch_size):
+            scores = table[position_idx, codes[start:start + self.batch_size]].sum(axis=1)
+            # first germline wins ties
+            best.append(np.argmax(scores, axis=1))
+        return np.concatenate(best) if best else np.zeros(0, dtype=np.int64)
+
+    def assign_encoded(self, chain_type, encoded):
+        """
+        Find best V and J germline of each row of a matrix of queries of one chain type, encoded at germline positions
+
+        :return: tuple of arrays of V germline indexes and J germline indexes, see get_germline_codes and names
+        """
+        results = []
+        for gene in ['V', 'J']:
+            keys = [row.tobytes() for row in encoded[:, self.gene_positions[(chain_type, gene)]]]
+            cache = self.cache.setdefault((chain_type, gene), {})
+            pending = {}
+            for i, key in enumerate(keys):
+                if key not in cache:
+                    pending.setdefault(key, i)
+            if pending:
+                best = self._rank(encoded[list(pending.values())], chain_type, gene)
+                cache.update(zip(pending, best.tolist()))
+            results.append(np.array([cache[key] for key in keys], dtype=np.int64))
+        return tuple(results)
+
+    def assign(self, chains):
+        """
+        Find best V and J germline of each IMGT-numbered Chain
+
+        :return: tuple of list of (V germline index, J germline index) tuples and list of encoded chains
+        """
+        encoded = [self.encode(chain) for chain in chains]
+        results = [None] * len(chains)
+        for chain_type in set(chain.chain_type for chain in chains):
+            idxs = [i for i, chain in enumerate(chains) if chain.chain_type == chain_type]
+            v_idxs, j_idxs = self.assign_encoded(chain_type, np.array([encoded[i] for i in idxs]))
+            for i, v_idx, j_idx in zip(idxs, v_idxs.tolist(), j_idxs.tolist()):
+                results[i] = (v_idx, j_idx)
+        return results, encoded
+
+    def get_germline_codes(self, chain_type, v_idx, j_idx):
+        """
+        Get encoded merged germline, V germline residues take priority over J germline residues
+        """
+        v_codes = self.matrices[(chain_type, 'V')][v_idx]
+        return np.where(v_codes != GAP_CODE, v_codes, self.matrices[(chain_type, 'J')][j_idx])
+
+    def get_merged_germline(self, chain_type, v_idx, j_idx):
+        """
+        Get merged germline as IMGT-numbered Chain
+        """
+        codes = self.get_germline_codes(chain_type, v_idx, j_idx)
+        return Chain(sequence=None, scheme='imgt', chain_type=chain_type, tail='', aa_dict={
+            Position.from_string(pos, chain_type=chain_type, scheme='imgt'): AMINO_ACIDS[code]
+            for pos, code in zip(self.positions[chain_type], codes) if code != GAP_CODE
+        }, name=f'{self.names[(chain_type, "V")][v_idx]} {self.names[(chain_type, "J")][j_idx]}')
+
+    def get_germline_content(self, chains, per_position=False, scheme='imgt'):
+        """
+        Get fraction of residues identical to the merged germline for each IMGT-numbered Chain,
+        or list of (position, is_germline) tuples with per_position
+
+        Germline content is computed from the encoded germlines, other numbering schemes
+        align the merged germline renumbered to the given scheme.
+        """
+        assignments, encoded = self.assign(chains)
+        results = []
+        for chain, codes, (v_idx, j_idx) in zip(chains, encoded, assignments):
+            if scheme != 'imgt':
+                germline_chain = self.get_merged_germline(chain.chain_type, v_idx, j_idx).renumber(scheme)
+                aligned = chain.renumber(scheme).align(germline_chain)
+                if per_position:
+                    results.append([(pos, aa == bb) for pos, (aa, bb) in aligned])
+                else:
+                    results.append((len(aligned) - aligned.num_mutations()) / len(chain))
+                continue
+            germline_codes = self.get_germline_codes(chain.chain_type, v_idx, j_idx)
+            if per_position:
+                germline_positions = {Position.from_string(pos, chain_type=chain.chain_type, scheme='imgt'): code
+                                      for pos, code in zip(self.positions[chain.chain_type], germline_codes) if code != GAP_CODE}
+                position_index = self.position_index[chain.chain_type]
+                results.append([
+                    (pos, pos in chain.positions and pos in germline_positions
+                     and AMINO_ACID_CODES[ord(chain.positions[pos])] == germline_positions[pos] != GAP_CODE)
+                    for pos in sorted(set(chain.positions) | set(germline_positions))
+                ])
+            else:
+                num_identical = int(((codes == germline_codes) & (codes != GAP_CODE)).sum())
+                results.append(num_identical / len(chain))
+        return results
+
+_default_assigner = None
+
+def get_default_assigner():
+    global _default_assigner
+    if _default_assigner is None:
+        _default_assigner = GermlineAssigner()
+    return _default_assigner
+
+def get_seq_germline_content(seq, scheme='imgt', per_position=False, assigner=None):
+    chain = Chain(seq, scheme='imgt')
+    return (assigner or get_default_assigner()).get_germline_content([chain], per_position=per_position, scheme=scheme)[0]
+
+# Per-position matrix values, positions missing in both query and germline are marked as absent
+MATRIX_NOT_GERMLINE = 0
+MATRIX_GERMLINE = 1
+MATRIX_ABSENT = 255
+# IMGT positions with insertions (CDR1, CDR2 and CDR3), insertion codes A-Z are included in the per-position matrix
+IMGT_INSERTION_POSITIONS = [32, 33, 60, 61, 111, 112]
+MATRIX_POSITIONS_SUFFIX = '.positions.txt'
+DEFAULT_CHUNK_SIZE = 1000
+
+def get_imgt_position_labels():
+    """
+    Get ordered IMGT position labels used as per-position matrix columns (1-128 and insertions)
+    """
+    labels = [str(i) for i in range(1, 129)]
+    labels += [f'{i}{chr(ord("A") + c)}' for i in IMGT_INSERTION_POSITIONS for c in range(26)]
+    return sorted(labels, key=lambda label: Position.from_string(label, chain_type='H', scheme='imgt'))
+
+def get_chunk_germline_content(records, scheme='imgt', per_position=False, matrix_labels=None, assigner=None):
+    """
+    Get germline content table of a chunk of (id, description, sequence) records
+
+    :param per_position: return long table with one row for each position instead
+    :param matrix_labels: also return uint8 matrix with one row for each record and one column for each position label
+    :return: DataFrame, or tuple of DataFrame and matrix with matrix_labels
+    """
+    assigner = assigner or get_default_assigner()
+    chains = [Chain(seq, scheme='imgt') for _, _, seq in records]
+    if per_position:
+        contents = assigner.get_germline_content(chains, per_position=True, scheme=scheme)
+        return pd.DataFrame([
+            {'id': record_id, 'description': description, scheme+'_pos': pos, 'is_germline': is_germline}
+            for (record_id, description, _), content in zip(records, contents) for pos, is_germline in content
+        ], columns=['id', 'description', scheme+'_pos', 'is_germline'])
+    if matrix_labels is None:
+        return pd.DataFrame({
+            'id': [record_id for record_id, _, _ in records],
+            'description': [description for _, description, _ in records],
+            'germline_content': assigner.get_germline_content(chains)
+        })
+    label_index = {label: i for i, label in enumerate(matrix_labels)}
+    matrix = np.full((len(records), len(matrix_labels)), MATRIX_ABSENT, dtype=np.uint8)
+    germline_content = []
+    # germline content is computed from the same per-position pass, chains are only assigned once
+    for i, (chain, content) in enumerate(zip(chains, assigner.get_germline_content(chains, per_position=True))):
+        for pos, is_germline in content:
+            label = pos.format(chain_type=False)
+            if label not in label_index:
+                raise ValueError(f'Position {label} of {records[i][0]} is not one of the per-position matrix positions')
+            matrix[i, label_index[label]] = MATRIX_GERMLINE if is_germline else MATRIX_NOT_GERMLINE
+        germline_content.append(sum(is_germline for _, is_germline in content) / len(chain))
+    table = pd.DataFrame({
+        'id': [record_id for record_id, _, _ in records],
+        'description': [description for _, description, _ in records],
+        'germline_content': germline_content
+    })
+    return table, matrix
+
+def _process_chunk(args):
+    records, kwargs = args
+    return get_chunk_germline_content(records, **kwargs)
+
+def iterate_germline_content(queries, chunk_size=DEFAULT_CHUNK_SIZE, workers=1, **kwargs):
+    """
+    Get results of get_chunk_germline_content for chunks of queries, in order of queries
+
+    Chunks are processed by a pool of worker processes, only a few chunks are read ahead so that memory does not grow with input size.
+    """
+    records = ((query.id, query.description, str(query.seq)) for query in queries)
+    chunks = iter(lambda: list(itertools.islice(records, chunk_size)), [])
+    if workers == 1:
+        for chunk in chunks:
+            yield get_chunk_germline_content(chunk, **kwargs)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_process_chunk, ((chunk, kwargs),)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def get_seqs_germline_content(queries, scheme='imgt', per_position=False, chunk_size=DEFAULT_CHUNK_SIZE, workers=1):
+    """
+    Get germline content of each query, or one row for each position of each query with per_position
+    """
+    return pd.concat(list(iterate_germline_content(queries, chunk_size=chunk_size, workers=workers, scheme=scheme, per_position=per_position)),
+                     ignore_index=True)
+
+def read_per_position_matrix(path):
+    """
+    Read per-position matrix saved using --per-position-matrix as memory-mapped uint8 array, together with its position labels
+    """
+    with open(path + MATRIX_POSITIONS_SUFFIX) as f:
+        labels = [line.strip() for line in f]
+    return np.memmap(path, dtype=np.uint8, mode='r').reshape(-1, len(labels)), labels
 
 if __name__ == "__main__":
     # Parse command line
@@ -47,12 +341,38 @@ if __name__ == "__main__":
     parser.add_argument("output", help="Output TSV file path.")
     parser.add_argument("--scheme", default='imgt', help="Numbering scheme.")
     parser.add_argument("--per-position", action="store_true", help="Include one row for each position.")
+    parser.add_argument("--per-position-matrix", help="Also save uint8 matrix with one row for each sequence and one column for each IMGT position "
+                                                      f"({MATRIX_GERMLINE} germline, {MATRIX_NOT_GERMLINE} not germline, {MATRIX_ABSENT} absent) "
+                                                      f"to this path, with position labels in {MATRIX_POSITIONS_SUFFIX} file.")
+    parser.add_argument("--workers", default=1, type=int, help="Number of worker processes.")
+    parser.add_argument("--chunk-size", default=DEFAULT_CHUNK_SIZE, type=int, help="Number of sequences processed and saved at once.")
 
     options = parser.parse_args()
+    if options.per_position_matrix and (options.per_position or options.scheme != 'imgt'):
+        parser.error('--per-position-matrix can only be used with --scheme imgt and without --per-position')
     
     queries = SeqIO.parse(options.query, 'fasta')
-    
-    df = get_seqs_germline_content(queries, scheme=options.scheme, per_position=options.per_position)
-    
-    df.to_csv(options.output, sep='\t', index=False)
-    print(f'Saved to: {options.output}')
+
+    kwargs = dict(scheme=options.scheme, per_position=options.per_position)
+    matrix_file = None
+    if options.per_position_matrix:
+        labels = get_imgt_position_labels()
+        kwargs['matrix_labels'] = labels
+        with open(options.per_position_matrix + MATRIX_POSITIONS_SUFFIX, 'w') as f:
+            f.writelines(f'{label}\n' for label in labels)
+        matrix_file = open(options.per_position_matrix, 'wb')
+
+    num_seqs = 0
+    with open(options.output, 'w') as f, tqdm() as progress:
+        for i, result in enumerate(iterate_germline_content(queries, chunk_size=options.chunk_size, workers=options.workers, **kwargs)):
+            if matrix_file is not None:
+                result, matrix = result
+                matrix_file.write(matrix.tobytes())
+            result.to_csv(f, sep='\t', index=False, header=i == 0)
+            chunk_seqs = result['id'].nunique() if options.per_position else len(result)
+            num_seqs += chunk_seqs
+            progress.update(chunk_seqs)
+    if matrix_file is not None:
+        matrix_file.close()
+        print(f'Saved per-position matrix to: {options.per_position_matrix}')
+    print(f'Saved {num_seqs} sequences to: {options.output}')
@@ -3,49 +3,256 @@
 import argparse
 import pandas as pd
 from Bio import SeqIO
-import os
 import numpy as np
-from collections import OrderedDict
 from tqdm import tqdm
 from abnumber import Chain
-import re
-import requests
-import time
-
-def get_seq_germline_content(seq):
-    chain = Chain(seq, scheme='imgt')
-    germline_chain = chain.find_merged_human_germline()
-    aligned = chain.align(germline_chain)
-    num_identical = len(aligned) - aligned.num_mutations()
-    return num_identical / len(chain)
-
-def get_seqs_germline_content(queries):
-    results = []
-    for query in tqdm(queries):
-        results.append(dict(
-            id=query.id,
-            description=query.description,
-            germline_content=get_seq_germline_content(query.seq)
-        ))
-    return pd.DataFrame(results)
-
-def get_seqs_germline_alignment(queries):
-    results = []
-    for query in tqdm(queries):
-        results
-    return pd.DataFrame(results)
+import itertools
+import multiprocessing
+from collections import deque
+from bin.humanness_germline_content import get_default_assigner, get_imgt_position_labels
+from bin.oas_units import read_unit, is_encoded_unit
+from bin.oas_store import get_v_family
+from bin.oas_search import read_manifest
+from bin.utils import AMINO_ACIDS, AMINO_ACID_CODES, GAP_CODE, encode_chains
+
+# Residue of each code, gaps and unknown residues last
+RESIDUES = AMINO_ACIDS + '-'
+NUM_CODES = GAP_CODE + 1
+DEFAULT_CHUNK_SIZE = 10000
+
+class GermlinePileup:
+    """
+    Pileup of query residues against residues of their nearest human germline (see GermlineAssigner)
+
+    Counts are kept as one dense (positions x query residues x germline residues) array for each group of sequences,
+    groups are chain types, or chain types and V families of the assigned germline with by_v_family.
+    Pileups of chunks of sequences can be computed separately and merged.
+    """
+    def __init__(self, labels=None, by_v_family=False):
+        self.labels = list(labels if labels is not None else get_imgt_position_labels())
+        self.label_index = {label: i for i, label in enumerate(self.labels)}
+        self.by_v_family = by_v_family
+        self.counts = {}
+
+    def add_counts(self, group, counts):
+        if group in self.counts:
+            self.counts[group] += counts
+        else:
+            self.counts[group] = counts.copy()
+
+    def merge(self, other):
+        assert self.labels == other.labels and self.by_v_family == other.by_v_family, 'Cannot merge pileups with different settings'
+        for group, counts in other.counts.items():
+            self.add_counts(group, counts)
+        return self
+
+    def add_encoded(self, chain_types, codes, assigner):
+        """
+        Assign germlines and add counts of sequences encoded at pileup positions
+
+        :param chain_types: chain type of each sequence
+        :param codes: (sequences x positions) matrix of amino acid codes at pileup positions
+        """
+        chain_types = np.asarray(chain_types)
+        for chain_type in np.unique(chain_types):
+            rows = np.flatnonzero(chain_types == chain_type)
+            chain_codes = codes[rows]
+            # germline positions are a subset of pileup positions
+            columns = np.array([self.label_index[pos] for pos in assigner.positions[chain_type]])
+            v_idxs, j_idxs = assigner.assign_encoded(chain_type, chain_codes[:, columns])
+            v_codes = assigner.matrices[(chain_type, 'V')][v_idxs]
+            germline_codes = np.full(chain_codes.shape, GAP_CODE, dtype=np.int64)
+            germline_codes[:, columns] = np.where(v_codes != GAP_CODE, v_codes, assigner.matrices[(chain_type, 'J')][j_idxs])
+
+            if self.by_v_family:
+                v_names = assigner.names[(chain_type, 'V')]
+                families = np.array([get_v_family(v_names[i]) for i in range(len(v_names))])[v_idxs]
+                groups = [((chain_type, family), families == family) for family in np.unique(families)]
+            else:
+                groups = [((chain_type,), np.ones(len(rows), dtype=bool))]
+            flat = (np.arange(len(self.labels))[None, :] * NUM_CODES + chain_codes) * NUM_CODES + germline_codes
+            # skip positions missing in both query and germline
+            present = (chain_codes != GAP_CODE) | (germline_codes != GAP_CODE)
+            for group, mask in groups:
+                counts = np.bincount(flat[mask][present[mask]], minlength=len(self.labels) * NUM_CODES * NUM_CODES)
+                self.add_counts(group, counts.reshape(len(self.labels), NUM_CODES, NUM_CODES))
+
+    def add_chains(self, chains, assigner):
+        """
+        Add IMGT-numbered abnumber Chains
+        """
+        codes = encode_chains(chains, self.label_index)
+        self.add_encoded([chain.chain_type for chain in chains], codes, assigner)
+
+    def add_unit(self, unit, assigner):
+        """
+        Add sequences of an EncodedUnit (see bin/oas_units.py)
+        """
+        columns = [i for i, pos in enumerate(unit.positions) if pos in self.label_index]
+        codes = np.full((len(unit), len(self.labels)), GAP_CODE, dtype=np.int64)
+        # missing residues are encoded as 0, which maps to the gap code
+        codes[:, [self.label_index[unit.positions[i]] for i in columns]] = AMINO_ACID_CODES[np.asarray(unit.residues)[:, columns]]
+        self.add_encoded(np.asarray(unit.chain_types), codes, assigner)
+
+    def get_group_columns(self):
+        return ['chain_type', 'v_family'] if self.by_v_family else ['chain_type']
+
+    def get_rates_table(self):
+        """
+        Get table with number of residues, germline residues and germline match rate of each group and position
+        """
+        tables = []
+        for group, counts in sorted(self.counts.items()):
+            num_residues = counts[:, :GAP_CODE, :].sum(axis=(1, 2))
+            num_matches = np.einsum('pii->p', counts[:, :GAP_CODE, :GAP_CODE])
+            table = pd.DataFrame({
+                'position': self.labels,
+                'num_residues': num_residues,
+                'num_germline_residues': counts[:, :, :GAP_CODE].sum(axis=(1, 2)),
+                'num_matches': num_matches,
+                'germline_rate': num_matches / np.maximum(num_residues, 1)
+            })
+            for column, value in zip(self.get_group_columns(), group):
+                table.insert(len(table.columns) - 5, column, value)
+            tables.append(table[(table['num_residues'] > 0) | (table['num_germline_residues'] > 0)])
+        return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+    def get_counts_table(self):
+        """
+        Get long table of non-zero counts of each group, position, query residue and germline residue
+        """
+        tables = []
+        for group, counts in sorted(self.counts.items()):
+            position_idx, residue_idx, germline_idx = np.nonzero(counts)
+            table = pd.DataFrame({
+                'position': np.array(self.labels)[position_idx],
+                'residue': np.array(list(RESIDUES))[residue_idx],
+                'germline_residue': np.array(list(RESIDUES))[germline_idx],
+                'count': counts[position_idx, residue_idx, germline_idx]
+            })
+            for column, value in zip(self.get_group_columns(), group):
+                table.insert(len(table.columns) - 4, column, value)
+            tables.append(table)
+        return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+    def save(self, path):
+        groups = sorted(self.counts)
+        with open(path, 'wb') as f:
+            np.savez(f, labels=np.array(self.labels), by_v_family=self.by_v_family,
+                     groups=np.array(['\t'.join(group) for group in groups]),
+                     counts=np.array([self.counts[group] for group in groups]).reshape(-1, len(self.labels), NUM_CODES, NUM_CODES))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        pileup = cls(labels=data['labels'].tolist(), by_v_family=bool(data['by_v_family']))
+        for group, counts in zip(data['groups'].tolist(), data['counts']):
+            pileup.counts[tuple(group.split('\t'))] = counts
+        return pileup
+
+_worker_context = {}
+
+def _init_worker():
+    _worker_context['assigner'] = get_default_assigner()
+
+def _pileup_chunk(task):
+    """
+    Get pileup of a chunk of FASTA records, or of a range of rows of a data unit
+    """
+    kind, data, by_v_family = task
+    assigner = _worker_context.get('assigner') or get_default_assigner()
+    pileup = GermlinePileup(by_v_family=by_v_family)
+    if kind == 'fasta':
+        pileup.add_chains([Chain(seq, scheme='imgt') for seq in data], assigner)
+        return pileup, len(data)
+    path, start, end = data
+    unit = read_unit(path)
+    if start is not None:
+        unit = unit.take(slice(start, end))
+    pileup.add_unit(unit, assigner)
+    return pileup, len(unit)
+
+def iterate_pileup_tasks(paths, by_v_family=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split FASTA files and OAS data units (JSON or encoded) into chunks of sequences
+    """
+    for path in paths:
+        if is_encoded_unit(path):
+            num_seqs = len(read_unit(path))
+            for start in range(0, num_seqs, chunk_size):
+                yield 'unit', (path, start, start + chunk_size), by_v_family
+        elif path.endswith('.json') or path.endswith('.json.gz'):
+            # JSON data units are encoded in memory, so they are not split
+            yield 'unit', (path, None, None), by_v_family
+        else:
+            records = (str(record.seq) for record in SeqIO.parse(path, 'fasta'))
+            for chunk in iter(lambda: list(itertools.islice(records, chunk_size)), []):
+                yield 'fasta', chunk, by_v_family
+
+def get_germline_pileup(paths, by_v_family=False, chunk_size=DEFAULT_CHUNK_SIZE, workers=1):
+    """
+    Compute pileup of query residues against their nearest human germline residues
+
+    Chunks of sequences are processed by a pool of worker processes and their pileups are merged,
+    only a few chunks are read ahead so that memory does not grow with input size.
+
+    :param paths: FASTA files (numbered using ANARCI) or OAS data units (JSON or encoded using bin/oas_units.py)
+    :return: GermlinePileup
+    """
+    pileup = GermlinePileup(by_v_family=by_v_family)
+    tasks = iterate_pileup_tasks(paths, by_v_family=by_v_family, chunk_size=chunk_size)
+    with tqdm(unit='seqs') as progress:
+        if workers == 1:
+            _init_worker()
+            for task in tasks:
+                chunk_pileup, num_seqs = _pileup_chunk(task)
+                pileup.merge(chunk_pileup)
+                progress.update(num_seqs)
+        else:
+            with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+                pending = deque()
+                for task in itertools.chain(tasks, [None]):
+                    if task is not None:
+                        pending.append(pool.apply_async(_pileup_chunk, (task,)))
+                    while pending and (task is None or len(pending) >= 2 * workers):
+                        chunk_pileup, num_seqs = pending.popleft().get()
+                        pileup.merge(chunk_pileup)
+                        progress.update(num_seqs)
+    return pileup
+
+def get_seqs_germline_alignment(queries, by_v_family=False):
+    """
+    Get germline pileup rates table of query SeqRecords
+    """
+    pileup = GermlinePileup(by_v_family=by_v_family)
+    pileup.add_chains([Chain(str(query.seq), scheme='imgt') for query in tqdm(queries)], get_default_assigner())
+    return pileup.get_rates_table()
 
 if __name__ == "__main__":
     # Parse command line
-    parser = argparse.ArgumentParser()
-    parser.add_argument("query", help="Query FASTA sequence file.")
-    parser.add_argument("output", help="Output TSV file path.")
+    parser = argparse.ArgumentParser(description='Pileup of query residues against residues of their nearest human germline at each IMGT position.')
+    parser.add_argument("query", nargs='+', help="Query FASTA sequence file(s), or OAS data unit(s) (JSON or encoded using bin/oas_units.py).")
+    parser.add_argument("output", help="Output TSV file path with germline match rate at each position.")
+    parser.add_argument("--manifest", help="Text file with one additional query path per line.")
+    parser.add_argument("--counts", help="Output TSV file path with counts of each query residue and germline residue at each position.")
+    parser.add_argument("--save-pileup", help="Output .npz file path with pileup count arrays.")
+    parser.add_argument("--merge", nargs='+', help="Add pileups saved using --save-pileup.")
+    parser.add_argument("--by-v-family", action="store_true", help="Separate pileup for each V family of the nearest germline.")
+    parser.add_argument("--workers", default=1, type=int, help="Number of worker processes.")
+    parser.add_argument("--chunk-size", default=DEFAULT_CHUNK_SIZE, type=int, help="Number of sequences in one task.")
 
     options = parser.parse_args()
-    
-    queries = SeqIO.parse(options.query, 'fasta')
-    
-    df = get_seqs_germline_alignment(queries)
-    
-    df.to_csv(options.output, sep='\t', index=False)
+
+    paths = options.query + (read_manifest(options.manifest) if options.manifest else [])
+    pileup = get_germline_pileup(paths, by_v_family=options.by_v_family, chunk_size=options.chunk_size, workers=options.workers)
+    for path in options.merge or []:
+        pileup.merge(GermlinePileup.load(path))
+
+    pileup.get_rates_table().to_csv(options.output, sep='\t', index=False)
     print(f'Saved to: {options.output}')
+    if options.counts:
+        pileup.get_counts_table().to_csv(options.counts, sep='\t', index=False)
+        print(f'Saved counts to: {options.counts}')
+    if options.save_pileup:
+        pileup.save(options.save_pileup)
+        print(f'Saved pileup to: {options.save_pileup}')
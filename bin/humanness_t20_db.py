@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+from abnumber import Chain
+from abnumber.exceptions import ChainParseError
+from tqdm import tqdm
+
+DB_INDEX = 'index.json'
+CHAIN_TYPES = ['H', 'K', 'L']
+
+
+def get_chain_type(seq):
+    """
+    Get IMGT chain type (H, K or L) of a sequence, None if it cannot be numbered
+    """
+    try:
+        return Chain(seq, scheme='imgt').chain_type
+    except ChainParseError:
+        return None
+
+
+def read_text_db(path):
+    """
+    Read sequences from gzipped (or plain) text file with one sequence per line
+    """
+    with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path)) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+class PackedSequences:
+    """
+    Memory-mapped sequences of one chain type, saved as one byte buffer with an array of start offsets
+
+    Only the paths are pickled, so worker processes map the same files and share their pages.
+    """
+    def __init__(self, path, chain_type):
+        self.path = path
+        self.chain_type = chain_type
+        self.offsets = np.load(os.path.join(path, f'{chain_type}.offsets.npy'), mmap_mode='r')
+        seqs_path = os.path.join(path, f'{chain_type}.seqs')
+        # np.memmap cannot map empty files
+        self.data = np.memmap(seqs_path, dtype=np.uint8, mode='r') if os.path.getsize(seqs_path) else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        return {'path': self.path, 'chain_type': self.chain_type}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['chain_type'])
+
+
+class T20Database:
+    """
+    Compiled T20 reference database: deduplicated sequences split by chain type and sorted by length
+
+    Each chain type is saved as <chain_type>.seqs (concatenated sequences) and <chain_type>.offsets.npy,
+    numbers of sequences are listed in index.json.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, DB_INDEX)) as f:
+            self.index = json.load(f)
+        self.chain_types = list(self.index['num_seqs'])
+
+    def __len__(self):
+        return sum(self.index['num_seqs'].values())
+
+    def get_targets(self, chain_type):
+        return PackedSequences(self.path, chain_type)
+
+    def get_kmer_index_path(self, chain_type, k):
+        return os.path.join(self.path, f'{chain_type}.kmers{k}.npz')
+
+    @classmethod
+    def is_database(cls, path):
+        return os.path.isdir(path) and os.path.exists(os.path.join(path, DB_INDEX))
+
+
+def save_packed(path, chain_type, seqs):
+    encoded = [seq.encode() for seq in seqs]
+    offsets = np.concatenate([[0], np.cumsum([len(seq) for seq in encoded], dtype=np.int64)])
+    with open(os.path.join(path, f'{chain_type}.seqs'), 'wb') as f:
+        f.write(b''.join(encoded))
+    np.save(os.path.join(path, f'{chain_type}.offsets.npy'), offsets)
+
+
+def build_t20_db(seqs, path, chain_type=None, workers=1):
+    """
+    Save deduplicated sequences as a compiled T20Database, split by chain type and sorted by length
+
+    :param seqs: list of sequences
+    :param path: output directory path
+    :param chain_type: chain type of all sequences, determined using ANARCI for each sequence if None
+    :param workers: number of processes used to determine chain types
+    :return: T20Database
+    """
+    unique_seqs = list(dict.fromkeys(seqs))
+    print(f'Found {len(unique_seqs)} unique of {len(seqs)} sequences')
+    if chain_type:
+        chain_types = [chain_type] * len(unique_seqs)
+    elif workers == 1:
+        chain_types = [get_chain_type(seq) for seq in tqdm(unique_seqs)]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            chain_types = list(tqdm(pool.imap(get_chain_type, unique_seqs, chunksize=100), total=len(unique_seqs)))
+    num_skipped = sum(t is None for t in chain_types)
+    if num_skipped:
+        print(f'Skipped {num_skipped} sequences that could not be numbered')
+
+    os.makedirs(path, exist_ok=True)
+    num_seqs = {}
+    for t in sorted(set(chain_types) - {None}):
+        # stable sort keeps input order of sequences with same length
+        chain_seqs = sorted([seq for seq, seq_type in zip(unique_seqs, chain_types) if seq_type == t], key=len)
+        save_packed(path, t, chain_seqs)
+        num_seqs[t] = len(chain_seqs)
+    with open(os.path.join(path, DB_INDEX + '.tmp'), 'w') as f:
+        json.dump({'num_seqs': num_seqs, 'num_input_seqs': len(seqs)}, f, indent=2)
+    os.replace(os.path.join(path, DB_INDEX + '.tmp'), os.path.join(path, DB_INDEX))
+    # k-mer indexes of a previous build are no longer valid
+    for name in os.listdir(path):
+        if '.kmers' in name and name.endswith('.npz'):
+            os.remove(os.path.join(path, name))
+    return T20Database(path)
+
+
+if __name__ == "__main__":
+    # Parse command line
+    parser = argparse.ArgumentParser(description='Build compiled T20 database for bin/humanness_t20_score.py --db. '
+                                                 'Sequences are deduplicated, split by chain type and sorted by length.')
+    parser.add_argument("input", help="Human sequence database, gzipped TXT file with one sequence per line.")
+    parser.add_argument("output", help="Output database directory.")
+    parser.add_argument("--chain-type", choices=CHAIN_TYPES, help="Chain type of all input sequences, skips numbering each sequence.")
+    parser.add_argument("--workers", default=1, type=int, help="Number of processes used to determine chain types.")
+    options = parser.parse_args()
+
+    start_time = time.time()
+    db = build_t20_db(read_text_db(options.input), options.output, chain_type=options.chain_type, workers=options.workers)
+    counts = ', '.join(f'{t}: {n}' for t, n in db.index['num_seqs'].items())
+    print(f'Saved {len(db)} sequences ({counts}) in {time.time() - start_time:.1f}s to: {options.output}')
@@ -6,79 +6,256 @@ from Bio import SeqIO
 import os
 import numpy as np
 from collections import OrderedDict
-import gzip
 from tqdm import tqdm
 from abnumber import Chain
 import re
-import requests
 import time
-import sys
+import heapq
+import itertools
+import multiprocessing
+from collections import defaultdict
+from bin.humanness_t20_db import T20Database, get_chain_type, read_text_db
+from bin.online_client import get_multiple_online, add_client_arguments, get_client
 
 T20_REGEX = re.compile('<td>T20 Score:</td><td>([0-9.]+)</td>')
+T20_URL = 'https://dm.lakepharma.com/cgi-bin/blast.py?chain={chain_type}&region=1&output=3&seqs={seq}'
 
-def get_t20_online(seq):
+def get_t20_url(seq, url=T20_URL):
     chain = Chain(seq, scheme='imgt')
     chain_type = 'vh' if chain.chain_type == 'H' else ('vl' if chain.chain_type == 'L' else 'vk')
-    html = None
-    for retry in range(5):
-        url = f'https://dm.lakepharma.com/cgi-bin/blast.py?chain={chain_type}&region=1&output=3&seqs={seq}'
-        try:
-            request = requests.get(url)
-            if request.ok:
-                html = request.text
-                break
-        except Exception as e:
-            print(e)
-        time.sleep(0.5 + retry * 5)
-        print('Retry', retry+1)
-    if not html:
-        sys.exit(1)
+    return url.format(chain_type=chain_type, seq=seq)
+
+def parse_t20_html(html):
     matches = T20_REGEX.findall(html)
-    time.sleep(1)
     if not matches:
         print(html)
-        raise ValueError(f'Error calling url {url}')
+        raise ValueError('T20 score not found in response')
     return float(matches[0])
 
-def get_multiple_t20_online(queries):
-    results = []
-    for query in tqdm(queries):
-        t20 = get_t20_online(query.seq)
-        results.append(OrderedDict(
-            id=query.id,
-            description=query.description,
-            t20=t20
-        ))
-    return pd.DataFrame(results)
+def get_multiple_t20_online(queries, output=None, url=T20_URL, client=None):
+    """
+    Get T20 scores from the online service, saving each score to output as soon as it is received (see get_multiple_online)
+    """
+    return get_multiple_online(queries, lambda seq: get_t20_url(seq, url), parse_t20_html, 't20', output=output, client=client)
 
-def get_multiple_t20_custom_db(queries, targets, num=20):
+# Number of database sequences aligned to one query in one task
+DEFAULT_CHUNK_SIZE = 5000
+
+_worker_context = {}
+
+def _init_worker(query_seqs, targets):
+    _worker_context['query_seqs'] = query_seqs
+    _worker_context['targets'] = targets
+    _worker_context['aligners'] = {}
+
+def get_aligner(query_seq):
     from skbio.alignment import StripedSmithWaterman
     from skbio.alignment._pairwise import blosum50
+    return StripedSmithWaterman(
+        query_seq,
+        protein=True,
+        substitution_matrix=blosum50
+    )
+
+def get_alignment_identity(alignment):
+    """
+    Get number of identical aligned residues divided by query length
+    """
+    aligned_query = np.frombuffer(alignment.aligned_query_sequence.encode(), dtype=np.uint8)
+    aligned_target = np.frombuffer(alignment.aligned_target_sequence.encode(), dtype=np.uint8)
+    length = min(len(aligned_query), len(aligned_target))
+    return int((aligned_query[:length] == aligned_target[:length]).sum()) / len(alignment.query_sequence)
+
+def align_target_chunk(task):
+    """
+    Align query with a chunk of database sequences (range or ascending array of indexes), keeping num best identities in a min-heap
+
+    :return: tuple of (query index, list of num best identities,
+    tuple of (identity, target index, aligned query, aligned target) of the last target with the best identity)
+    """
+    query_idx, target_idxs, num = task
+    aligners = _worker_context['aligners']
+    if query_idx not in aligners:
+        # keep only the aligner of the current query, tasks are ordered by query
+        aligners.clear()
+        aligners[query_idx] = get_aligner(_worker_context['query_seqs'][query_idx])
+    aligner = aligners[query_idx]
+    targets = _worker_context['targets']
+    best_identities = []
+    best = None
+    for i in target_idxs:
+        alignment = aligner(targets[i])
+        identity = get_alignment_identity(alignment)
+        if len(best_identities) < num:
+            heapq.heappush(best_identities, identity)
+        elif identity > best_identities[0]:
+            heapq.heapreplace(best_identities, identity)
+        if best is None or identity >= best[0]:
+            best = (identity, i, alignment.aligned_query_sequence, alignment.aligned_target_sequence)
+    return query_idx, best_identities, best
+
+def merge_target_chunks(chunk_results, num):
+    """
+    Merge results of align_target_chunk for one query, same as aligning all targets one by one
+
+    :return: tuple of (num best identities sorted from worst to best, best hit tuple)
+    """
+    best_identities = sorted(heapq.nlargest(num, itertools.chain.from_iterable(identities for identities, best in chunk_results)))
+    # later targets win ties, same as when aligning one by one
+    best = max((best for identities, best in chunk_results if best is not None), key=lambda best: (best[0], best[1]))
+    return best_identities, best
+
+# Residues are encoded using 5 bits, other characters share the last code
+KMER_ALPHABET = 'ACDEFGHIKLMNPQRSTVWY'
+DEFAULT_KMER_SIZE = 4
+# k-mer codes use 5 bits per residue and need to fit in int64
+MAX_KMER_SIZE = 12
+
+def encode_kmers(seqs, k):
+    """
+    Encode k-mers of all sequences as integers
+
+    :return: tuple of (k-mer codes, index of sequence of each k-mer)
+    """
+    if not 1 <= k <= MAX_KMER_SIZE:
+        raise ValueError(f'K-mer size needs to be between 1 and {MAX_KMER_SIZE}, got: {k}')
+    lookup = np.full(256, 31, dtype=np.int64)
+    for code, aa in enumerate(KMER_ALPHABET):
+        lookup[ord(aa)] = code
+        lookup[ord(aa.lower())] = code
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    residues = lookup[np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)]
+    seq_idxs = np.repeat(np.arange(len(seqs)), lengths)
+    num_kmers = max(len(residues) - k + 1, 0)
+    codes = np.zeros(num_kmers, dtype=np.int64)
+    for j in range(k):
+        codes = (codes << 5) | residues[j:j + num_kmers]
+    # skip k-mers spanning two sequences
+    valid = seq_idxs[:num_kmers] == seq_idxs[k - 1:k - 1 + num_kmers]
+    return codes[valid], seq_idxs[:num_kmers][valid]
+
+class KmerIndex:
+    """
+    Inverted index from k-mers to database sequences that contain them, used to select T20 alignment candidates
+
+    Postings of each k-mer are saved in one array (CSR layout), so the index can be saved as a single .npz file.
+    """
+    def __init__(self, k, kmers, offsets, postings, num_targets):
+        self.k = k
+        self.kmers = kmers
+        self.offsets = offsets
+        self.postings = postings
+        self.num_targets = num_targets
+
+    @classmethod
+    def build(cls, targets, k=DEFAULT_KMER_SIZE):
+        codes, target_idxs = encode_kmers(targets, k)
+        # count each k-mer once per target, sorted by k-mer and target
+        order = np.lexsort((target_idxs, codes))
+        codes, target_idxs = codes[order], target_idxs[order]
+        unique = np.ones(len(codes), dtype=bool)
+        unique[1:] = (codes[1:] != codes[:-1]) | (target_idxs[1:] != target_idxs[:-1])
+        codes, target_idxs = codes[unique], target_idxs[unique]
+        kmers, starts = np.unique(codes, return_index=True)
+        offsets = np.append(starts, len(codes))
+        return cls(k, kmers, offsets, target_idxs.astype(np.int32), len(targets))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(int(data['k']), data['kmers'], data['offsets'], data['postings'], int(data['num_targets']))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, k=self.k, kmers=self.kmers, offsets=self.offsets, postings=self.postings, num_targets=self.num_targets)
+
+    def count_shared_kmers(self, seq):
+        """
+        Get number of distinct k-mers of seq found in each database sequence
+        """
+        codes = np.unique(encode_kmers([seq], self.k)[0])
+        positions = np.minimum(np.searchsorted(self.kmers, codes), len(self.kmers) - 1)
+        positions = positions[self.kmers[positions] == codes]
+        postings = [self.postings[self.offsets[p]:self.offsets[p + 1]] for p in positions.tolist()]
+        if not postings:
+            return np.zeros(self.num_targets, dtype=np.int64)
+        return np.bincount(np.concatenate(postings), minlength=self.num_targets)
+
+    def select_candidates(self, seq, num_candidates):
+        """
+        Get ascending indexes of num_candidates database sequences sharing most k-mers with seq
+        """
+        counts = self.count_shared_kmers(seq)
+        if num_candidates >= len(counts):
+            return np.arange(len(counts))
+        # stable sort keeps earlier targets on ties
+        return np.sort(np.argsort(-counts, kind='stable')[:num_candidates])
+
+def get_kmer_index(targets, k=DEFAULT_KMER_SIZE, path=None):
+    """
+    Load k-mer index from path, or build it (and save it to path if provided)
+    """
+    if path and os.path.exists(path):
+        index = KmerIndex.load(path)
+        if index.k != k or index.num_targets != len(targets):
+            raise ValueError(f'K-mer index {path} was built for {index.num_targets} sequences with k={index.k}, '
+                             f'got {len(targets)} sequences with k={k}, remove it to rebuild')
+        return index
+    start_time = time.time()
+    index = KmerIndex.build(targets, k=k)
+    print(f'Built {k}-mer index of {len(targets)} sequences in {time.time() - start_time:.1f}s')
+    if path:
+        index.save(path)
+        print(f'Saved k-mer index to: {path}')
+    return index
+
+def get_multiple_t20_custom_db(queries, targets, num=20, workers=1, chunk_size=DEFAULT_CHUNK_SIZE, kmer_index=None, num_candidates=None):
+    """
+    Align each query with all database sequences, return mean identity of num closest sequences (T20 score)
+
+    Queries and chunks of database sequences are aligned in parallel using a pool of worker processes.
+    With a KmerIndex, each query is only aligned with num_candidates database sequences sharing most k-mers with it.
+    """
+    queries = list(queries)
+    query_seqs = [str(query.seq) for query in queries]
+    if kmer_index is not None:
+        assert num_candidates >= num, f'Number of prefilter candidates needs to be at least {num}'
+        tasks = []
+        for query_idx, query_seq in enumerate(query_seqs):
+            candidates = kmer_index.select_candidates(query_seq, num_candidates)
+            tasks += [(query_idx, candidates[start:start + chunk_size], num) for start in range(0, len(candidates), chunk_size)]
+    else:
+        tasks = [(query_idx, range(start, min(start + chunk_size, len(targets))), num)
+                 for query_idx in range(len(queries)) for start in range(0, len(targets), chunk_size)]
+
+    start_time = time.time()
+    if workers == 1:
+        _init_worker(query_seqs, targets)
+        pool = None
+        chunks = map(align_target_chunk, tasks)
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(query_seqs, targets))
+        chunks = pool.imap_unordered(align_target_chunk, tasks)
+    chunk_results = defaultdict(list)
+    try:
+        for query_idx, identities, best in tqdm(chunks, total=len(tasks)):
+            chunk_results[query_idx].append((identities, best))
+    except BaseException:
+        # stop remaining tasks, e.g. on Ctrl+C
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start_time
+    num_aligned = sum(len(target_idxs) for _, target_idxs, _ in tasks)
+    print(f'Aligned {len(queries)} queries to {num_aligned / max(len(queries), 1):.0f} of {len(targets)} sequences on average '
+          f'in {elapsed:.1f}s ({num_aligned / max(elapsed, 1e-9):.0f} sequences/sec)')
+
     results = []
-    for query in tqdm(queries):
-        aligner = StripedSmithWaterman(
-            str(query.seq), 
-            protein=True,
-            substitution_matrix=blosum50
-        )
-        best_identities = []
-        best_aligned_query = None
-        best_aligned_target = None
-        
-        for target in targets:
-            alignment = aligner(target)
-            query_length = len(alignment.query_sequence)
-            identity = sum([a == b for a, b in zip(alignment.aligned_query_sequence, alignment.aligned_target_sequence)]) / query_length
-            if len(best_identities) < num:
-                best_identities.append(identity)
-                best_identities = sorted(best_identities)
-            elif identity > best_identities[0]:
-                best_identities = best_identities[1:] + [identity]
-                best_identities = sorted(best_identities)
-            
-            if identity == best_identities[-1]:
-                best_aligned_query = alignment.aligned_query_sequence
-                best_aligned_target = alignment.aligned_target_sequence
+    for query_idx, query in enumerate(queries):
+        best_identities, (_, _, best_aligned_query, best_aligned_target) = merge_target_chunks(chunk_results[query_idx], num)
         result = OrderedDict(
             query_seq=best_aligned_query,
             id=query.id,
@@ -89,31 +266,115 @@ def get_multiple_t20_custom_db(queries, targets, num=20):
         result[f'T{num}'] = np.mean(best_identities)
         results.append(result)
     return pd.DataFrame(results)
-    
+
+def benchmark_prefilter(queries, targets, kmer_index, num_candidates, num=20, **kwargs):
+    """
+    Compare prefiltered T20 scores with exhaustive T20 scores of the same queries
+
+    :return: DataFrame with exhaustive and prefiltered T{num} score and best identity of each query
+    """
+    queries = list(queries)
+    col = f'T{num}'
+    start_time = time.time()
+    exhaustive = get_multiple_t20_custom_db(queries, targets, num=num, **kwargs)
+    exhaustive_time = time.time() - start_time
+    start_time = time.time()
+    prefiltered = get_multiple_t20_custom_db(queries, targets, num=num, kmer_index=kmer_index, num_candidates=num_candidates, **kwargs)
+    prefiltered_time = time.time() - start_time
+
+    comparison = pd.DataFrame(OrderedDict(
+        id=exhaustive['id'],
+        description=exhaustive['description'],
+        exhaustive=exhaustive[col],
+        prefiltered=prefiltered[col],
+        exhaustive_best_identity=exhaustive['best_identity'],
+        prefiltered_best_identity=prefiltered['best_identity']
+    ))
+    comparison['diff'] = comparison['prefiltered'] - comparison['exhaustive']
+    # compare with tolerance for float rounding of the mean
+    changed = ~np.isclose(comparison['exhaustive'], comparison['prefiltered'], rtol=0, atol=1e-9)
+    best_changed = ~np.isclose(comparison['exhaustive_best_identity'], comparison['prefiltered_best_identity'], rtol=0, atol=1e-9)
+    print(f'Prefilter with {num_candidates} candidates ({kmer_index.k}-mers): {col} differs for {changed.sum()} of {len(comparison)} queries '
+          f'({changed.mean():.2%}), best identity differs for {best_changed.sum()} queries, '
+          f'max {col} difference {comparison["diff"].abs().max():.4f}, '
+          f'speedup {exhaustive_time / max(prefiltered_time, 1e-9):.1f}x ({exhaustive_time:.1f}s vs {prefiltered_time:.1f}s)')
+    return comparison
+
+def get_multiple_t20_compiled_db(queries, db, num=20, num_candidates=None, kmer_size=DEFAULT_KMER_SIZE, benchmark=False, **kwargs):
+    """
+    Get T20 scores using a compiled T20Database, each query is only aligned with database sequences of the same chain type
+
+    With num_candidates, k-mer indexes are saved in the database directory the first time they are used.
+    """
+    queries = list(queries)
+    chain_types = [get_chain_type(str(query.seq)) for query in queries]
+    tables = []
+    for chain_type in dict.fromkeys(chain_types):
+        if chain_type is None:
+            raise ValueError('Some queries could not be numbered: ' + ', '.join(q.id for q, t in zip(queries, chain_types) if t is None))
+        if not db.index['num_seqs'].get(chain_type):
+            raise ValueError(f'No {chain_type} chain sequences in database: {db.path}')
+        idxs = [i for i, t in enumerate(chain_types) if t == chain_type]
+        targets = db.get_targets(chain_type)
+        print(f'Scoring {len(idxs)} {chain_type} chain queries using {len(targets)} database sequences')
+        kmer_index = get_kmer_index(targets, k=kmer_size, path=db.get_kmer_index_path(chain_type, kmer_size)) if num_candidates else None
+        group = [queries[i] for i in idxs]
+        if benchmark:
+            table = benchmark_prefilter(group, targets, kmer_index, num_candidates, num=num, **kwargs)
+        else:
+            table = get_multiple_t20_custom_db(group, targets, num=num, kmer_index=kmer_index, num_candidates=num_candidates, **kwargs)
+        tables.append(table.set_index(pd.Index(idxs)))
+    return pd.concat(tables).sort_index().reset_index(drop=True)
+
 if __name__ == "__main__":
     # Parse command line
     parser = argparse.ArgumentParser()
     parser.add_argument("query", help="Query FASTA sequence file.")
     parser.add_argument("output", help="Output TSV file path.")
-    parser.add_argument("--db", help="Custom human gzipped TXT sequence database file.")
+    parser.add_argument("--db", help="Custom human database, compiled using bin/humanness_t20_db.py (recommended) or gzipped TXT sequence file.")
     parser.add_argument("-n", "--num", default=20, type=int, help="Number of closest sequences to evaluate.")
+    parser.add_argument("--workers", default=1, type=int, help="Number of worker processes used with custom --db.")
+    parser.add_argument("--chunk-size", default=DEFAULT_CHUNK_SIZE, type=int, help="Number of --db sequences aligned to one query in one task.")
+    parser.add_argument("--prefilter", type=int, help="Only align each query with N --db sequences that share most k-mers with it.")
+    parser.add_argument("--kmer-size", default=DEFAULT_KMER_SIZE, type=int, help=f"K-mer size used with --prefilter (at most {MAX_KMER_SIZE}).")
+    parser.add_argument("--kmer-index", help="K-mer index .npz file used with --prefilter and TXT --db, built and saved if it does not exist "
+                                             "(saved in the compiled --db directory automatically).")
+    parser.add_argument("--benchmark-prefilter", action='store_true', help="Run both exhaustive and --prefilter search, "
+                                                                           "save comparison of their scores to output instead.")
 
+    add_client_arguments(parser, T20_URL)
     options = parser.parse_args()
-    
+    if options.benchmark_prefilter and not options.prefilter:
+        parser.error('--benchmark-prefilter requires --prefilter')
+    if not 1 <= options.kmer_size <= MAX_KMER_SIZE:
+        parser.error(f'--kmer-size needs to be between 1 and {MAX_KMER_SIZE}')
     
     queries = SeqIO.parse(options.query, 'fasta')
     
-    if options.db:
-        with gzip.open(options.target, 'rt') as f:
-            targets = [l.strip() for l in f.readlines()]
+    if options.db and T20Database.is_database(options.db):
+        if options.kmer_index:
+            parser.error('--kmer-index can only be used with TXT --db')
+        df = get_multiple_t20_compiled_db(queries, T20Database(options.db), num=options.num, num_candidates=options.prefilter,
+                                          kmer_size=options.kmer_size, benchmark=options.benchmark_prefilter,
+                                          workers=options.workers, chunk_size=options.chunk_size)
+    elif options.db:
+        targets = read_text_db(options.db)
 
-        df = get_multiple_t20_custom_db(queries, targets, num=options.num)
+        kmer_index = get_kmer_index(targets, k=options.kmer_size, path=options.kmer_index) if options.prefilter else None
+        if options.benchmark_prefilter:
+            df = benchmark_prefilter(queries, targets, kmer_index, options.prefilter, num=options.num,
+                                     workers=options.workers, chunk_size=options.chunk_size)
+        else:
+            df = get_multiple_t20_custom_db(queries, targets, num=options.num, workers=options.workers, chunk_size=options.chunk_size,
+                                            kmer_index=kmer_index, num_candidates=options.prefilter)
     else:
+        assert not options.prefilter, 'You need to provide a custom --db to run with --prefilter'
         assert options.num == 20, 'You need to provide a custom --db to run with n != 20'
-        print('Note: The sequences will be processed through lakepharma T20 service! Sleeping for 10s, press Ctrl+C to cancel...')
-        time.sleep(10)
+        print(f'Note: The sequences will be processed through lakepharma T20 service! Sleeping for {options.wait:.0f}s, press Ctrl+C to cancel...')
+        time.sleep(options.wait)
         print('Processing...')
-        df = get_multiple_t20_online(queries)
+        # scores are saved to output as they are received, so that an interrupted run can be resumed
+        df = get_multiple_t20_online(queries, output=options.output, url=options.url, client=get_client(options))
     
     df.to_csv(options.output, sep='\t', index=False)
     print(f'Saved to: {options.output}')
@@ -9,57 +9,202 @@ from collections import OrderedDict
 from tqdm import tqdm
 from abnumber import Chain
 import re
-import requests
 import time
+from bin.online_client import get_multiple_online, add_client_arguments, get_client
+from bin.oas_store import get_v_family
+from bin.utils import AMINO_ACID_CODES, GAP_CODE, encode_chains
 
 SCORE_REGEX = re.compile('<h3>The Z-score value of the Query sequence is: (-?[0-9.]+)</h3>')
+Z_SCORE_URL = 'http://www.bioinf.org.uk/abs/shab/shab.cgi?aa_sequence={seq}&DB={chain_type}'
 
-def get_z_score_online(seq):
+def get_z_score_url(seq, url=Z_SCORE_URL):
     chain = Chain(seq, scheme='imgt')
     chain_type = 'human_heavy' if chain.chain_type == 'H' else ('human_lambda' if chain.chain_type == 'L' else 'human_kappa')
-    html = None
-    for retry in range(5):
-        url = f'http://www.bioinf.org.uk/abs/shab/shab.cgi?aa_sequence={seq}&DB={chain_type}'
-        request = requests.get(url)
-        time.sleep(0.5 + retry * 5)
-        if request.ok:
-            html = request.text
-            break
-        else:
-            print('Retry', retry+1)
-    if not html:
-        raise ValueError('Z-score server is not accessible')
+    return url.format(chain_type=chain_type, seq=seq)
+
+def parse_z_score_html(html):
     matches = SCORE_REGEX.findall(html)
     if not matches:
         print(html)
-        raise ValueError(f'Error calling url {url}')
+        raise ValueError('Z-score not found in response')
     return float(matches[0])
 
-def get_z_scores_online(queries):
-    results = []
-    for query in tqdm(queries):
-        zscore = get_z_score_online(query.seq)
-        results.append(OrderedDict(
-            id=query.id,
-            description=query.description,
-            zscore=zscore
-        ))
-    return pd.DataFrame(results)
+def get_z_scores_online(queries, output=None, url=Z_SCORE_URL, client=None):
+    """
+    Get Z-scores from the online service, saving each score to output as soon as it is received (see get_multiple_online)
+    """
+    return get_multiple_online(queries, lambda seq: get_z_score_url(seq, url), parse_z_score_html, 'zscore', output=output, client=client)
+
+# Minimum number of reference sequences in a subgroup that can be assigned to a query
+MIN_SUBGROUP_SIZE = 2
+
+def encode_residues(residues):
+    """
+    Encode 2D array of single-letter residues (gaps as '-' or empty) as 2D array of amino acid codes
+    """
+    chars = np.array([[r[0] if isinstance(r, str) and r else '-' for r in row] for row in residues], dtype='S1')
+    return AMINO_ACID_CODES[chars.view(np.uint8).reshape(chars.shape)]
+
+class LocalZScore:
+    """
+    Local Z-score of one chain type, computed from a set of human reference sequences
+
+    Humanness is the mean identity of a sequence to all reference sequences, calculated over aligned IMGT positions
+    and divided by the sequence length. Z-score compares it with mean identities of the reference sequences
+    from the same subgroup (V gene family), the subgroup of a query is the one with highest mean identity.
+
+    Mean identity to a set of sequences only depends on residue counts at each position, so references are kept
+    as one (positions x residues) count matrix for each subgroup and queries are scored using array lookups.
+    """
+    def __init__(self, positions, codes, lengths, subgroups):
+        self.positions = list(positions)
+        self.position_index = {pos: i for i, pos in enumerate(self.positions)}
+        self.subgroups = sorted(set(subgroups))
+        subgroup_idx = np.array([self.subgroups.index(s) for s in subgroups])
+        num_refs, num_positions = codes.shape
+        # residue counts of each subgroup, gap column stays zero
+        self.counts = np.zeros((len(self.subgroups), num_positions, GAP_CODE + 1))
+        np.add.at(self.counts, (subgroup_idx[:, None], np.arange(num_positions)[None, :], codes), 1)
+        self.counts[:, :, GAP_CODE] = 0
+        self.subgroup_sizes = np.bincount(subgroup_idx, minlength=len(self.subgroups))
+        self.total_counts = self.counts.sum(axis=0)
+
+        # mean identity of each reference to all other references, excluding matches with itself
+        matches = self.total_counts[np.arange(num_positions)[None, :], codes].sum(axis=1) - (codes != GAP_CODE).sum(axis=1)
+        ref_identity = matches / max(num_refs - 1, 1) / np.maximum(lengths, 1)
+        self.means = np.array([ref_identity[subgroup_idx == i].mean() for i in range(len(self.subgroups))])
+        self.stds = np.array([ref_identity[subgroup_idx == i].std() for i in range(len(self.subgroups))])
+        # queries are not assigned to subgroups without a distribution of identities
+        self.assignable = (self.subgroup_sizes >= MIN_SUBGROUP_SIZE) & (self.stds > 0)
+        if not self.assignable.any():
+            raise ValueError(f'No subgroup with at least {MIN_SUBGROUP_SIZE} reference sequences with different identities, '
+                             f'got {num_refs} reference sequences in {len(self.subgroups)} subgroups')
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Create from ANARCI CSV table of reference sequences, subgroup is taken from v_gene or Id (e.g. IMGT germline names)
+        """
+        positions = [column for column in table.columns if column[0].isnumeric()]
+        residues = table[positions].fillna('-').values
+        lengths = (residues != '-').sum(axis=1)
+        names = table['v_gene'].where(table['v_gene'].notnull() & (table['v_gene'] != ''), table.index.to_series()) \
+            if 'v_gene' in table.columns else table.index.to_series()
+        return cls(positions, encode_residues(residues), lengths, [get_v_family(str(name)) for name in names])
+
+    def encode(self, chains):
+        """
+        Encode residues of abnumber Chains at the reference positions, return codes and sequence lengths
+        """
+        return encode_chains(chains, self.position_index), np.array([len(chain) for chain in chains])
+
+    def score(self, chains):
+        """
+        Get DataFrame with mean identity, subgroup and Z-score of each Chain
+        """
+        codes, lengths = self.encode(chains)
+        position_idx = np.arange(len(self.positions))[None, :]
+        # matches with each subgroup summed over references, shape (num_chains, num_subgroups)
+        subgroup_matches = np.stack([counts[position_idx, codes].sum(axis=1) for counts in self.counts], axis=1)
+        subgroup_identity = subgroup_matches / self.subgroup_sizes[None, :] / np.maximum(lengths, 1)[:, None]
+        identity = subgroup_matches.sum(axis=1) / self.subgroup_sizes.sum() / np.maximum(lengths, 1)
+        subgroup_idx = np.where(self.assignable[None, :], subgroup_identity, -np.inf).argmax(axis=1)
+        zscore = (identity - self.means[subgroup_idx]) / self.stds[subgroup_idx]
+        return pd.DataFrame({
+            'mean_identity': identity,
+            'subgroup': [self.subgroups[i] for i in subgroup_idx],
+            'zscore': zscore
+        })
+
+def load_local_z_score_models(paths):
+    """
+    Load human reference sequences from ANARCI CSV file(s) with chain_type column, return dict of chain type -> LocalZScore
+    """
+    table = pd.concat([pd.read_csv(path, index_col=0, dtype=str) for path in paths])
+    return {chain_type: LocalZScore.from_table(group) for chain_type, group in table.groupby('chain_type')}
+
+def get_z_scores_local(chains, models):
+    """
+    Get Z-scores using local reference sequences, in the same format as get_z_scores_online
+
+    :param chains: list of abnumber Chains with name and description (e.g. from read_query_chains)
+    :param models: dict of chain type -> LocalZScore
+    """
+    chains = list(chains)
+    chain_types = [chain.chain_type for chain in chains]
+    missing = set(chain_types) - set(models)
+    if missing:
+        raise ValueError(f'Missing reference sequences for chain types: {", ".join(sorted(missing))}')
+    scores = [None] * len(chains)
+    for chain_type, model in models.items():
+        idxs = [i for i, t in enumerate(chain_types) if t == chain_type]
+        if idxs:
+            for i, zscore in zip(idxs, model.score([chains[i] for i in idxs])['zscore']):
+                scores[i] = zscore
+    return pd.DataFrame(OrderedDict(
+        id=[chain.name for chain in chains],
+        description=[getattr(chain, 'description', chain.name) for chain in chains],
+        zscore=scores
+    ))
+
+def read_query_chains(path):
+    """
+    Read query chains from ANARCI CSV (.csv, IMGT-aligned) or FASTA file (numbered using ANARCI)
+    """
+    if path.endswith('.csv'):
+        return list(Chain.from_anarci_csv(path, scheme='imgt', as_series=True))
+    chains = []
+    for record in SeqIO.parse(path, 'fasta'):
+        chain = Chain(str(record.seq), scheme='imgt', name=record.id)
+        chain.description = record.description
+        chains.append(chain)
+    return chains
+
+def validate_z_scores(df, expected_path):
+    """
+    Compare Z-scores with archived (online) Z-scores, print correlation and differences
+    """
+    expected = pd.read_csv(expected_path, sep='\t', index_col=0)['zscore']
+    expected = expected[~expected.index.duplicated()]
+    merged = df[['id', 'zscore']].rename(columns={'zscore': 'local'}) \
+        .merge(expected.rename('expected'), left_on='id', right_index=True).dropna()
+    diff = (merged['local'] - merged['expected']).abs()
+    print(f'Validated {len(merged)} of {len(df)} Z-scores against {expected_path}: '
+          f'Pearson {merged["local"].corr(merged["expected"]):.3f}, '
+          f'Spearman {merged["local"].corr(merged["expected"], method="spearman"):.3f}, '
+          f'mean absolute difference {diff.mean():.3f}, max {diff.max():.3f}')
+    return merged
 
 if __name__ == "__main__":
     # Parse command line
     parser = argparse.ArgumentParser()
     parser.add_argument("query", help="Query FASTA sequence file.")
     parser.add_argument("output", help="Output TSV file path.")
+    parser.add_argument("--reference", nargs='+', help="Compute Z-scores locally using human reference sequences "
+                                                       "from ANARCI CSV file(s) (IMGT-aligned, with chain_type and v_gene columns). "
+                                                       "Query can also be an ANARCI CSV file.")
+    parser.add_argument("--validate", help="Compare local Z-scores with archived Z-scores in TSV file (query_id and zscore columns).")
+    add_client_arguments(parser, Z_SCORE_URL)
 
     options = parser.parse_args()
-    
-    queries = SeqIO.parse(options.query, 'fasta')
-    
-    print('Note: The sequences will be processed through UCL Z-score web service! Sleeping for 10s, press Ctrl+C to cancel...')
-    time.sleep(10)
-    print('Processing...')
-    df = get_z_scores_online(queries)
+    if options.validate and not options.reference:
+        parser.error('--validate can only be used with --reference')
+
+    if options.reference:
+        start_time = time.time()
+        models = load_local_z_score_models(options.reference)
+        df = get_z_scores_local(read_query_chains(options.query), models)
+        print(f'Scored {len(df)} sequences in {time.time() - start_time:.1f}s')
+        if options.validate:
+            validate_z_scores(df, options.validate)
+    else:
+        queries = SeqIO.parse(options.query, 'fasta')
+
+        print(f'Note: The sequences will be processed through UCL Z-score web service! Sleeping for {options.wait:.0f}s, press Ctrl+C to cancel...')
+        time.sleep(options.wait)
+        print('Processing...')
+        # scores are saved to output as they are received, so that an interrupted run can be resumed
+        df = get_z_scores_online(queries, output=options.output, url=options.url, client=get_client(options))
     
     df.to_csv(options.output, sep='\t', index=False)
     print(f'Saved to: {options.output}')
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import numpy as np
+import argparse
+from abnumber import Chain
+from bin.oas_units import read_unit
+from bin.oas_store import OASStore
+from bin.oas_hit_store import HitStore
+from bin import oas_search, cdr_search_imgt_oas, global_search_imgt_oas
+
+# Hit ranking criteria: total identity (global_search_imgt_oas.py),
+# CDR identity first and framework identity first (cdr_search_imgt_oas.py without and with --framework-first)
+CRITERIA = ['global', 'cdr', 'framework']
+
+
+def create_results(queries, criteria, top_k=1):
+    """
+    Create empty TopHits of all queries for each criterion
+    """
+    return {
+        criterion: global_search_imgt_oas.create_results(queries, top_k=top_k) if criterion == 'global'
+        else cdr_search_imgt_oas.create_results(queries, top_k=top_k, framework_first=criterion == 'framework')
+        for criterion in criteria
+    }
+
+
+def search_encoded_unit(engine, unit, results, same_length=False):
+    """
+    Compare queries with all sequences of an EncodedUnit, saving improvements to each criterion's TopHits in place
+
+    Matches in each region are counted once and used for all criteria, producing the same results
+    as global_search_imgt_oas.py and cdr_search_imgt_oas.py (with or without --framework-first).
+    """
+    check_cdr_positions = same_length and 'cdr' in results
+    for offset, region_matches, valid, same_cdr in engine.iterate_region_matches_with_cdr_check(unit, same_length=same_length, check_cdr_positions=check_cdr_positions):
+        num_cdr_matches = oas_search.get_cdr_matches(region_matches)
+        num_fw_matches = oas_search.get_fw_matches(region_matches)
+        unit_hits = {}
+        for criterion, criterion_results in results.items():
+            if criterion == 'global':
+                keys = num_cdr_matches + num_fw_matches
+            elif criterion == 'cdr':
+                keys = num_cdr_matches * oas_search.KEY_BASE + num_fw_matches
+            else:
+                keys = num_fw_matches * oas_search.KEY_BASE + num_cdr_matches
+            criterion_valid = valid & same_cdr if criterion == 'cdr' and same_cdr is not None else valid
+            keys = np.where(criterion_valid, keys, -1)
+            thresholds = np.array([criterion_results.get_threshold_key(name) for name in engine.names])
+            for q, rows in oas_search.select_candidates(keys, thresholds, criterion_results.k):
+                for i in rows:
+                    if i not in unit_hits:
+                        unit_hits[i] = oas_search.get_unit_hit(unit, offset + i)
+                    if criterion == 'global':
+                        matches = {'num_matches': int(keys[i, q])}
+                    else:
+                        matches = {'num_cdr_matches': int(num_cdr_matches[i, q]), 'num_fw_matches': int(num_fw_matches[i, q])}
+                    # save improvement
+                    criterion_results.add(engine.names[q], {**matches, **unit_hits[i]}, key=keys[i, q])
+
+
+def search_units(queries, paths, criteria=CRITERIA, limit=None, same_length=False, top_k=1, block_size=oas_search.DEFAULT_BLOCK_SIZE, results=None, checkpoint=None):
+    """
+    Search for best hits of each query by each criterion in a single pass over given OAS data units
+
+    :return: dict of criterion -> TopHits, updated in place if existing 'results' are provided
+    """
+    if results is None:
+        results = create_results(queries, criteria, top_k=top_k)
+    engine = oas_search.RegionMatchEngine(queries, block_size=block_size)
+    for json_path in paths:
+        if checkpoint is not None and checkpoint.is_done(json_path, engine.names):
+            continue
+        unit = read_unit(json_path, limit=limit)
+        search_encoded_unit(engine, unit, results, same_length=same_length)
+        if checkpoint is not None:
+            checkpoint.mark_done(json_path, engine.names)
+    return results
+
+
+def get_hits_tables(queries, results):
+    """
+    Get dict of criterion -> hits table, in the same format as the single-criterion search scripts
+    """
+    return {
+        criterion: (global_search_imgt_oas if criterion == 'global' else cdr_search_imgt_oas).get_hits_table(queries, criterion_results)
+        for criterion, criterion_results in results.items()
+    }
+
+
+def get_criterion_settings(queries, criterion, **kwargs):
+    """
+    Get search settings of given criterion, same as the settings saved by the single-criterion search scripts
+    """
+    kwargs = {key: value for key, value in kwargs.items() if key != 'criteria'}
+    if criterion != 'global':
+        kwargs['framework_first'] = criterion == 'framework'
+    return oas_search.get_search_settings(queries, **kwargs)
+
+
+def search_unit_to_csv(path, output_paths, queries, criteria=CRITERIA, **kwargs):
+    """
+    Search single OAS data unit and save hits of each criterion to its CSV, return list of hits tables
+    """
+    results = search_units(queries, [path], criteria=criteria, **kwargs)
+    tables = get_hits_tables(queries, results)
+    for criterion, output_path in zip(criteria, output_paths):
+        oas_search.save_csv(tables[criterion], output_path)
+    return [tables[criterion] for criterion in criteria]
+
+
+if __name__ == "__main__":
+    # Parse command line
+    parser = argparse.ArgumentParser(description='Search OAS by total identity, CDR identity first and framework identity first in a single pass. '
+                                                 'Only criteria with an output are evaluated.')
+    parser.add_argument("targets", nargs='*', help="Target OAS data-unit (gzipped) JSON file path(s) or encoded unit(s) created using bin/oas_units.py.")
+    parser.add_argument("--query", required=True, help="Input query sequences as ANARCI CSV (IMGT-aligned) file path.")
+    parser.add_argument("--store", help="Target OAS store created using bin/oas_store.py, instead of data units.")
+    parser.add_argument("--v-family", nargs='+', help="Only search --store targets from given V gene families (e.g. IGHV3).")
+    for criterion in CRITERIA:
+        parser.add_argument(f"--{criterion}-output", help=f"Output CSV file path with hits by {criterion} criterion (output directory with --manifest).")
+        parser.add_argument(f"--{criterion}-hit-store", help=f"Also append hits by {criterion} criterion of each data unit from --manifest to this hit store.")
+    parser.add_argument("--manifest", help="Text file with one target data-unit path per line, to be searched separately (outputs are directories).")
+    parser.add_argument("--workers", type=int, default=1, help="Number of data units from --manifest to search in parallel.")
+    parser.add_argument("--resume", action='store_true', help="Skip data units from --manifest that already have a CSV file in all output directories.")
+    parser.add_argument("--checkpoint", help="Pickle file for saving best hits and searched data units at intervals. "
+                                             "If it exists, its hits are kept and its data units are skipped (resume or add new data units).")
+    parser.add_argument("--checkpoint-interval", type=int, default=oas_search.DEFAULT_CHECKPOINT_INTERVAL, help="Minimum number of seconds between saving two checkpoints.")
+    parser.add_argument("--limit", type=int, help="Check only first N rows in each JSON file.")
+    parser.add_argument("--same-length", action='store_true', help="Only consider pairs with same sequence length (and same CDR positions for cdr criterion).")
+    parser.add_argument("--top-k", type=int, default=1, help="Number of best hits to save for each query.")
+    parser.add_argument("--block-size", type=int, default=oas_search.DEFAULT_BLOCK_SIZE, help="Number of target sequences compared with all queries at once.")
+    options = parser.parse_args()
+
+    outputs = {criterion: getattr(options, f'{criterion}_output') for criterion in CRITERIA if getattr(options, f'{criterion}_output')}
+    if not outputs:
+        parser.error('Provide at least one of: ' + ', '.join(f'--{criterion}-output' for criterion in CRITERIA))
+    if options.top_k < 1:
+        parser.error('--top-k needs to be at least 1')
+    if options.manifest:
+        if options.targets or options.store or options.checkpoint:
+            parser.error('Use --manifest without targets, --store or --checkpoint')
+    else:
+        if bool(options.targets) == bool(options.store):
+            parser.error('Provide either targets, --store or --manifest')
+        if options.workers != 1 or options.resume:
+            parser.error('--workers and --resume can only be used with --manifest')
+    if options.v_family and not options.store:
+        parser.error('--v-family can only be used with --store')
+    hit_stores = {criterion: getattr(options, f'{criterion}_hit_store') for criterion in CRITERIA if getattr(options, f'{criterion}_hit_store')}
+    if hit_stores and not options.manifest:
+        parser.error('Hit stores can only be used with --manifest')
+    if set(hit_stores) - set(outputs):
+        parser.error('Hit stores can only be used for criteria with an output')
+
+    queries = Chain.from_anarci_csv(options.query, scheme='imgt', as_series=True)
+    criteria = list(outputs)
+    search_kwargs = dict(
+        criteria=criteria,
+        limit=options.limit,
+        same_length=options.same_length,
+        top_k=options.top_k,
+        block_size=options.block_size
+    )
+
+    if options.manifest:
+        paths = oas_search.read_manifest(options.manifest)
+        settings = [get_criterion_settings(queries, criterion, **search_kwargs) for criterion in criteria]
+        print(f'Searching {len(queries)} antibodies by {", ".join(criteria)} in {len(paths)} data units using {options.workers} workers...')
+        oas_search.search_units_parallel(search_unit_to_csv, paths, list(outputs.values()), workers=options.workers,
+                                         resume=options.resume, settings=settings, queries=queries,
+                                         hit_store=[HitStore(hit_stores[criterion]) if criterion in hit_stores else None for criterion in criteria],
+                                         **search_kwargs)
+    else:
+        results = create_results(queries, criteria, top_k=options.top_k)
+        checkpoint = None
+        if options.checkpoint:
+            settings = oas_search.get_search_settings(queries, **search_kwargs)
+            checkpoint = oas_search.SearchCheckpoint(options.checkpoint, results, settings, interval=options.checkpoint_interval)
+            print(f'Skipping {len(checkpoint)} data units that were already searched according to: {options.checkpoint}')
+        if options.store:
+            print(f'Searching {len(queries)} antibodies by {", ".join(criteria)} in store: {options.store}')
+            store = OASStore(options.store)
+            oas_search.search_store(search_units, queries, store, results, same_cdr_lengths=options.same_length and criteria == ['cdr'],
+                                    v_families=options.v_family, checkpoint=checkpoint, **search_kwargs)
+        else:
+            print(f'Searching {len(queries)} antibodies by {", ".join(criteria)} in {len(options.targets)} data units...')
+            search_units(queries, options.targets, results=results, checkpoint=checkpoint, **search_kwargs)
+        if checkpoint is not None:
+            checkpoint.save()
+        for criterion, table in get_hits_tables(queries, results).items():
+            table.to_csv(outputs[criterion])
+            print(f'Saved {len(table)} {criterion} hits to: {outputs[criterion]}')
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import argparse
+import fcntl
+import os
+from contextlib import contextmanager
+import subprocess
+import tempfile
+import numpy as np
+import pandas as pd
+from bin.utils import iterate_fasta, read_netMHCIIpan_alleles
+
+PEPTIDE_LENGTH = 9
+DEFAULT_ALLELES = ['DRB1_0101', 'DRB1_0301', 'DRB1_0401', 'DRB1_0701', 'DRB1_0801', 'DRB1_1101', 'DRB1_1301', 'DRB1_1501']
+# Values predicted for each peptide and allele, in netMHCIIpan xls column order
+VALUE_COLUMNS = ['1-log50k', 'nM', 'Rank']
+# Rank threshold of weak binders counted in the NB column (netMHCIIpan default)
+NB_RANK = 10
+DEFAULT_BATCH_SIZE = 100000
+LOCK_SUFFIX = '.lock'
+
+
+def read_netMHCIIpan_xls(path):
+    """
+    Read netMHCIIpan xls table as long table with Peptide, Allele, 1-log50k, nM and Rank columns
+    """
+    with open(path, 'rt') as f:
+        alleles = read_netMHCIIpan_alleles(f)
+        names = ['Pos', 'Peptide', 'ID'] + [f'{allele}.{column}' for allele in alleles for column in VALUE_COLUMNS]
+        table = pd.read_csv(f, sep='\t', header=None, usecols=range(len(names)), names=names, dtype={'Peptide': str, 'ID': str})
+    return pd.concat([
+        table[['Peptide'] + [f'{allele}.{column}' for column in VALUE_COLUMNS]]
+            .set_axis(['Peptide'] + VALUE_COLUMNS, axis=1)
+            .assign(Allele=allele)
+        for allele in alleles
+    ], ignore_index=True)[['Peptide', 'Allele'] + VALUE_COLUMNS]
+
+
+class NetMHCIIpanPredictor:
+    """
+    Run netMHCIIpan on a list of peptides, any callable with the same signature can be used instead (e.g. in tests)
+    """
+    def __init__(self, executable='netMHCIIpan'):
+        self.executable = executable
+
+    def __call__(self, peptides, alleles):
+        """
+        :return: long table with Peptide, Allele, 1-log50k, nM and Rank of each peptide and allele
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = os.path.join(tmp_dir, 'peptides.txt')
+            output_path = os.path.join(tmp_dir, 'predictions.xls')
+            with open(input_path, 'w') as f:
+                f.write(''.join(f'{peptide}\n' for peptide in peptides))
+            subprocess.run([self.executable, '-inptype', '1', '-f', input_path, '-a', ','.join(alleles),
+                            '-xls', '-xlsfile', output_path], check=True, stdout=subprocess.DEVNULL)
+            return read_netMHCIIpan_xls(output_path)
+
+
+class PeptideRankCache:
+    """
+    Persistent cache of netMHCIIpan predictions of each peptide and allele
+
+    Saved as a TSV file with Peptide, Allele, 1-log50k, nM and Rank columns, new predictions are appended.
+    The file can be shared by parallel processes (e.g. make -j), reading and appending is done under a file lock.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.values = {}
+        if path:
+            with self._lock(fcntl.LOCK_SH):
+                if os.path.exists(path) and os.path.getsize(path):
+                    self._add(pd.read_csv(path, sep='\t', dtype={'Peptide': str, 'Allele': str}))
+
+    @contextmanager
+    def _lock(self, operation):
+        with open(self.path + LOCK_SUFFIX, 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _add(self, table):
+        for allele, allele_table in table.groupby('Allele', sort=False):
+            values = self.values.setdefault(allele, {})
+            values.update(zip(allele_table['Peptide'], allele_table[VALUE_COLUMNS].values.tolist()))
+
+    def __len__(self):
+        return sum(len(values) for values in self.values.values())
+
+    def get_missing(self, peptides, alleles):
+        """
+        Get peptides without a cached prediction for at least one allele, grouped by their missing alleles
+
+        :return: dict of tuple of missing alleles -> list of peptides
+        """
+        missing = {}
+        for peptide in peptides:
+            missing_alleles = tuple(allele for allele in alleles if peptide not in self.values.get(allele, {}))
+            if missing_alleles:
+                missing.setdefault(missing_alleles, []).append(peptide)
+        return missing
+
+    def add(self, table):
+        """
+        Add long table of predictions and append them to the cache file
+        """
+        self._add(table)
+        if self.path:
+            with self._lock(fcntl.LOCK_EX):
+                exists = os.path.exists(self.path) and os.path.getsize(self.path)
+                table[['Peptide', 'Allele'] + VALUE_COLUMNS].to_csv(self.path, sep='\t', index=False, mode='a', header=not exists)
+
+    def get(self, peptides, allele):
+        """
+        Get (peptides x 1-log50k, nM, Rank) array of one allele
+        """
+        values = self.values[allele]
+        return np.array([values[peptide] for peptide in peptides], dtype=np.float64).reshape(-1, len(VALUE_COLUMNS))
+
+
+def get_peptides(records, length=PEPTIDE_LENGTH):
+    """
+    Get table with Pos (0-based), Peptide and ID of each peptide of each sequence
+    """
+    rows = [(pos, str(record.seq)[pos:pos + length], record.id)
+            for record in records for pos in range(len(record.seq) - length + 1)]
+    return pd.DataFrame(rows, columns=['Pos', 'Peptide', 'ID'])
+
+
+def predict_netMHCIIpan_cached(records, cache, alleles=DEFAULT_ALLELES, predictor=None, length=PEPTIDE_LENGTH, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Get netMHCIIpan predictions of all peptides of given sequences, only predicting unique peptides and alleles missing in the cache
+
+    :param records: sequence records (Bio.SeqRecord)
+    :param cache: PeptideRankCache, updated with new predictions after each batch
+    :param predictor: callable(peptides, alleles) returning long prediction table, NetMHCIIpanPredictor if None
+    :param batch_size: number of peptides predicted at once
+    :return: table with same columns as netMHCIIpan xls output (Pos, Peptide, ID, values of each allele, Ave, NB)
+    """
+    predictor = predictor or NetMHCIIpanPredictor()
+    table = get_peptides(records, length=length)
+    codes, unique_peptides = pd.factorize(table['Peptide'])
+    missing = cache.get_missing(unique_peptides, alleles)
+    num_missing = sum(len(peptides) for peptides in missing.values())
+    print(f'Found {len(unique_peptides)} unique of {len(table)} peptides, predicting {num_missing} peptides missing in cache')
+    # only predict alleles missing in the cache, peptides missing the same alleles are predicted together
+    for missing_alleles, peptides in missing.items():
+        for start in range(0, len(peptides), batch_size):
+            cache.add(predictor(peptides[start:start + batch_size], list(missing_alleles)))
+
+    log50k = []
+    ranks = []
+    for allele in alleles:
+        # fan out unique peptide predictions to each sequence and position
+        values = cache.get(unique_peptides, allele)[codes]
+        for i, column in enumerate(VALUE_COLUMNS):
+            table[f'{allele}.{column}'] = values[:, i]
+        log50k.append(values[:, 0])
+        ranks.append(values[:, 2])
+    table['Ave'] = np.mean(log50k, axis=0)
+    table['NB'] = (np.array(ranks) <= NB_RANK).sum(axis=0)
+    return table
+
+
+def save_netMHCIIpan_xls(table, alleles, path):
+    """
+    Save predictions in netMHCIIpan xls format, readable by bin.utils.parse_netMHCIIpan_table
+    """
+    with open(path, 'w') as f:
+        f.write('\t\t\t' + '\t\t\t'.join(alleles) + '\t\t\n')
+        f.write('\t'.join(['Pos', 'Peptide', 'ID'] + VALUE_COLUMNS * len(alleles) + ['Ave', 'NB']) + '\n')
+        table.to_csv(f, sep='\t', index=False, header=False)
+
+
+if __name__ == "__main__":
+    # Parse command line
+    parser = argparse.ArgumentParser(description='Run netMHCIIpan on unique peptides of FASTA sequences, reusing cached predictions. '
+                                                 'Output has the same format as netMHCIIpan -xls.')
+    parser.add_argument("input", nargs='+', help="Input FASTA file path(s).")
+    parser.add_argument("output", help="Output xls (TSV) file path.")
+    parser.add_argument("--cache", required=True, help="Peptide prediction cache TSV file path, created if it does not exist.")
+    parser.add_argument("--alleles", default=','.join(DEFAULT_ALLELES), help="Comma-separated list of alleles.")
+    parser.add_argument("--length", default=PEPTIDE_LENGTH, type=int, help="Peptide length.")
+    parser.add_argument("--executable", default='netMHCIIpan', help="netMHCIIpan executable.")
+    parser.add_argument("--batch-size", default=DEFAULT_BATCH_SIZE, type=int, help="Number of peptides sent to netMHCIIpan at once.")
+    options = parser.parse_args()
+
+    alleles = options.alleles.split(',')
+    cache = PeptideRankCache(options.cache)
+    print(f'Loaded {len(cache)} cached predictions from: {options.cache}')
+    table = predict_netMHCIIpan_cached(
+        list(iterate_fasta(options.input)),
+        cache,
+        alleles=alleles,
+        predictor=NetMHCIIpanPredictor(options.executable),
+        length=options.length,
+        batch_size=options.batch_size
+    )
+    save_netMHCIIpan_xls(table, alleles, options.output)
+    print(f'Saved {len(table)} peptides to: {options.output}')
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+import argparse
+import fcntl
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Columns with few distinct values are stored as int32 codes with a list of categories
+CATEGORY_COLUMNS = ['query', 'unit', 'study', 'species', 'hit_chain_type']
+SCHEMA_FILE = 'schema.json'
+STATE_FILE = 'state.json'
+LOCK_FILE = 'lock'
+UNITS_FILE = 'units.txt'
+INT_DTYPE = np.dtype('<i8')
+CODE_DTYPE = np.dtype('<i4')
+
+
+class HitStore:
+    """
+    Append-only columnar store of OAS search hits, one record for each (query, data unit, hit rank)
+
+    Each column is saved as a binary file in the store directory:
+
+    - int columns (match counts, hit rank, query length): <column>.int64
+    - category columns (query, unit, study, species, chain type): <column>.codes (int32) and <column>.categories (text)
+    - text columns (hit name and sequence): <column>.offsets (int64 end offsets) and <column>.data (utf-8)
+
+    Appending is done under a file lock. New data is only visible after the committed size of each file
+    is saved in state.json, data written after the last commit (e.g. by a killed process) is truncated by the next append.
+    Data units are listed in units.txt, including units without hits, so that finished units can be skipped.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _read_json(self, name, default):
+        if not os.path.exists(self._file(name)):
+            return default
+        with open(self._file(name)) as f:
+            return json.load(f)
+
+    def _write_json(self, name, data):
+        with open(self._file(name) + '.tmp', 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._file(name) + '.tmp', self._file(name))
+
+    @property
+    def schema(self):
+        return self._read_json(SCHEMA_FILE, {})
+
+    def get_state(self):
+        return self._read_json(STATE_FILE, {'num_records': 0, 'sizes': {}})
+
+    def __len__(self):
+        return self.get_state()['num_records']
+
+    def _read_bytes(self, name, state):
+        size = state['sizes'].get(name, 0)
+        if not size:
+            return b''
+        with open(self._file(name), 'rb') as f:
+            return f.read(size)
+
+    def _read_array(self, name, dtype, state):
+        return np.frombuffer(self._read_bytes(name, state), dtype=dtype)
+
+    def _read_lines(self, name, state):
+        data = self._read_bytes(name, state).decode()
+        return data.split('\n')[:-1] if data else []
+
+    def get_units(self):
+        """
+        Get names of data units that were added to the store
+        """
+        return set(self._read_lines(UNITS_FILE, self.get_state()))
+
+    def read(self, columns=None):
+        """
+        Read committed records as a DataFrame, category columns are returned as pandas Categorical
+        """
+        state = self.get_state()
+        schema = self.schema
+        data = {}
+        for column in (columns or list(schema)):
+            kind = schema[column]
+            if kind == 'int':
+                data[column] = self._read_array(f'{column}.int64', INT_DTYPE, state)
+            elif kind == 'category':
+                codes = self._read_array(f'{column}.codes', CODE_DTYPE, state)
+                data[column] = pd.Categorical.from_codes(codes, categories=self._read_lines(f'{column}.categories', state))
+            else:
+                offsets = self._read_array(f'{column}.offsets', INT_DTYPE, state)
+                text = self._read_bytes(f'{column}.data', state)
+                starts = np.concatenate([[0], offsets[:-1]])
+                data[column] = [text[start:end].decode() for start, end in zip(starts.tolist(), offsets.tolist())]
+        return pd.DataFrame(data, index=pd.RangeIndex(state['num_records']))
+
+    def append(self, records, units):
+        """
+        Append records and mark data units as added
+
+        Data units that were already added (e.g. when resuming a search with a missing CSV file) are skipped together with their records.
+
+        :param records: DataFrame with one record per row, int columns, category columns and text columns
+        :param units: names of data units that the records come from, including units without any records
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._file(LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._append(records, units)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _append(self, records, units):
+        schema = self.schema
+        if not schema and len(records):
+            schema = {column: 'category' if column in CATEGORY_COLUMNS
+                      else 'int' if pd.api.types.is_integer_dtype(records[column]) else 'text'
+                      for column in records.columns}
+            self._write_json(SCHEMA_FILE, schema)
+        if len(records) and set(records.columns) != set(schema):
+            raise ValueError(f'Expected columns {sorted(schema)}, got {sorted(records.columns)}')
+
+        state = self.get_state()
+        added = set(self._read_lines(UNITS_FILE, state))
+        if added.intersection(units):
+            units = [unit for unit in units if unit not in added]
+            if len(records):
+                records = records[~records['unit'].astype(str).isin(added)]
+        sizes = state['sizes']
+        num_records = state['num_records'] + len(records)
+
+        def write(name, data):
+            # discard anything written after the last commit
+            with open(self._file(name), 'ab') as f:
+                f.truncate(sizes.get(name, 0))
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            sizes[name] = sizes.get(name, 0) + len(data)
+
+        if len(records):
+            for column, kind in schema.items():
+                values = records[column]
+                if kind == 'int':
+                    write(f'{column}.int64', values.to_numpy(dtype=INT_DTYPE).tobytes())
+                elif kind == 'category':
+                    categories = self._read_lines(f'{column}.categories', state)
+                    codes = {category: i for i, category in enumerate(categories)}
+                    new_categories = [value for value in dict.fromkeys(values.astype(str)) if value not in codes]
+                    for value in new_categories:
+                        if '\n' in value:
+                            raise ValueError(f'Category values cannot contain newlines: {value!r}')
+                        codes[value] = len(codes)
+                    write(f'{column}.categories', ''.join(f'{value}\n' for value in new_categories).encode())
+                    write(f'{column}.codes', np.array([codes[value] for value in values.astype(str)], dtype=CODE_DTYPE).tobytes())
+                else:
+                    encoded = [str(value).encode() for value in values]
+                    end = sizes.get(f'{column}.data', 0)
+                    offsets = end + np.cumsum([len(value) for value in encoded], dtype=INT_DTYPE)
+                    write(f'{column}.data', b''.join(encoded))
+                    write(f'{column}.offsets', offsets.astype(INT_DTYPE).tobytes())
+        write(UNITS_FILE, ''.join(f'{unit}\n' for unit in units).encode())
+
+        self._write_json(STATE_FILE, {'num_records': num_records, 'sizes': sizes})
+
+
+def get_unit_study(path):
+    """
+    Get OAS study of a data unit, the name of the directory that contains it (all/json/<study>/<unit>.json.gz)
+    """
+    return os.path.basename(os.path.dirname(os.path.abspath(path.rstrip('/'))))
+
+
+def get_hit_records(table, query_lengths, unit, study):
+    """
+    Convert hits table of a search script (one row per query and hit rank) to HitStore records
+
+    :param table: hits table as created by get_hits_table of the search scripts
+    :param query_lengths: pandas Series with sequence length of each query
+    :param unit: data unit name
+    :param study: study name
+    """
+    if table.empty:
+        return pd.DataFrame()
+    position_columns = [column for column in table.columns if column[0].isnumeric()]
+    metric_columns = [column for column in table.columns if column.startswith('num_')]
+    records = pd.DataFrame({
+        'query': table.index.astype(str),
+        'query_length': query_lengths.loc[table.index].values.astype(INT_DTYPE),
+        'unit': unit,
+        'study': study,
+        'species': table['species'].fillna('').astype(str).values,
+        'hit_rank': table['hit_rank'].values.astype(INT_DTYPE) if 'hit_rank' in table.columns else 1,
+        **{column: table[column].values.astype(INT_DTYPE) for column in metric_columns},
+        'hit_name': table['hit_name'].astype(str).values,
+        'hit_seq': table[position_columns].astype(str).agg(''.join, axis=1).str.replace('-', '', regex=False).values,
+        'hit_chain_type': table['chain_type'].astype(str).values,
+    })
+    return records
+
+
+def reduce_best_hits(stores, species=None, exclude_species=None, studies=None, exclude_studies=None, framework_first=False):
+    """
+    Find best hit of each query in one or more HitStores
+
+    Hits are ranked by num_matches for total identity stores, or by CDR matches and then framework matches
+    (framework first with framework_first). Ties are resolved in favor of the first study and unit by name
+    and then the first hit rank, so the result does not depend on the order in which units were searched.
+    Note that this differs from merging per-unit hit CSV files in units.tsv order in the processing notebooks,
+    where the last unit wins ties of total identity hits and the first unit wins ties of CDR hits.
+
+    :param stores: list of HitStore objects
+    :param species: only consider hits from these species
+    :param exclude_species: ignore hits from these species
+    :param studies: only consider hits from these studies
+    :param exclude_studies: ignore hits from these studies
+    :return: DataFrame indexed by query Id with columns of merged hits
+    """
+    hits = pd.concat([store.read() for store in stores if len(store)], ignore_index=True)
+    if hits.empty:
+        return pd.DataFrame(index=pd.Index([], name='Id'))
+    for column in CATEGORY_COLUMNS:
+        hits[column] = hits[column].astype(str)
+    mask = np.ones(len(hits), dtype=bool)
+    if species:
+        mask &= hits['species'].isin(species).values
+    if exclude_species:
+        mask &= ~hits['species'].isin(exclude_species).values
+    if studies:
+        mask &= hits['study'].isin(studies).values
+    if exclude_studies:
+        mask &= ~hits['study'].isin(exclude_studies).values
+    hits = hits[mask]
+
+    if 'num_matches' in hits.columns:
+        sort_by = ['num_matches']
+        num_matches = hits['num_matches']
+    else:
+        sort_by = ['num_fw_matches', 'num_cdr_matches'] if framework_first else ['num_cdr_matches', 'num_fw_matches']
+        num_matches = hits['num_cdr_matches'] + hits['num_fw_matches']
+    hits = hits.assign(identity=num_matches / hits['query_length'])
+    best = hits.sort_values(sort_by + ['study', 'unit', 'hit_rank'], ascending=[False] * len(sort_by) + [True] * 3) \
+        .groupby('query', sort=True).head(1)
+
+    metric_columns = [column for column in hits.columns if column.startswith('num_')]
+    best = best.rename(columns={'unit': 'hit_unit', 'study': 'hit_study'}).set_index('query').sort_index()
+    best.index.name = 'Id'
+    return best[metric_columns + ['identity', 'species', 'hit_name', 'hit_seq', 'hit_unit', 'hit_study']]
+
+
+if __name__ == "__main__":
+    # Parse command line
+    parser = argparse.ArgumentParser(description='Find best hit of each query in hit stores created by OAS search scripts (--hit-store).')
+    parser.add_argument("stores", nargs='+', help="Hit store directory path(s).")
+    parser.add_argument("--output", required=True, help="Output CSV file path.")
+    parser.add_argument("--species", nargs='+', help="Only consider hits from given species.")
+    parser.add_argument("--exclude-species", nargs='+', help="Ignore hits from given species.")
+    parser.add_argument("--study", nargs='+', help="Only consider hits from given studies.")
+    parser.add_argument("--exclude-study", nargs='+', help="Ignore hits from given studies.")
+    parser.add_argument("--framework-first", action='store_true', help="Prioritize framework identity over CDR identity (for CDR search hits).")
+    options = parser.parse_args()
+
+    best_hits = reduce_best_hits(
+        [HitStore(path) for path in options.stores],
+        species=options.species,
+        exclude_species=options.exclude_species,
+        studies=options.study,
+        exclude_studies=options.exclude_study,
+        framework_first=options.framework_first
+    )
+    best_hits.to_csv(options.output)
+    print(f'Saved best hits of {len(best_hits)} queries to: {options.output}')
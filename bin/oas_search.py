@@ -0,0 +1,531 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import heapq
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+from abnumber import Position
+from bin.oas_hit_store import get_hit_records, get_unit_study
+from bin.oas_units import QUERY_MISSING_RESIDUE, MISSING_RESIDUE, REGIONS, FW_REGIONS, CDR_REGIONS, ENCODED_UNIT_SUFFIX, is_encoded_unit
+
+# Number of target sequences compared with all queries at once
+DEFAULT_BLOCK_SIZE = 4096
+# Combine two match counts into one sortable key (number of matches is always lower than this)
+KEY_BASE = 1024
+# Minimum number of seconds between saving two checkpoints
+DEFAULT_CHECKPOINT_INTERVAL = 300
+# Saved to --output-dir in manifest mode, used to check that resumed searches use the same settings
+SEARCH_SETTINGS_FILE = 'search_settings.json'
+
+
+class RegionMatchEngine:
+    """
+    Compare all query chains with blocks of target sequences from an EncodedUnit
+
+    Queries are encoded as one position-aligned matrix for each unit,
+    number of matches in each region is counted for all (target, query) pairs at once using NumPy broadcasting.
+    """
+    def __init__(self, queries, block_size=DEFAULT_BLOCK_SIZE):
+        self.queries = queries
+        self.names = list(queries.index) if hasattr(queries, 'index') else [query.name for query in queries]
+        self.lengths = np.array([len(query) for query in queries])
+        self.block_size = block_size
+
+    def iterate_matches(self, unit, same_length=False):
+        """
+        Count matching positions between each target and query (identity), in blocks of targets
+
+        Same as len(alignment) - alignment.num_mutations() of the aligned query and target chain.
+
+        :param unit: EncodedUnit with target sequences
+        :param same_length: Only consider pairs with same sequence length
+        :return: generator of (offset of first target in block, int array of targets x queries, bool array of valid targets x queries)
+        """
+        query_residues, _ = unit.encode_chains(self.queries)
+        for offset, block, valid in self._iterate_blocks(unit, same_length=same_length):
+            matches = np.zeros((len(block), len(self.names)), dtype=np.int64)
+            for col in range(block.shape[1]):
+                matches += block[:, col, np.newaxis] == query_residues[np.newaxis, :, col]
+            yield offset, matches, valid
+
+    def _iterate_blocks(self, unit, same_length=False):
+        for offset in range(0, len(unit), self.block_size):
+            block = np.asarray(unit.residues[offset:offset + self.block_size])
+            valid = np.ones((len(block), len(self.names)), dtype=bool)
+            if same_length:
+                target_lengths = (block != MISSING_RESIDUE).sum(axis=1)
+                valid &= target_lengths[:, np.newaxis] == self.lengths[np.newaxis, :]
+            yield offset, block, valid
+
+    def iterate_region_matches(self, unit, same_length=False, same_cdr_positions=False):
+        """
+        Count matches between each target and query in each region, in blocks of targets
+
+        :param unit: EncodedUnit with target sequences
+        :param same_length: Only consider pairs with same sequence length
+        :param same_cdr_positions: Only consider pairs with same exact CDR positions
+        :return: generator of (offset of first target in block, uint8 array of regions x targets x queries, bool array of valid targets x queries)
+        """
+        for offset, region_matches, valid, same_cdr in self.iterate_region_matches_with_cdr_check(unit, same_length=same_length, check_cdr_positions=same_cdr_positions):
+            if same_cdr is not None:
+                valid &= same_cdr
+            yield offset, region_matches, valid
+
+    def iterate_region_matches_with_cdr_check(self, unit, same_length=False, check_cdr_positions=False):
+        """
+        Count matches between each target and query in each region, checking CDR positions separately
+
+        Useful when results with and without the CDR position check are needed from the same pass.
+
+        :param unit: EncodedUnit with target sequences
+        :param same_length: Only consider pairs with same sequence length
+        :param check_cdr_positions: Check which pairs have the same exact CDR positions
+        :return: generator of (offset of first target in block, uint8 array of regions x targets x queries,
+        bool array of valid targets x queries, bool array of targets x queries with same CDR positions or None)
+        """
+        query_residues, query_off_axis = unit.encode_chains(self.queries)
+        region_columns = unit.get_region_columns()
+        column_regions = np.zeros(len(unit.positions), dtype=np.int64)
+        for r, region in enumerate(REGIONS):
+            column_regions[region_columns[region]] = r
+
+        if check_cdr_positions:
+            query_cdr_patterns = {}
+            for region in CDR_REGIONS:
+                r = REGIONS.index(region)
+                patterns = query_residues[:, region_columns[region]] != QUERY_MISSING_RESIDUE
+                # queries with CDR positions that are not present in the unit can never have the same positions
+                query_cdr_patterns[region] = (patterns, query_off_axis[:, r])
+
+        for offset, block, valid in self._iterate_blocks(unit, same_length=same_length):
+            region_matches = np.zeros((len(REGIONS), len(block), len(self.names)), dtype=np.uint8)
+            for col, r in enumerate(column_regions):
+                region_matches[r] += block[:, col, np.newaxis] == query_residues[np.newaxis, :, col]
+
+            same_cdr = None
+            if check_cdr_positions:
+                same_cdr = np.ones_like(valid)
+                for region in CDR_REGIONS:
+                    query_patterns, query_off_axis_region = query_cdr_patterns[region]
+                    target_patterns = block[:, region_columns[region]] != MISSING_RESIDUE
+                    same_cdr &= is_same_pattern(target_patterns, query_patterns)
+                    same_cdr &= ~query_off_axis_region[np.newaxis, :]
+
+            yield offset, region_matches, valid, same_cdr
+
+
+def is_same_pattern(target_patterns, query_patterns):
+    """
+    Compare each target bool row with each query bool row
+
+    :return: bool array of targets x queries, True where the rows are identical
+    """
+    if not target_patterns.shape[1]:
+        return np.ones((len(target_patterns), len(query_patterns)), dtype=bool)
+    combined = np.concatenate([target_patterns, query_patterns])
+    _, pattern_ids = np.unique(np.packbits(combined, axis=1), axis=0, return_inverse=True)
+    pattern_ids = pattern_ids.reshape(-1)
+    return pattern_ids[:len(target_patterns), np.newaxis] == pattern_ids[np.newaxis, len(target_patterns):]
+
+
+def sum_regions(region_matches, regions):
+    return region_matches[[REGIONS.index(region) for region in regions]].sum(axis=0, dtype=np.int64)
+
+
+def get_fw_matches(region_matches):
+    return sum_regions(region_matches, FW_REGIONS)
+
+
+def get_cdr_matches(region_matches):
+    return sum_regions(region_matches, CDR_REGIONS)
+
+
+def select_candidates(keys, thresholds, k):
+    """
+    Find targets that can enter the top K hits of each query
+
+    Only the K best targets of each query in the block are returned, same as when checking targets one by one,
+    ties are resolved in favor of later targets.
+
+    :param keys: int array of targets x queries, -1 for pairs that should not be considered
+    :param thresholds: int array with key of K-th best hit of each query found so far (or -1)
+    :param k: Number of best hits to keep for each query
+    :return: generator of (query index, sorted array of target indexes)
+    """
+    candidates = keys >= np.maximum(thresholds, 0)[np.newaxis, :]
+    for q in np.flatnonzero(candidates.any(axis=0)):
+        rows = np.flatnonzero(candidates[:, q])
+        if len(rows) > k:
+            rows = np.sort(rows[np.lexsort((rows, keys[rows, q]))[-k:]])
+        yield q, rows
+
+
+class TopHits:
+    """
+    Keep K best hits of each query using bounded min-heaps
+
+    Hits are ordered by key, ties are resolved in favor of the hit that was added later,
+    so that with K=1 this is the same as accepting each hit that is at least as good as the previous best.
+    """
+    def __init__(self, names, key, k=1):
+        """
+        :param names: query names
+        :param key: function that returns sortable int key of a hit dict
+        :param k: number of best hits to keep for each query
+        """
+        assert k >= 1, f'Expected k >= 1, got {k}'
+        self.heaps = {name: [] for name in names}
+        self.key = key
+        self.k = k
+        self.counter = itertools.count()
+
+    def get_threshold_hit(self, name):
+        """
+        Get K-th best hit of given query, or empty dict if less than K hits were found
+        """
+        heap = self.heaps[name]
+        return heap[0][2] if len(heap) == self.k else {}
+
+    def get_threshold_key(self, name):
+        """
+        Get key of K-th best hit of given query, or -1 if less than K hits were found
+        """
+        heap = self.heaps[name]
+        return heap[0][0] if len(heap) == self.k else -1
+
+    def add(self, name, hit, key=None):
+        """
+        Add hit to the top hits of given query if it is at least as good as the K-th best hit
+        """
+        entry = (self.key(hit) if key is None else key, next(self.counter), hit)
+        heap = self.heaps[name]
+        if len(heap) < self.k:
+            heapq.heappush(heap, entry)
+        elif entry[0] >= heap[0][0]:
+            heapq.heapreplace(heap, entry)
+
+    def get_ranked(self, name):
+        """
+        Get hits of given query sorted from best to worst
+        """
+        return [hit for key, order, hit in sorted(self.heaps[name], reverse=True)]
+
+    def get_state(self):
+        """
+        Get picklable state of all heaps (the key function is not included)
+        """
+        return {'heaps': self.heaps, 'k': self.k, 'counter': next(self.counter)}
+
+    def set_state(self, state):
+        assert state['k'] == self.k, f'Expected state with k={self.k}, got {state["k"]}'
+        assert state['heaps'].keys() == self.heaps.keys(), 'Expected state with the same query names'
+        self.heaps = state['heaps']
+        # hits added later need to win ties with the restored hits
+        self.counter = itertools.count(state['counter'])
+
+
+def get_search_settings(queries, **kwargs):
+    """
+    Get dict of queries and search options that need to stay the same when a search is resumed
+
+    Options that do not change the results (debug, block_size) are ignored.
+    """
+    digest = hashlib.sha1()
+    for query in queries:
+        numbering = ','.join(f'{pos}{aa}' for pos, aa in query.positions.items())
+        digest.update(f'{query.name}\t{query.chain_type}\t{numbering}\n'.encode())
+    settings = {key: value for key, value in kwargs.items() if key not in ['debug', 'block_size']}
+    return {'queries': digest.hexdigest(), **settings}
+
+
+class SearchCheckpoint:
+    """
+    Best hits of each query together with a ledger of searched data units, saved to a pickle file at intervals
+
+    When the checkpoint file already exists, its hits are restored and data units in the ledger are skipped,
+    so that an interrupted search can be resumed, or a finished search can be extended with new data units.
+    Data units are recorded together with the query names they were searched for (see search_store).
+    """
+    def __init__(self, path, results, settings, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        """
+        :param path: checkpoint pickle file path
+        :param results: TopHits (or dict of TopHits) updated by the search, restored from the checkpoint if it exists
+        :param settings: dict of search settings, see get_search_settings
+        :param interval: minimum number of seconds between saving two checkpoints
+        """
+        self.path = path
+        self.results = results
+        self.settings = settings
+        self.interval = interval
+        self.done = {}
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+            if state['settings'] != settings:
+                raise ValueError(f'Checkpoint was created with different queries or search options, '
+                                 f'remove it to start a new search: {path}')
+            # paths are saved as absolute paths, relative paths of older checkpoints are resolved from the current directory
+            self.done = {names: set(os.path.abspath(path) for path in paths) for names, paths in state['done'].items()}
+            if isinstance(results, dict):
+                for name, criterion_results in results.items():
+                    criterion_results.set_state(state['results'][name])
+            else:
+                results.set_state(state['results'])
+        self.last_saved = time.time()
+
+    def __len__(self):
+        return len(set(path for paths in self.done.values() for path in paths))
+
+    def is_done(self, path, names):
+        return os.path.abspath(path) in self.done.get(tuple(names), ())
+
+    def mark_done(self, path, names):
+        """
+        Record searched data unit, save checkpoint if the interval has passed since it was last saved
+        """
+        self.done.setdefault(tuple(names), set()).add(os.path.abspath(path))
+        if time.time() - self.last_saved >= self.interval:
+            self.save()
+
+    def save(self):
+        """
+        Save checkpoint, replacing the file only after it was fully written
+        """
+        tmp_path = self.path + '.tmp'
+        if isinstance(self.results, dict):
+            results_state = {name: criterion_results.get_state() for name, criterion_results in self.results.items()}
+        else:
+            results_state = self.results.get_state()
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'settings': self.settings, 'done': self.done, 'results': results_state}, f)
+        os.replace(tmp_path, self.path)
+        self.last_saved = time.time()
+
+
+def get_unit_hit(unit, i):
+    """
+    Get hit properties of i-th sequence of an EncodedUnit, including its original numbering
+    """
+    return {
+        'hit_name': str(unit.names[i]),
+        'hit_seq': unit.get_seq(i),
+        'hit_chain_type': str(unit.chain_types[i]),
+        'hit_species': unit.get_species(i),
+        'hit_numbering': unit.get_numbering(i)
+    }
+
+
+def get_chain_hit(chain, species=None):
+    """
+    Get hit properties of an abnumber Chain, including its original numbering
+    """
+    positions = chain.positions
+    return {
+        'hit_name': chain.name,
+        'hit_seq': chain.seq,
+        'hit_chain_type': chain.chain_type,
+        'hit_species': species,
+        'hit_numbering': {pos.format(chain_type=False): aa for pos, aa in positions.items()}
+    }
+
+
+def get_numbering_table(names, hits):
+    """
+    Create table of hit sequences aligned by their original numbering, same format as Chain.to_dataframe
+
+    Hit sequences are not renumbered, the numbering stored with each hit is used directly.
+    """
+    table = pd.DataFrame(index=pd.Index(names, name='Id'))
+    if not hits:
+        return table
+    chain_type = hits[0]['hit_chain_type']
+    labels = set(label for hit in hits for label in hit['hit_numbering'])
+    positions = sorted(Position.from_string(label, chain_type=chain_type, scheme='imgt') for label in labels)
+    columns = [pos.format(chain_type=False) for pos in positions]
+    table = pd.DataFrame([hit['hit_numbering'] for hit in hits], index=table.index, columns=columns).fillna('-')
+    table.insert(0, 'chain_type', [hit['hit_chain_type'] for hit in hits])
+    table.insert(1, 'species', [hit['hit_species'] for hit in hits])
+    return table
+
+
+def validate_target_options(parser, options):
+    """
+    Check that either targets or --store with --output, or --manifest with --output-dir were provided
+    """
+    if options.manifest:
+        if options.targets or options.output or options.store:
+            parser.error('Use --manifest with --output-dir, not with targets, --store or --output')
+        if not options.output_dir:
+            parser.error('--output-dir is required when using --manifest')
+        if options.debug:
+            parser.error('--debug cannot be used with --manifest')
+    else:
+        if not (options.targets or options.store) or not options.output:
+            parser.error('Provide targets or --store with --output, or use --manifest with --output-dir')
+        if options.targets and options.store:
+            parser.error('Use either targets or --store, not both')
+        if options.output_dir or options.workers != 1:
+            parser.error('--output-dir and --workers can only be used with --manifest')
+    if options.store and options.debug:
+        parser.error('--debug cannot be used with --store')
+    if options.v_family and not options.store:
+        parser.error('--v-family can only be used with --store')
+    if options.checkpoint and options.manifest:
+        parser.error('--checkpoint cannot be used with --manifest, use --resume instead')
+    if options.resume and not options.manifest:
+        parser.error('--resume can only be used with --manifest, use --checkpoint instead')
+    if options.hit_store and not options.manifest:
+        parser.error('--hit-store can only be used with --manifest')
+
+
+def search_store(search_units, queries, store, results, same_cdr_lengths=False, v_families=None, **kwargs):
+    """
+    Search OASStore, comparing each group of queries only with the store parts that can contain its hits
+
+    :param search_units: function(queries, paths, results=None, **kwargs) that returns TopHits
+    :param queries: pandas Series of abnumber Chains
+    :param store: OASStore object
+    :param results: TopHits of all queries, updated in place
+    :param same_cdr_lengths: Only search parts with the same CDR lengths as the query
+    :param v_families: Only search parts with given V gene families
+    :return: TopHits of all queries
+    """
+    plan = store.plan_search(queries, same_cdr_lengths=same_cdr_lengths, v_families=v_families)
+    paths = set(path for mask, group_paths in plan for path in group_paths)
+    print(f'Reading {len(paths)} of {len(store.index)} store parts '
+          f'({store.get_num_seqs(paths)} of {len(store)} sequences)', flush=True)
+    for mask, group_paths in plan:
+        search_units(queries[mask], group_paths, results=results, **kwargs)
+    return results
+
+
+def read_manifest(path):
+    """
+    Read list of data-unit paths, one per line, ignoring empty lines and # comments
+    """
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def get_unit_name(path):
+    name = os.path.basename(path.rstrip('/'))
+    for ext in ['.json.gz', '.json', ENCODED_UNIT_SUFFIX]:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def get_unit_size(path):
+    if is_encoded_unit(path):
+        return os.path.getsize(os.path.join(path, 'residues.npy'))
+    return os.path.getsize(path)
+
+
+def save_csv(table, path):
+    """
+    Save table to CSV, replacing the file only after it was fully written
+    """
+    tmp_path = path + '.tmp'
+    table.to_csv(tmp_path)
+    os.replace(tmp_path, path)
+
+
+_worker_context = {}
+
+
+def _init_worker(search_unit_to_csv, kwargs):
+    _worker_context['search_unit_to_csv'] = search_unit_to_csv
+    _worker_context['kwargs'] = kwargs
+
+
+def _search_unit_in_worker(task):
+    path, output_path = task
+    return path, output_path, _worker_context['search_unit_to_csv'](path, output_path, **_worker_context['kwargs'])
+
+
+def check_search_settings(output_dir, settings, resume=False):
+    """
+    Save search settings to output_dir, when resuming check that they did not change
+    """
+    settings_path = os.path.join(output_dir, SEARCH_SETTINGS_FILE)
+    if resume and os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) != settings:
+                raise ValueError(f'Existing results were created with different queries or search options, '
+                                 f'search without resuming to replace them: {output_dir}')
+    with open(settings_path + '.tmp', 'w') as f:
+        json.dump(settings, f)
+    os.replace(settings_path + '.tmp', settings_path)
+
+
+def search_units_parallel(search_unit_to_csv, paths, output_dir, workers=1, resume=False, settings=None, hit_store=None, **kwargs):
+    """
+    Search each data unit separately using a pool of worker processes, save one CSV per unit to output_dir
+
+    Queries and other keyword arguments are passed to each worker process once, not with each unit.
+    Units are processed largest-first so that the slowest units don't end up running last.
+    CSV of each unit is saved as soon as the unit is finished, so the CSV files also serve as a ledger
+    of searched units: with resume, units that already have a CSV (and are in the hit store) are skipped.
+
+    :param search_unit_to_csv: function(path, output_path, **kwargs) that saves the CSV and returns the hits table
+    :param paths: list of data-unit paths
+    :param output_dir: output directory, CSV files are named by the data unit. When a list of directories is provided,
+    search_unit_to_csv receives a list with one output path in each directory and returns a list of tables
+    :param workers: number of worker processes
+    :param resume: skip data units that already have a CSV in output_dir
+    :param settings: dict of search settings (see get_search_settings), checked when resuming,
+    list of dicts for each directory when output_dir is a list
+    :param hit_store: HitStore where hits of each unit are appended (list of HitStores or None for each directory
+    when output_dir is a list)
+    """
+    multiple = not isinstance(output_dir, str)
+    output_dirs = list(output_dir) if multiple else [output_dir]
+    settings_list = (settings or [None] * len(output_dirs)) if multiple else [settings]
+    hit_stores = (hit_store or [None] * len(output_dirs)) if multiple else [hit_store]
+    for criterion_output_dir, criterion_settings in zip(output_dirs, settings_list):
+        os.makedirs(criterion_output_dir, exist_ok=True)
+        if criterion_settings is not None:
+            check_search_settings(criterion_output_dir, criterion_settings, resume=resume)
+
+    tasks = [(path, [os.path.join(d, get_unit_name(path) + '.csv') for d in output_dirs])
+             for path in sorted(paths, key=get_unit_size, reverse=True)]
+    if resume:
+        stored_units = [store.get_units() for store in hit_stores if store is not None]
+        num_tasks = len(tasks)
+        tasks = [(path, output_paths) for path, output_paths in tasks
+                 if not all(os.path.exists(p) for p in output_paths)
+                 or not all(get_unit_name(path) in units for units in stored_units)]
+        print(f'Skipping {num_tasks - len(tasks)} data units that were already searched', flush=True)
+    tasks = [(path, output_paths if multiple else output_paths[0]) for path, output_paths in tasks]
+
+    if workers == 1:
+        _init_worker(search_unit_to_csv, kwargs)
+        pool = None
+        results = map(_search_unit_in_worker, tasks)
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(search_unit_to_csv, kwargs))
+        results = pool.imap_unordered(_search_unit_in_worker, tasks)
+    query_lengths = kwargs['queries'].apply(len) if any(store is not None for store in hit_stores) else None
+    try:
+        for i, (path, output_path, tables) in enumerate(results):
+            output_paths = output_path if multiple else [output_path]
+            tables = tables if multiple else [tables]
+            for table, store in zip(tables, hit_stores):
+                if store is not None:
+                    # appended in the main process only, so there is a single writer
+                    records = get_hit_records(table, query_lengths, unit=get_unit_name(path), study=get_unit_study(path))
+                    store.append(records, units=[get_unit_name(path)])
+            num_hits = sum(len(table) for table in tables)
+            print(f'[{i+1}/{len(tasks)}] Saved {num_hits} hits to: {", ".join(output_paths)}', flush=True)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import re
+from collections import Counter
+import numpy as np
+import pandas as pd
+from bin.oas_units import read_unit, read_unit_seqs, concatenate_units, get_chain_prefix, CDR_REGIONS, ENCODED_UNIT_SUFFIX
+from bin.oas_search import read_manifest, get_unit_name
+
+STORE_INDEX = 'index.tsv'
+STORE_UNITS = 'units.txt'
+BUCKET_COLUMNS = ['chain_type', 'v_family'] + [f'{region}_length' for region in CDR_REGIONS]
+INDEX_COLUMNS = ['bucket', 'part'] + BUCKET_COLUMNS + ['num_seqs']
+# Bucket is saved as a new part once it collects this many sequences
+DEFAULT_PART_SIZE = 100000
+# All buckets are saved once this many sequences are waiting to be saved
+DEFAULT_BUFFER_SIZE = 2000000
+
+
+def get_v_family(v_gene):
+    """
+    Get V gene family from V gene name, e.g. IGHV3 from IGHV3-23*01 or IGKV1 from IGKV1D-39*01
+    """
+    match = re.match(r'IG[HKL]V\d+', v_gene)
+    family = match.group(0) if match else re.split(r'[-*/]', v_gene)[0]
+    return re.sub(r'[^\w.]', '_', family) or 'unknown'
+
+
+def get_bucket_name(chain_type, v_family, cdr1_length, cdr2_length, cdr3_length):
+    return os.path.join(chain_type, v_family, f'{cdr1_length}_{cdr2_length}_{cdr3_length}')
+
+
+def get_cdr_lengths(chain):
+    return tuple(len(getattr(chain, f'{region}_dict')) for region in CDR_REGIONS)
+
+
+class OASStore:
+    """
+    Persistent store of OAS sequences partitioned into buckets by chain type, V gene family and CDR lengths
+
+    Each bucket is saved as one or more EncodedUnit parts, listed in index.tsv together with their bucket key and size.
+    Names of data units that were added are listed in units.txt, so that new data units can be added later.
+    """
+    def __init__(self, path):
+        self.path = path
+        index_path = os.path.join(path, STORE_INDEX)
+        if os.path.exists(index_path):
+            self.index = pd.read_csv(index_path, sep='\t', dtype={'v_family': str})
+        else:
+            self.index = pd.DataFrame(columns=INDEX_COLUMNS)
+        units_path = os.path.join(path, STORE_UNITS)
+        self.units = read_manifest(units_path) if os.path.exists(units_path) else []
+
+    def __len__(self):
+        return int(self.index['num_seqs'].sum())
+
+    def get_path(self, part):
+        return os.path.join(self.path, part)
+
+    def select_parts(self, chain_prefix=None, cdr_lengths=None, v_families=None):
+        """
+        Get paths of store parts that contain the given heavy/light chain type, CDR lengths and V gene families
+
+        :param chain_prefix: H for heavy or L for light chains (kappa and lambda), None for all
+        :param cdr_lengths: tuple of CDR1, CDR2 and CDR3 lengths, None for all
+        :param v_families: list of V gene families, None for all
+        """
+        mask = np.ones(len(self.index), dtype=bool)
+        if chain_prefix is not None:
+            mask &= self.index['chain_type'].map(get_chain_prefix).values == chain_prefix
+        if cdr_lengths is not None:
+            for region, length in zip(CDR_REGIONS, cdr_lengths):
+                mask &= self.index[f'{region}_length'].values == length
+        if v_families:
+            mask &= self.index['v_family'].isin(v_families).values
+        return [self.get_path(part) for part in self.index['part'][mask]]
+
+    def plan_search(self, queries, same_cdr_lengths=False, v_families=None):
+        """
+        Group queries that can only have hits in the same store parts
+
+        Queries are only compared with parts of the same heavy/light chain type.
+        With same_cdr_lengths, queries are only compared with parts with the same CDR1, CDR2 and CDR3 lengths.
+
+        :param queries: pandas Series of abnumber Chains
+        :return: list of (bool mask of queries in the group, list of part paths)
+        """
+        keys = [(get_chain_prefix(query.chain_type), get_cdr_lengths(query) if same_cdr_lengths else None)
+                for query in queries]
+        plan = []
+        for chain_prefix, cdr_lengths in dict.fromkeys(keys):
+            mask = np.array([key == (chain_prefix, cdr_lengths) for key in keys])
+            paths = self.select_parts(chain_prefix=chain_prefix, cdr_lengths=cdr_lengths, v_families=v_families)
+            plan.append((mask, paths))
+        return plan
+
+    def get_num_seqs(self, paths):
+        num_seqs = dict(zip(self.index['part'].map(self.get_path), self.index['num_seqs']))
+        return int(sum(num_seqs[path] for path in paths))
+
+    def add_units(self, paths, part_size=DEFAULT_PART_SIZE, buffer_size=DEFAULT_BUFFER_SIZE):
+        """
+        Add sequences of OAS data units (JSON or encoded) to the store, skipping data units that were already added
+
+        :return: number of added sequences
+        """
+        added = set(self.units)
+        pending = {}
+        num_pending = 0
+        num_added = 0
+        for i, path in enumerate(paths):
+            name = get_unit_name(path)
+            if name in added:
+                print(f'[{i+1}/{len(paths)}] Skipping {name}, already in store')
+                continue
+            unit = read_unit(path)
+            keys = pd.DataFrame(unit.get_region_lengths(CDR_REGIONS), columns=BUCKET_COLUMNS[2:])
+            keys.insert(0, 'chain_type', np.asarray(unit.chain_types))
+            keys.insert(1, 'v_family', [get_v_family(v_gene) for v_gene in unit.v_genes.tolist()])
+            for key, rows in keys.groupby(BUCKET_COLUMNS).indices.items():
+                pending.setdefault(key, []).append((unit.take(rows), name))
+            num_pending += len(unit)
+            num_added += len(unit)
+            self.units.append(name)
+            added.add(name)
+            print(f'[{i+1}/{len(paths)}] Added {len(unit)} sequences from {name}', flush=True)
+
+            for key in list(pending):
+                if sum(len(part) for part, _ in pending[key]) >= part_size:
+                    num_pending -= self._save_part(key, pending.pop(key))
+            if num_pending >= buffer_size:
+                for key in list(pending):
+                    num_pending -= self._save_part(key, pending.pop(key))
+
+        for key in list(pending):
+            self._save_part(key, pending.pop(key))
+        self.save_index()
+        return num_added
+
+    def _save_part(self, key, items):
+        chain_type, v_family, cdr1_length, cdr2_length, cdr3_length = key
+        bucket = get_bucket_name(chain_type, v_family, cdr1_length, cdr2_length, cdr3_length)
+        part_num = int((self.index['bucket'] == bucket).sum())
+        part = os.path.join(bucket, f'part{part_num:05d}{ENCODED_UNIT_SUFFIX}')
+        unit = concatenate_units([unit for unit, _ in items], [name for _, name in items])
+        os.makedirs(os.path.dirname(self.get_path(part)), exist_ok=True)
+        unit.save(self.get_path(part))
+        self.index.loc[len(self.index)] = [bucket, part, chain_type, v_family,
+                                           int(cdr1_length), int(cdr2_length), int(cdr3_length), len(unit)]
+        return len(unit)
+
+    def verify_units(self, paths):
+        """
+        Check that sequences of data units were stored unchanged, comparing the (name, sequence) pairs of each data unit
+
+        :return: list of names of data units with missing or changed sequences
+        """
+        stored = {get_unit_name(path): Counter() for path in paths}
+        for part in self.index['part']:
+            unit = read_unit(self.get_path(part))
+            for i, source_unit in enumerate(unit.source_units.tolist()):
+                if source_unit in stored:
+                    stored[source_unit][(str(unit.names[i]), unit.get_seq(i))] += 1
+        return [get_unit_name(path) for path in paths if stored[get_unit_name(path)] != Counter(read_unit_seqs(path))]
+
+    def save_index(self):
+        """
+        Save index.tsv and units.txt, replacing them only after they were fully written
+        """
+        os.makedirs(self.path, exist_ok=True)
+        index_path = os.path.join(self.path, STORE_INDEX)
+        self.index.to_csv(index_path + '.tmp', sep='\t', index=False)
+        os.replace(index_path + '.tmp', index_path)
+        units_path = os.path.join(self.path, STORE_UNITS)
+        with open(units_path + '.tmp', 'w') as f:
+            f.writelines(f'{name}\n' for name in self.units)
+        os.replace(units_path + '.tmp', units_path)
+
+
+if __name__ == "__main__":
+    # Parse command line
+    parser = argparse.ArgumentParser(description='Build OAS store partitioned by chain type, V gene family and CDR lengths. '
+                                                 'Data units that are already in the store are skipped, so the store can be extended later.')
+    parser.add_argument("store", help="Output store directory (created or extended).")
+    parser.add_argument("inputs", nargs='*', help="OAS data-unit (gzipped) JSON file path(s) or encoded unit(s) created using bin/oas_units.py.")
+    parser.add_argument("--manifest", help="Text file with one data-unit path per line.")
+    parser.add_argument("--part-size", type=int, default=DEFAULT_PART_SIZE, help="Number of sequences after which a bucket is saved as a new part.")
+    parser.add_argument("--buffer-size", type=int, default=DEFAULT_BUFFER_SIZE, help="Number of sequences kept in memory before all buckets are saved.")
+    parser.add_argument("--verify", action="store_true", help="Check that sequences of the data units are stored unchanged after adding them.")
+    options = parser.parse_args()
+
+    paths = options.inputs + (read_manifest(options.manifest) if options.manifest else [])
+    if not paths:
+        parser.error('Provide data-unit paths or --manifest')
+
+    store = OASStore(options.store)
+    num_added = store.add_units(paths, part_size=options.part_size, buffer_size=options.buffer_size)
+    print(f'Added {num_added} sequences, store now has {len(store)} sequences '
+          f'in {store.index["bucket"].nunique()} buckets ({len(store.index)} parts): {options.store}')
+    if options.verify:
+        changed = store.verify_units(paths)
+        if changed:
+            raise ValueError(f'Sequences of {len(changed)} data units differ from the store: {", ".join(changed)}')
+        print(f'Verified sequences of {len(paths)} data units')
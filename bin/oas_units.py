@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import numpy as np
+from abnumber import Chain, Position
+
+ENCODED_UNIT_SUFFIX = '.encoded'
+ENCODED_UNIT_ARRAYS = ['positions', 'residues', 'chain_types', 'names', 'v_genes', 'j_genes']
+# Only present in units that combine sequences from multiple data units
+OPTIONAL_ENCODED_UNIT_ARRAYS = ['source_units', 'source_species']
+# Residues are stored as ASCII codes, positions without a residue are stored as zero
+MISSING_RESIDUE = 0
+# Query positions that have no residue (or are not present in the target unit) never match
+QUERY_MISSING_RESIDUE = 255
+# Residues that are dropped when creating a Chain
+SKIPPED_RESIDUES = ['*', '-', '', '.']
+REGIONS = ['fr1', 'cdr1', 'fr2', 'cdr2', 'fr3', 'cdr3', 'fr4']
+FW_REGIONS = ['fr1', 'fr2', 'fr3', 'fr4']
+CDR_REGIONS = ['cdr1', 'cdr2', 'cdr3']
+
+
+def get_chain_type(v_germline, path=None):
+    if v_germline.startswith('IGHV'):
+        return 'H'
+    if v_germline.startswith('IGLV'):
+        return 'L'
+    if v_germline.startswith('IGKV'):
+        return 'K'
+    raise ValueError(f'Invalid germline "{v_germline}": {path}')
+
+
+def get_chain_prefix(chain_type):
+    return 'H' if chain_type == 'H' else 'L'
+
+
+def iterate_oas_json_items(path, limit=None):
+    """
+    Iterate through OAS data-unit JSON records, skipping the metadata row
+
+    Note: Same as iterate_oas_json, this yields limit+1 records when limit is provided
+    """
+    if path.endswith('.json.gz'):
+        gzipped = True
+    elif path.endswith('.json'):
+        gzipped = False
+    else:
+        raise ValueError(f'Expected .json or .json.gz file, got: {path}')
+    with (gzip.open(path) if gzipped else open(path)) as f:
+        i = 0
+        for line in f:
+            if limit and i > limit:
+                break
+            item = json.loads(line)
+            if 'seq' not in item:
+                # skip metadata row
+                continue
+            i += 1
+            yield item
+
+
+def read_oas_json_metadata(path):
+    """
+    Read metadata row of OAS data-unit JSON file (e.g. Species, Chain), return empty dict if not present
+    """
+    with (gzip.open(path) if path.endswith('.gz') else open(path)) as f:
+        for line in f:
+            item = json.loads(line)
+            return {} if 'seq' in item else item
+    return {}
+
+
+class PositionCache:
+    """
+    Interned abnumber Position objects for each chain type, with their numbering order and region
+
+    Ranks and regions are keyed by Position, which only distinguishes heavy and light positions,
+    so they are shared by kappa and lambda positions.
+    """
+    def __init__(self):
+        self.positions = {}
+        self.ranks = {}
+        self.regions = {}
+
+    def get(self, label, chain_type):
+        key = (chain_type, label)
+        pos = self.positions.get(key)
+        if pos is None:
+            pos = Position.from_string(label, chain_type=chain_type, scheme='imgt')
+            pos = self.positions.setdefault((chain_type, pos.format(chain_type=False)), pos)
+            self.positions[key] = pos
+            self.regions[pos] = REGIONS.index(pos.get_region().lower())
+            # Re-rank all positions with the same heavy/light prefix, this only happens when a new position is seen.
+            # Kappa and lambda positions with the same label are equal (same ranks key) and have the same numbering order.
+            prefix = get_chain_prefix(chain_type)
+            same_prefix = sorted(set(p for (t, _), p in self.positions.items() if get_chain_prefix(t) == prefix))
+            for rank, p in enumerate(same_prefix):
+                self.ranks[p] = rank
+        return pos
+
+
+_position_cache = PositionCache()
+
+
+class OASRecord:
+    """
+    Numbered OAS sequence, a lightweight alternative to abnumber Chain
+
+    Positions are sorted in numbering order, residues is a string with one residue for each position,
+    region_starts contains index of first position of each region (and total length as last item).
+    """
+    __slots__ = ['name', 'chain_type', 'v_gene', 'j_gene', 'positions', 'residues', 'region_starts']
+
+    def __init__(self, name, chain_type, v_gene, j_gene, positions, residues, region_starts):
+        self.name = name
+        self.chain_type = chain_type
+        self.v_gene = v_gene
+        self.j_gene = j_gene
+        self.positions = positions
+        self.residues = residues
+        self.region_starts = region_starts
+
+    def __len__(self):
+        return len(self.residues)
+
+    @property
+    def seq(self):
+        return self.residues
+
+    def get_region_dict(self, region):
+        r = REGIONS.index(region)
+        start, end = self.region_starts[r], self.region_starts[r + 1]
+        return dict(zip(self.positions[start:end], self.residues[start:end]))
+
+    def to_chain(self):
+        return Chain(sequence=None, aa_dict=dict(zip(self.positions, self.residues)), name=self.name, scheme='imgt',
+                     chain_type=self.chain_type, tail='')
+
+
+def iterate_oas_records(path, limit=None, cache=_position_cache):
+    """
+    Iterate through OAS data-unit JSON file, return generator of OASRecord objects
+
+    Position objects are interned in a per-chain-type cache, so they are only parsed once for each label.
+    """
+    for item in iterate_oas_json_items(path, limit=limit):
+        chain_type = get_chain_type(item['v'], path)
+        data = json.loads(item['data'])
+        residues = {}
+        for region, region_data in data.items():
+            for label, aa in region_data.items():
+                aa = aa.upper().strip()
+                if aa in SKIPPED_RESIDUES:
+                    continue
+                residues[cache.get(label, chain_type)] = aa
+        positions = sorted(residues, key=cache.ranks.__getitem__)
+        region_counts = np.bincount([cache.regions[pos] for pos in positions], minlength=len(REGIONS))
+        yield OASRecord(
+            name=item['original_name'],
+            chain_type=chain_type,
+            v_gene=item['v'],
+            j_gene=item.get('j', ''),
+            positions=tuple(positions),
+            residues=''.join(residues[pos] for pos in positions),
+            region_starts=tuple([0] + np.cumsum(region_counts).tolist())
+        )
+
+
+def read_unit_seqs(path):
+    """
+    Get list of (name, sequence) of each record of an OAS data unit (JSON or encoded)
+
+    Sequences of JSON data units are read using separate Position objects for each record, independent of the position cache,
+    so they can be used to check sequences of encoded units and stores.
+    """
+    if is_encoded_unit(path):
+        unit = read_unit(path)
+        return [(str(unit.names[i]), unit.get_seq(i)) for i in range(len(unit))]
+    seqs = []
+    for item in iterate_oas_json_items(path):
+        chain_type = get_chain_type(item['v'], path)
+        residues = {}
+        for region_data in json.loads(item['data']).values():
+            for label, aa in region_data.items():
+                aa = aa.upper().strip()
+                if aa not in SKIPPED_RESIDUES:
+                    residues[Position.from_string(label, chain_type=chain_type, scheme='imgt')] = aa
+        seqs.append((item['original_name'], ''.join(residues[pos] for pos in sorted(residues))))
+    return seqs
+
+
+def encode_oas_json(path, limit=None):
+    """
+    Read OAS data-unit JSON file into a position-aligned EncodedUnit
+    """
+    records = list(iterate_oas_records(path, limit=limit))
+    if len(set(get_chain_prefix(record.chain_type) for record in records)) > 1:
+        raise ValueError(f'Expected only heavy or only light chains in one data unit: {path}')
+
+    positions = sorted(set(pos for record in records for pos in record.positions))
+    columns = {pos: i for i, pos in enumerate(positions)}
+    residues = np.zeros((len(records), len(positions)), dtype=np.uint8)
+    for i, record in enumerate(records):
+        residues[i, [columns[pos] for pos in record.positions]] = np.frombuffer(record.residues.encode(), dtype=np.uint8)
+
+    return EncodedUnit(
+        positions=np.array([pos.format(chain_type=False) for pos in positions], dtype=str),
+        residues=residues,
+        chain_types=np.array([record.chain_type for record in records], dtype=str),
+        names=np.array([record.name for record in records], dtype=str),
+        v_genes=np.array([record.v_gene for record in records], dtype=str),
+        j_genes=np.array([record.j_gene for record in records], dtype=str),
+        metadata=read_oas_json_metadata(path)
+    )
+
+
+def is_encoded_unit(path):
+    return path.rstrip('/').endswith(ENCODED_UNIT_SUFFIX)
+
+
+def get_encoded_unit_path(json_path, output_dir=None):
+    name = os.path.basename(json_path)
+    for ext in ['.json.gz', '.json']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return os.path.join(output_dir if output_dir else os.path.dirname(json_path), name + ENCODED_UNIT_SUFFIX)
+
+
+def read_unit(path, limit=None, mmap=True):
+    """
+    Read OAS data unit from JSON or from pre-encoded format (see EncodedUnit)
+    """
+    if is_encoded_unit(path):
+        unit = EncodedUnit.load(path, mmap=mmap)
+        if limit:
+            # keep the same number of records as iterate_oas_json
+            unit = unit.head(limit + 1)
+        return unit
+    return encode_oas_json(path, limit=limit)
+
+
+class EncodedUnit:
+    """
+    OAS data unit stored as a position-aligned residue matrix
+
+    The unit is saved as a directory of .npy arrays that can be memory-mapped:
+
+    - positions: IMGT position labels without chain prefix, sorted in numbering order
+    - residues: uint8 matrix (sequences x positions) of ASCII residue codes, 0 for missing positions
+    - chain_types: H, K or L for each sequence
+    - names, v_genes, j_genes: OAS original name, V gene and J gene of each sequence
+    - source_units, source_species: data unit name and species of each sequence (optional, see concatenate_units)
+
+    Unit metadata (the metadata row of the JSON file) is saved as metadata.json.
+    """
+    def __init__(self, positions, residues, chain_types, names, v_genes, j_genes, metadata=None,
+                 source_units=None, source_species=None):
+        assert residues.shape == (len(names), len(positions)), \
+            f'Expected residue matrix of shape {(len(names), len(positions))}, got {residues.shape}'
+        self.positions = positions
+        self.residues = residues
+        self.chain_types = chain_types
+        self.names = names
+        self.v_genes = v_genes
+        self.j_genes = j_genes
+        self.metadata = metadata or {}
+        self.source_units = source_units
+        self.source_species = source_species
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def chain_prefix(self):
+        return get_chain_prefix(self.chain_types[0]) if len(self) else None
+
+    def head(self, limit):
+        return self.take(slice(None, limit))
+
+    def take(self, rows):
+        """
+        Get unit with selected sequences, rows can be a slice, bool mask or array of indexes
+        """
+        return EncodedUnit(
+            positions=self.positions,
+            residues=self.residues[rows],
+            chain_types=self.chain_types[rows],
+            names=self.names[rows],
+            v_genes=self.v_genes[rows],
+            j_genes=self.j_genes[rows],
+            metadata=self.metadata,
+            source_units=None if self.source_units is None else self.source_units[rows],
+            source_species=None if self.source_species is None else self.source_species[rows]
+        )
+
+    def get_positions(self):
+        """
+        Get abnumber Position object for each column
+        """
+        chain_type = self.chain_types[0] if len(self) else 'H'
+        return [Position.from_string(label, chain_type=chain_type, scheme='imgt') for label in self.positions]
+
+    def get_region_columns(self):
+        """
+        Get dict of region name -> array of column indexes
+        """
+        regions = np.array([pos.get_region().lower() for pos in self.get_positions()], dtype=str)
+        return {region: np.flatnonzero(regions == region) for region in REGIONS}
+
+    def get_chain(self, i):
+        """
+        Get i-th sequence as abnumber Chain (slow, use for debugging only)
+        """
+        chain_type = str(self.chain_types[i])
+        row = self.residues[i]
+        aa_dict = {Position.from_string(label, chain_type=chain_type, scheme='imgt'): chr(code)
+                   for label, code in zip(self.positions, row) if code != MISSING_RESIDUE}
+        return Chain(sequence=None, aa_dict=aa_dict, name=str(self.names[i]), scheme='imgt',
+                     chain_type=chain_type, tail='')
+
+    def get_seq(self, i):
+        row = self.residues[i]
+        return row[row != MISSING_RESIDUE].tobytes().decode()
+
+    def get_numbering(self, i):
+        """
+        Get dict of position label -> residue of i-th sequence, in numbering order
+        """
+        row = np.asarray(self.residues[i])
+        present = np.flatnonzero(row != MISSING_RESIDUE)
+        return dict(zip(self.positions[present].tolist(), row[present].tobytes().decode()))
+
+    @property
+    def species(self):
+        return self.metadata.get('Species')
+
+    def get_species(self, i):
+        if self.source_species is not None:
+            return str(self.source_species[i]) or None
+        return self.species
+
+    def get_region_lengths(self, regions=CDR_REGIONS):
+        """
+        Get int array of sequences x regions with number of residues of each sequence in each region
+        """
+        region_columns = self.get_region_columns()
+        present = np.asarray(self.residues) != MISSING_RESIDUE
+        return np.stack([present[:, region_columns[region]].sum(axis=1) for region in regions], axis=1)
+
+    def encode_chains(self, chains):
+        """
+        Encode abnumber Chains to a matrix aligned to this unit's position columns
+
+        Positions without a residue are encoded as QUERY_MISSING_RESIDUE so that they never match.
+        Chains that are not of the same heavy/light type as this unit will not match any position.
+
+        :return: tuple of (uint8 matrix of chains x positions, bool matrix of chains x regions
+        which is True when the chain has a position in that region that is not present in this unit)
+        """
+        columns = {label: i for i, label in enumerate(self.positions)}
+        encoded = np.full((len(chains), len(self.positions)), QUERY_MISSING_RESIDUE, dtype=np.uint8)
+        off_axis = np.zeros((len(chains), len(REGIONS)), dtype=bool)
+        for i, chain in enumerate(chains):
+            same_prefix = get_chain_prefix(chain.chain_type) == self.chain_prefix
+            for r, region in enumerate(REGIONS):
+                for pos, aa in getattr(chain, f'{region}_dict').items():
+                    col = columns.get(pos.format(chain_type=False))
+                    if col is None or not same_prefix:
+                        off_axis[i, r] = True
+                    else:
+                        encoded[i, col] = ord(aa)
+        return encoded, off_axis
+
+    def save(self, path):
+        """
+        Save unit as a directory of .npy arrays, replacing it atomically
+        """
+        tmp_path = path.rstrip('/') + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name in ENCODED_UNIT_ARRAYS + OPTIONAL_ENCODED_UNIT_ARRAYS:
+            if getattr(self, name) is not None:
+                np.save(os.path.join(tmp_path, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(tmp_path, 'metadata.json'), 'w') as f:
+            json.dump(self.metadata, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None)
+                  for name in ENCODED_UNIT_ARRAYS}
+        for name in OPTIONAL_ENCODED_UNIT_ARRAYS:
+            array_path = os.path.join(path, f'{name}.npy')
+            if os.path.exists(array_path):
+                arrays[name] = np.load(array_path, mmap_mode='r' if mmap else None)
+        metadata_path = os.path.join(path, 'metadata.json')
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                arrays['metadata'] = json.load(f)
+        return cls(**arrays)
+
+
+def concatenate_units(units, unit_names):
+    """
+    Combine sequences of multiple EncodedUnits into one unit with a shared position axis
+
+    Data unit name and species of each sequence are kept in source_units and source_species.
+
+    :param units: list of EncodedUnit objects with the same heavy/light chain type
+    :param unit_names: data unit name of each unit, used when the unit does not have source_units already
+    """
+    unit_names = [name for unit, name in zip(units, unit_names) if len(unit)]
+    units = [unit for unit in units if len(unit)]
+    if len(set(unit.chain_prefix for unit in units)) > 1:
+        raise ValueError('Expected only heavy or only light chains when concatenating units')
+    chain_type = str(units[0].chain_types[0]) if units else 'H'
+    labels = set(label for unit in units for label in unit.positions.tolist())
+    positions = sorted(Position.from_string(label, chain_type=chain_type, scheme='imgt') for label in labels)
+    columns = {pos.format(chain_type=False): i for i, pos in enumerate(positions)}
+
+    residues = np.zeros((sum(len(unit) for unit in units), len(positions)), dtype=np.uint8)
+    offset = 0
+    for unit in units:
+        residues[offset:offset + len(unit), [columns[label] for label in unit.positions.tolist()]] = unit.residues
+        offset += len(unit)
+
+    def combine(get_array):
+        return np.concatenate([np.asarray(get_array(unit, name)) for unit, name in zip(units, unit_names)]) \
+            if units else np.array([], dtype=str)
+
+    return EncodedUnit(
+        positions=np.array(list(columns), dtype=str),
+        residues=residues,
+        chain_types=combine(lambda unit, name: unit.chain_types),
+        names=combine(lambda unit, name: unit.names),
+        v_genes=combine(lambda unit, name: unit.v_genes),
+        j_genes=combine(lambda unit, name: unit.j_genes),
+        source_units=combine(lambda unit, name: unit.source_units if unit.source_units is not None
+                             else np.full(len(unit), name)),
+        source_species=combine(lambda unit, name: unit.source_species if unit.source_species is not None
+                               else np.full(len(unit), unit.species or ''))
+    )
+
+
+if __name__ == "__main__":
+    # Parse command line
+    parser = argparse.ArgumentParser(description='Convert OAS data-unit JSON files to memory-mappable encoded units.')
+    parser.add_argument("inputs", nargs='+', help="OAS data-unit (gzipped) JSON file path(s).")
+    parser.add_argument("--output-dir", help=f"Output directory (default: next to input file, with {ENCODED_UNIT_SUFFIX} suffix).")
+    options = parser.parse_args()
+
+    if options.output_dir:
+        os.makedirs(options.output_dir, exist_ok=True)
+
+    for json_path in options.inputs:
+        output_path = get_encoded_unit_path(json_path, output_dir=options.output_dir)
+        unit = encode_oas_json(json_path)
+        unit.save(output_path)
+        print(f'Saved {len(unit)} sequences with {len(unit.positions)} positions to: {output_path}')
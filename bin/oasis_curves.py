@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+import pandas as pd
+from bin.oasis_db import PEPTIDE_LENGTH
+from bin.oasis_index import OASisIndex, encode_sequence_peptides
+from bin.utils import iterate_fasta
+
+# OASis identity is computed at prevalence thresholds from 0% to MAX_THRESHOLD%
+MAX_THRESHOLD = 90
+CHAIN_SUFFIXES = {'VH': False, 'VL': True}
+
+
+def get_chain_records(records):
+    """
+    Get antibody name and whether it is a light chain for each record, from descriptions like "<antibody> VH" or "<antibody> VL"
+    """
+    names, is_light = [], []
+    for record in records:
+        parts = record.description.rsplit(' ', 1)
+        if len(parts) != 2 or parts[1] not in CHAIN_SUFFIXES:
+            raise ValueError(f'Expected description "<antibody> VH" or "<antibody> VL", got: {record.description}')
+        names.append(parts[0])
+        is_light.append(CHAIN_SUFFIXES[parts[1]])
+    return names, np.array(is_light, dtype=bool)
+
+
+def get_peptide_table(seqs, is_light, oasis_index):
+    """
+    Get number and fraction of OAS subjects of all overlapping 9-mer peptides of each chain
+
+    :return: tuple of chain index of each peptide, number of subjects and total number of subjects
+    """
+    keys, chain_idx = encode_sequence_peptides(seqs)
+    peptide_is_light = is_light[chain_idx]
+    num_subjects = oasis_index.get_num_subjects(keys, peptide_is_light)
+    return chain_idx, num_subjects, oasis_index.get_total_subjects(peptide_is_light)
+
+
+def get_oasis_curves(names, seqs, is_light, oasis_index, max_threshold=MAX_THRESHOLD, per_chain=False):
+    """
+    Get OASis identity of each antibody at prevalence thresholds 0%-max_threshold%, same as the "OASis Curves" sheet
+
+    OASis identity at threshold t is the fraction of peptides of all chains of the antibody
+    found in at least t% of OAS subjects. All chains and thresholds are computed in one vectorized pass.
+
+    :param names: antibody name of each chain
+    :param seqs: sequence of each chain
+    :param is_light: bool array, True for light chains
+    :param per_chain: separate curves of heavy and light chains of each antibody, indexed by Antibody and Chain (H or L)
+    :return: DataFrame indexed by Antibody with one column per threshold ('0%', '1%', ...)
+    """
+    is_light = np.asarray(is_light)
+    groups = pd.MultiIndex.from_arrays([names, np.where(is_light, 'L', 'H')], names=['Antibody', 'Chain']) if per_chain \
+        else pd.Index(names, name='Antibody')
+    # antibodies in input order
+    antibody_idx, antibodies = pd.factorize(groups)
+    antibodies = antibodies.set_names(groups.names)
+    chain_idx, num_subjects, total_subjects = get_peptide_table(seqs, is_light, oasis_index)
+    peptide_antibody = antibody_idx[chain_idx]
+
+    num_thresholds = max_threshold + 1
+    # peptide passes thresholds 0..k where k = floor(100 * fraction), in integer arithmetic to avoid rounding at thresholds
+    passed = np.minimum(num_subjects * 100 // np.maximum(total_subjects, 1), max_threshold)
+    histogram = np.bincount(peptide_antibody * num_thresholds + passed, minlength=len(antibodies) * num_thresholds)
+    histogram = histogram.reshape(len(antibodies), num_thresholds)
+    # number of peptides passing each threshold
+    num_passed = np.cumsum(histogram[:, ::-1], axis=1)[:, ::-1]
+    num_peptides = histogram.sum(axis=1, keepdims=True)
+    curves = pd.DataFrame(num_passed / np.maximum(num_peptides, 1),
+                          index=antibodies,
+                          columns=[f'{t}%' for t in range(num_thresholds)])
+    return curves
+
+
+if __name__ == "__main__":
+    # Parse command line
+    parser = argparse.ArgumentParser(description='Compute OASis identity curves of antibodies using an OASis index created by bin/oasis_index.py.')
+    parser.add_argument("input", nargs='+', help="Input FASTA file path(s) with '<antibody> VH' and '<antibody> VL' descriptions.")
+    parser.add_argument("output", help="Output TSV file path with OASis identity at each threshold (same columns as the 'OASis Curves' sheet).")
+    parser.add_argument("--index", required=True, help="OASis index directory.")
+    parser.add_argument("--per-chain", action="store_true", help="Separate curves of heavy and light chains (e.g. for bin/oasis_percentile.py).")
+    parser.add_argument("--peptides", help="Output TSV file path with number and fraction of OAS subjects of each peptide.")
+    options = parser.parse_args()
+
+    oasis_index = OASisIndex(options.index)
+    records = list(iterate_fasta(options.input))
+    names, is_light = get_chain_records(records)
+    seqs = [str(record.seq) for record in records]
+    curves = get_oasis_curves(names, seqs, is_light, oasis_index, per_chain=options.per_chain)
+    curves.to_csv(options.output, sep='\t')
+    print(f'Saved {len(curves)} OASis curves to: {options.output}')
+
+    if options.peptides:
+        chain_idx, num_subjects, total_subjects = get_peptide_table(seqs, is_light, oasis_index)
+        offsets = np.arange(len(chain_idx)) - np.searchsorted(chain_idx, chain_idx)
+        peptides = pd.DataFrame({
+            'Antibody': np.asarray(names)[chain_idx],
+            'Chain type': np.where(is_light[chain_idx], 'L', 'H'),
+            'Peptide Seq': [seqs[c][o:o + PEPTIDE_LENGTH] for c, o in zip(chain_idx.tolist(), offsets.tolist())],
+            'Peptide Num OAS Subjects': num_subjects,
+            'Peptide Fraction OAS Subjects': num_subjects / np.maximum(total_subjects, 1)
+        })
+        peptides.to_csv(options.peptides, sep='\t', index=False)
+        print(f'Saved {len(peptides)} peptides to: {options.peptides}')
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+MIN_PERCENT_SUBJECTS = 1
+MIN_SEQUENCES_PER_SUBJECT = 10000
+PEPTIDE_LENGTH = 9
+DEFAULT_BATCH_SIZE = 1000000
+# Peptides are saved as one row per peptide with a bitset of subjects, or one row per peptide and subject (BioPhi format)
+LAYOUTS = ['bitset', 'rows']
+SUBJECT_INDEXES = ['HeavySeqs', 'LightSeqs', 'CompleteHeavySeqs', 'CompleteLightSeqs']
+SUBJECT_METADATA = ['Age', 'Disease', 'Vaccine', 'Isotype', 'BType', 'BSource', 'Processed']
+
+
+def read_units(path):
+    """
+    Read units.tsv of the tree_of_9mers directory, indexed by unit number (without the 'h' prefix)
+    """
+    units = pd.read_csv(path, sep='\t')
+    units.set_index(units['Index'].astype(str).str.replace('h', '').astype(int), inplace=True)
+    units = units.drop(columns=['Index', 'Cdr3Records', 'NuclBytes', 'SeqBytes', 'Cdr3Bytes'], errors='ignore')
+    units['Subject'] = units.apply('{0.StudyPath}:{0.Subject}'.format, axis=1)
+    return units
+
+
+def read_complete_seq_counts(units, stats_dir):
+    """
+    Read number of complete sequences of each unit from <stats_dir>/<study>.tsv files
+    """
+    complete = pd.concat([pd.read_csv(os.path.join(stats_dir, f'{study}.tsv'), sep='\t') for study in units['StudyPath'].unique()])
+    return complete.set_index('UnitPath')['CompleteSeqs'].loc[units['UnitPath'].values]
+
+
+def concat_unique(vals):
+    return ', '.join(vals.fillna('None').astype(str).value_counts(dropna=False).index)
+
+
+def concat_age(vals):
+    return '-'.join(sorted(vals.fillna('None').astype(str).value_counts(dropna=False).index))
+
+
+def get_subjects(units, complete, min_sequences_per_subject=MIN_SEQUENCES_PER_SUBJECT):
+    """
+    Get table of subjects with at least min_sequences_per_subject complete heavy or light sequences, indexed from 1
+
+    Subjects of studies without subject annotation are removed.
+    """
+    complete_seqs_per_subject = complete.groupby([units['Chain'].values, units['Subject'].values]).sum()
+    seqs_per_subject = units.groupby(['Chain', 'Subject'])['SeqRecords'].sum()
+
+    subjects = units.groupby(['Subject', 'StudyPath', 'Author', 'Link', 'Year']).apply(
+        lambda group: pd.Series({column: (concat_age if column == 'Age' else concat_unique)(group[column]) for column in SUBJECT_METADATA})
+    ).reset_index()
+    assert len(subjects) == len(subjects[['StudyPath', 'Subject']].drop_duplicates())
+    removed = subjects[subjects['Subject'].str.endswith(':no')]['StudyPath'].unique()
+    print(f'Removed {len(removed)} studies with no subject annotation: {" ".join(removed)}')
+    subjects = subjects[~subjects['Subject'].str.endswith(':no')].replace('None', np.nan)
+
+    for i, (column, chain, counts) in enumerate([
+        ('HeavySeqs', 'Heavy', seqs_per_subject),
+        ('LightSeqs', 'Light', seqs_per_subject),
+        ('CompleteHeavySeqs', 'Heavy', complete_seqs_per_subject),
+        ('CompleteLightSeqs', 'Light', complete_seqs_per_subject)
+    ]):
+        chain_counts = counts.loc[chain] if chain in counts.index.get_level_values(0) else pd.Series(dtype=int)
+        subjects.insert(i + 1, column, chain_counts.reindex(subjects['Subject'], fill_value=0).values)
+
+    removed = (subjects['CompleteHeavySeqs'] < min_sequences_per_subject) & (subjects['CompleteLightSeqs'] < min_sequences_per_subject)
+    print(f'Removed {removed.sum()} subjects with less than {min_sequences_per_subject:,} sequences in heavy and light chain')
+    subjects = subjects[~removed]
+    assert subjects['Subject'].is_unique
+    subjects.index = pd.RangeIndex(1, len(subjects) + 1, name='id')
+    return subjects
+
+
+def get_peptide_files(input_dir):
+    """
+    Get paths of all peptide files in subdirectories of the tree_of_9mers directory
+    """
+    return sorted(
+        os.path.join(input_dir, dirname, filename)
+        for dirname in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, dirname))
+        for filename in os.listdir(os.path.join(input_dir, dirname))
+    )
+
+
+class PeptideExtractor:
+    """
+    Parse peptide files with lines "<peptide>\t<unit>:<count>,<unit>:<count>,..." into subject counts of each peptide
+
+    Units are mapped to subjects using arrays indexed by unit number, subject 0 marks removed subjects.
+    Peptides found in fewer than min_subjects subjects of their chain are skipped (chain of the last unit, as in the original notebook).
+    """
+    def __init__(self, units, subjects, min_percent_subjects=MIN_PERCENT_SUBJECTS, min_sequences_per_subject=MIN_SEQUENCES_PER_SUBJECT):
+        size = units.index.max() + 1
+        subject_index = pd.Series(subjects.index, subjects['Subject'])
+        self.unit_subject = np.zeros(size, dtype=np.int64)
+        self.unit_subject[units.index] = subject_index.reindex(units['Subject'], fill_value=0).values
+        # 0 heavy, 1 light, -1 unknown
+        self.unit_is_light = np.full(size, -1, dtype=np.int64)
+        self.unit_is_light[units.index] = np.where(units['Chain'] == 'Light', 1, np.where(units['Chain'] == 'Heavy', 0, -1))
+        self.num_subjects = len(subjects)
+        self.min_subjects = [
+            int(np.floor((subjects[column] >= min_sequences_per_subject).sum() * min_percent_subjects / 100))
+            for column in ['CompleteHeavySeqs', 'CompleteLightSeqs']
+        ]
+
+    def parse_line(self, line):
+        """
+        :return: tuple of peptide, sorted subject ids and their counts, or None if the peptide is skipped
+        """
+        peptide, count_str = line.rstrip('\n').split('\t')
+        assert len(peptide) == PEPTIDE_LENGTH, f'Expected {PEPTIDE_LENGTH}-mer, got: {peptide}'
+        unit_counts = np.array([kv.replace('h', '').split(':') for kv in count_str.split(',')], dtype=np.int64)
+        units, counts = unit_counts[:, 0], unit_counts[:, 1]
+        if units.max() >= len(self.unit_is_light) or (self.unit_is_light[units] < 0).any():
+            raise ValueError(f'Unknown unit in: {count_str}')
+        is_light = self.unit_is_light[units[-1]]
+        subjects = self.unit_subject[units]
+        kept = subjects > 0
+        subject_ids, inverse = np.unique(subjects[kept], return_inverse=True)
+        if len(subject_ids) < self.min_subjects[is_light]:
+            return None
+        return peptide, subject_ids, np.bincount(inverse, weights=counts[kept], minlength=len(subject_ids)).astype(np.int64)
+
+    def encode_subjects(self, subject_ids):
+        """
+        Encode subject ids (from 1) as a bitset, bit i of byte j is subject 8 * j + i + 1
+        """
+        bits = np.zeros(self.num_subjects, dtype=bool)
+        bits[subject_ids - 1] = True
+        return np.packbits(bits, bitorder='little').tobytes()
+
+    def extract(self, path, layout='bitset'):
+        """
+        Get rows of peptides table from one peptide file
+        """
+        rows = []
+        with open(path) as f:
+            for line in f:
+                parsed = self.parse_line(line)
+                if parsed is None:
+                    continue
+                peptide, subject_ids, counts = parsed
+                if layout == 'bitset':
+                    rows.append((peptide, len(subject_ids), self.encode_subjects(subject_ids), counts.astype('<u4').tobytes()))
+                else:
+                    rows += [(peptide, subject, count) for subject, count in zip(subject_ids.tolist(), counts.tolist())]
+        return rows
+
+
+def decode_subjects(bitset):
+    """
+    Decode bitset of a bitset-layout peptides row to array of subject ids (from 1)
+    """
+    return np.flatnonzero(np.unpackbits(np.frombuffer(bitset, dtype=np.uint8), bitorder='little')) + 1
+
+
+def decode_counts(counts):
+    """
+    Decode counts of a bitset-layout peptides row, in the same order as decode_subjects
+    """
+    return np.frombuffer(counts, dtype='<u4').astype(np.int64)
+
+
+_worker_context = {}
+
+
+def _init_worker(extractor, layout):
+    _worker_context['extractor'] = extractor
+    _worker_context['layout'] = layout
+
+
+def _extract_file(path):
+    return _worker_context['extractor'].extract(path, layout=_worker_context['layout'])
+
+
+def create_peptides_table(conn, layout):
+    if layout == 'bitset':
+        conn.execute('CREATE TABLE peptides (peptide TEXT, num_subjects INTEGER, subjects BLOB, counts BLOB)')
+    else:
+        conn.execute('CREATE TABLE peptides (peptide TEXT, subject INTEGER, count INTEGER)')
+
+
+def get_sql_type(values):
+    """
+    Get SQLite column type of a pandas column, same as DataFrame.to_sql
+    """
+    if pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(values):
+        return 'REAL'
+    return 'TEXT'
+
+
+def save_subjects(conn, subjects):
+    columns = ['id'] + list(subjects.columns)
+    table = subjects.reset_index()
+    conn.execute(f'CREATE TABLE subjects ({", ".join(f"{column} {get_sql_type(table[column])}" for column in columns)})')
+    rows = [tuple(None if pd.isnull(v) else v for v in row) for row in table[columns].astype(object).itertuples(index=False)]
+    conn.executemany(f'INSERT INTO subjects VALUES ({", ".join("?" * len(columns))})', rows)
+
+
+def build_oasis_db(input_dir, output, units_path=None, stats_dir=None, min_percent_subjects=MIN_PERCENT_SUBJECTS,
+                   min_sequences_per_subject=MIN_SEQUENCES_PER_SUBJECT, layout='bitset', workers=1, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Build OASis SQLite database with subjects and peptides tables from a tree_of_9mers directory
+
+    Peptide files are parsed in parallel and inserted in large transactions with synchronous=OFF,
+    indexes are created after all peptides are loaded. The database is written to a temporary file
+    and renamed to output when finished.
+
+    :param units_path: units.tsv path, <input_dir>/units.tsv if None
+    :param stats_dir: directory with complete sequence counts of each study (<study>.tsv with UnitPath and CompleteSeqs)
+    :param layout: 'bitset' for one row per peptide with a bitset of subjects, 'rows' for one row per peptide and subject
+    :return: number of saved peptides
+    """
+    units = read_units(units_path or os.path.join(input_dir, 'units.tsv'))
+    complete = read_complete_seq_counts(units, stats_dir)
+    subjects = get_subjects(units, complete, min_sequences_per_subject=min_sequences_per_subject)
+    print(f'Saving {len(subjects)} subjects')
+    extractor = PeptideExtractor(units, subjects, min_percent_subjects=min_percent_subjects,
+                                 min_sequences_per_subject=min_sequences_per_subject)
+    print(f'Minimum number of heavy and light chain subjects: {", ".join(map(str, extractor.min_subjects))}')
+
+    tmp_output = output + '.tmp'
+    for path in [tmp_output, tmp_output + '-wal', tmp_output + '-shm']:
+        if os.path.exists(path):
+            os.remove(path)
+    conn = sqlite3.connect(tmp_output, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('BEGIN')
+    save_subjects(conn, subjects)
+    create_peptides_table(conn, layout)
+
+    insert = f'INSERT INTO peptides VALUES ({", ".join("?" * (4 if layout == "bitset" else 3))})'
+    paths = get_peptide_files(input_dir)
+    num_rows = 0
+    num_pending = 0
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(extractor, layout)) if workers > 1 else None
+    try:
+        if pool is None:
+            _init_worker(extractor, layout)
+        file_rows = pool.imap(_extract_file, paths) if pool is not None else map(_extract_file, paths)
+        for rows in tqdm(file_rows, total=len(paths), unit='files'):
+            conn.executemany(insert, rows)
+            num_rows += len(rows)
+            num_pending += len(rows)
+            if num_pending >= batch_size:
+                conn.execute('COMMIT')
+                conn.execute('BEGIN')
+                num_pending = 0
+        conn.execute('COMMIT')
+    finally:
+        if pool is not None:
+            pool.close()
+    print(f'Saved {num_rows:,} peptide rows, creating indexes...')
+
+    conn.execute('BEGIN')
+    for column in SUBJECT_INDEXES:
+        conn.execute(f'CREATE INDEX ix_subjects_{column.lower()} ON subjects ({column})')
+    conn.execute('CREATE INDEX ix_peptides_peptide ON peptides (peptide)')
+    conn.execute('COMMIT')
+    conn.execute('ANALYZE')
+    # single-file database
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+    os.replace(tmp_output, output)
+    return num_rows
+
+
+if __name__ == "__main__":
+    # Parse command line
+    parser = argparse.ArgumentParser(description='Build OASis 9-mer SQLite database from a tree_of_9mers directory.')
+    parser.add_argument("input", help="Input tree_of_9mers directory, with peptide files in subdirectories.")
+    parser.add_argument("output", help="Output SQLite database path.")
+    parser.add_argument("--stats", required=True, help="Directory with complete sequence counts of each study (<study>.tsv).")
+    parser.add_argument("--units", help="Units TSV file path (default: <input>/units.tsv).")
+    parser.add_argument("--min-percent-subjects", default=MIN_PERCENT_SUBJECTS, type=float, help="Only save peptides found in at least this percentage of subjects.")
+    parser.add_argument("--min-sequences-per-subject", default=MIN_SEQUENCES_PER_SUBJECT, type=int, help="Only use subjects with at least this many complete heavy or light chain sequences.")
+    parser.add_argument("--layout", default='bitset', choices=LAYOUTS, help="Save subjects of each peptide as a bitset, or as one row per subject (format used by BioPhi).")
+    parser.add_argument("--workers", default=1, type=int, help="Number of processes parsing peptide files.")
+    parser.add_argument("--batch-size", default=DEFAULT_BATCH_SIZE, type=int, help="Number of rows inserted in one transaction.")
+    parser.add_argument("--force", action="store_true", help="Overwrite existing output database.")
+    options = parser.parse_args()
+
+    if os.path.exists(options.output) and not options.force:
+        parser.error(f'Output database already exists, use --force to overwrite: {options.output}')
+
+    start_time = time.time()
+    build_oasis_db(
+        options.input,
+        options.output,
+        units_path=options.units,
+        stats_dir=options.stats,
+        min_percent_subjects=options.min_percent_subjects,
+        min_sequences_per_subject=options.min_sequences_per_subject,
+        layout=options.layout,
+        workers=options.workers,
+        batch_size=options.batch_size
+    )
+    print(f'Saved database in {time.time() - start_time:.1f}s to: {options.output}')
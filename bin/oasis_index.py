@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from bin.oasis_db import MIN_SEQUENCES_PER_SUBJECT, PEPTIDE_LENGTH
+
+INDEX_FILE = 'index.json'
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+# Residues are packed as 5-bit codes from 1, code 0 (non-standard residues) never matches a peptide in the index
+BITS_PER_RESIDUE = 5
+RESIDUE_CODES = np.zeros(256, dtype=np.uint64)
+RESIDUE_CODES[np.frombuffer(AMINO_ACIDS.encode(), dtype=np.uint8)] = np.arange(1, len(AMINO_ACIDS) + 1)
+DEFAULT_CHUNK_SIZE = 1000000
+
+
+def pack_windows(codes, length=PEPTIDE_LENGTH):
+    """
+    Pack each window of residue codes into one integer, first residue in the highest bits
+
+    :param codes: (N, length) array of residue codes
+    :return: uint64 array of N keys, 0 for windows with a non-standard residue
+    """
+    keys = np.zeros(len(codes), dtype=np.uint64)
+    valid = np.ones(len(codes), dtype=bool)
+    for i in range(length):
+        keys = (keys << np.uint64(BITS_PER_RESIDUE)) | codes[:, i]
+        valid &= codes[:, i] > 0
+    return np.where(valid, keys, np.uint64(0))
+
+
+def encode_peptides(peptides, length=PEPTIDE_LENGTH):
+    """
+    Get packed keys of peptides of given length
+    """
+    data = np.frombuffer(''.join(peptides).encode(), dtype=np.uint8).reshape(-1, length)
+    return pack_windows(RESIDUE_CODES[data], length=length)
+
+
+def encode_sequence_peptides(seqs, length=PEPTIDE_LENGTH):
+    """
+    Get packed keys of all overlapping peptides of each sequence
+
+    :return: tuple of keys and index of sequence of each peptide
+    """
+    seqs = [str(seq) for seq in seqs]
+    num_peptides = np.array([max(len(seq) - length + 1, 0) for seq in seqs], dtype=np.int64)
+    data = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)
+    seq_starts = np.concatenate([[0], np.cumsum([len(seq) for seq in seqs])[:-1]]).astype(np.int64)
+    seq_idx = np.repeat(np.arange(len(seqs)), num_peptides)
+    # start of each peptide in the concatenated sequences, windows never cross sequence boundaries
+    starts = seq_starts[seq_idx] + np.arange(num_peptides.sum()) - np.repeat(np.cumsum(num_peptides) - num_peptides, num_peptides)
+    codes = RESIDUE_CODES[data[starts[:, None] + np.arange(length)]] if len(starts) else np.zeros((0, length), dtype=np.uint64)
+    return pack_windows(codes, length=length), seq_idx
+
+
+class OASisIndex:
+    """
+    Memory-mapped OASis 9-mer index exported from the OASis SQLite database
+
+    Peptides are saved as sorted 5-bit packed keys (keys.npy) with the number of heavy and light chain subjects
+    where each peptide was found (heavy_subjects.npy, light_subjects.npy). Total numbers of subjects are saved in index.json.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r')
+        self.num_subjects = {
+            chain: np.load(os.path.join(path, f'{chain}_subjects.npy'), mmap_mode='r') for chain in ['heavy', 'light']
+        }
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_num_subjects(self, keys, is_light):
+        """
+        Get number of subjects of each packed peptide, 0 for peptides not found in the index
+
+        :param is_light: bool array, True for peptides of light chains
+        """
+        idx = np.searchsorted(self.keys, keys)
+        idx[idx == len(self.keys)] = 0
+        found = (self.keys[idx] == keys) & (keys > 0) if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        counts = np.where(is_light, self.num_subjects['light'][idx], self.num_subjects['heavy'][idx]) if len(self.keys) else 0
+        return np.where(found, counts, 0).astype(np.int64)
+
+    def get_total_subjects(self, is_light):
+        return np.where(is_light, self.index['num_light_subjects'], self.index['num_heavy_subjects'])
+
+
+def read_peptide_subject_counts(db_path, min_sequences_per_subject=MIN_SEQUENCES_PER_SUBJECT, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Count heavy and light chain subjects of each peptide in an OASis SQLite database (bitset or rows layout, see bin/oasis_db.py)
+
+    Only subjects with at least min_sequences_per_subject complete sequences of the given chain are counted.
+
+    :return: tuple of sorted unique keys, heavy subject counts, light subject counts, number of heavy and light subjects
+    """
+    conn = sqlite3.connect(db_path)
+    subjects = pd.read_sql('SELECT id, CompleteHeavySeqs, CompleteLightSeqs FROM subjects', conn).set_index('id')
+    size = subjects.index.max() + 1 if len(subjects) else 1
+    is_subject = {}
+    for chain, column in [('heavy', 'CompleteHeavySeqs'), ('light', 'CompleteLightSeqs')]:
+        is_subject[chain] = np.zeros(size, dtype=np.int64)
+        is_subject[chain][subjects.index] = subjects[column] >= min_sequences_per_subject
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(peptides)')]
+    bitset = 'subjects' in columns
+    query = 'SELECT peptide, subjects FROM peptides' if bitset else 'SELECT DISTINCT peptide, subject FROM peptides'
+
+    parts = []
+    for chunk in tqdm(pd.read_sql(query, conn, chunksize=chunk_size), unit='chunks'):
+        if bitset:
+            # all bitsets have the same size, bit i is subject i + 1
+            bits = np.unpackbits(np.frombuffer(b''.join(chunk['subjects']), dtype=np.uint8).reshape(len(chunk), -1), axis=1, bitorder='little')
+            # bitsets are padded to whole bytes
+            counts = {chain: bits @ np.pad(flags[1:], (0, max(bits.shape[1] - len(flags) + 1, 0)))[:bits.shape[1]]
+                      for chain, flags in is_subject.items()}
+        else:
+            counts = {chain: flags[chunk['subject'].values] for chain, flags in is_subject.items()}
+        parts.append((encode_peptides(chunk['peptide']), counts['heavy'], counts['light']))
+    conn.close()
+
+    keys = np.concatenate([part[0] for part in parts]) if parts else np.zeros(0, dtype=np.uint64)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    heavy, light = [
+        np.bincount(inverse, weights=np.concatenate([part[i] for part in parts]), minlength=len(unique_keys)).astype(np.uint32)
+        if parts else np.zeros(0, dtype=np.uint32) for i in [1, 2]
+    ]
+    return unique_keys, heavy, light, int(is_subject['heavy'].sum()), int(is_subject['light'].sum())
+
+
+def export_oasis_index(db_path, output, min_sequences_per_subject=MIN_SEQUENCES_PER_SUBJECT, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Export OASis SQLite database to a memory-mapped OASisIndex directory
+    """
+    keys, heavy, light, num_heavy, num_light = read_peptide_subject_counts(
+        db_path, min_sequences_per_subject=min_sequences_per_subject, chunk_size=chunk_size)
+    os.makedirs(output, exist_ok=True)
+    np.save(os.path.join(output, 'keys.npy'), keys)
+    np.save(os.path.join(output, 'heavy_subjects.npy'), heavy)
+    np.save(os.path.join(output, 'light_subjects.npy'), light)
+    with open(os.path.join(output, INDEX_FILE), 'w') as f:
+        json.dump({
+            'num_peptides': len(keys),
+            'num_heavy_subjects': num_heavy,
+            'num_light_subjects': num_light,
+            'min_sequences_per_subject': min_sequences_per_subject,
+            'peptide_length': PEPTIDE_LENGTH
+        }, f, indent=2)
+    return OASisIndex(output)
+
+
+if __name__ == "__main__":
+    # Parse command line
+    parser = argparse.ArgumentParser(description='Export OASis 9-mer SQLite database to a memory-mapped index for bin/oasis_curves.py.')
+    parser.add_argument("input", help="OASis SQLite database path (created using bin/oasis_db.py or BioPhi OASis database).")
+    parser.add_argument("output", help="Output index directory.")
+    parser.add_argument("--min-sequences-per-subject", default=MIN_SEQUENCES_PER_SUBJECT, type=int, help="Only count subjects with at least this many complete sequences of the chain.")
+    parser.add_argument("--chunk-size", default=DEFAULT_CHUNK_SIZE, type=int, help="Number of database rows read at once.")
+    options = parser.parse_args()
+
+    start_time = time.time()
+    oasis_index = export_oasis_index(options.input, options.output, min_sequences_per_subject=options.min_sequences_per_subject,
+                                     chunk_size=options.chunk_size)
+    print(f'Saved {len(oasis_index):,} peptides ({oasis_index.index["num_heavy_subjects"]} heavy and '
+          f'{oasis_index.index["num_light_subjects"]} light chain subjects) in {time.time() - start_time:.1f}s to: {options.output}')
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import argparse
+import numpy as np
+import pandas as pd
+
+# Percentiles are tabulated at OASis identity 0-100%
+STEPS = np.arange(0, 101, 1)
+DELTA = 1e-10
+CHAIN_TABLES = {'heavy': 'H', 'light': 'L'}
+
+
+def read_curves(path):
+    """
+    Read OASis curves from TSV created by bin/oasis_curves.py (with Chain index level with --per-chain)
+    or from the "OASis Curves" sheet of an OASis xlsx report
+    """
+    if path.endswith('.xlsx'):
+        return pd.read_excel(path, sheet_name='OASis Curves', index_col=0)
+    header = pd.read_csv(path, sep='\t', nrows=0).columns
+    return pd.read_csv(path, sep='\t', index_col=[0, 1] if 'Chain' in header else 0)
+
+
+def get_threshold_columns(curves):
+    """
+    Get curve columns used for percentiles, all thresholds except 0% (where identity is always 100%)
+    """
+    return [column for column in curves.columns if column.endswith('%') and column != '0%']
+
+
+def get_report_chains(path):
+    """
+    Get chain type (H or L) of each sequence in an OASis xlsx report, light chains have no heavy V germline
+    """
+    report = pd.read_excel(path, index_col=0)
+    return pd.Series(np.where(report['Heavy V Germline'].isna(), 'L', 'H'), index=report.index.astype(str))
+
+
+def read_chain_mapping(path):
+    """
+    Read TSV with id, Antibody and Chain (H or L) of each sequence
+
+    :return: tuple of Series of antibody and Series of chain type, indexed by sequence id
+    """
+    mapping = pd.read_csv(path, sep='\t', dtype=str).set_index('id')
+    return mapping['Antibody'], mapping['Chain']
+
+
+def set_chain_index(curves, antibodies, chains):
+    """
+    Index curves of single sequences by Antibody and Chain, as created by bin/oasis_curves.py with --per-chain
+
+    :param antibodies: antibody of each sequence, Series indexed by sequence id
+    :param chains: chain type (H or L) of each sequence, Series indexed by sequence id
+    """
+    ids = curves.index.astype(str)
+    missing = ids.difference(antibodies.index).union(ids.difference(chains.index))
+    if len(missing):
+        raise ValueError(f'Antibody or chain type not found for {len(missing)} sequences, e.g.: {missing[0]}')
+    invalid = set(chains.loc[ids]) - set(CHAIN_TABLES.values())
+    if invalid:
+        raise ValueError(f'Expected chain type H or L, got: {", ".join(sorted(invalid))}')
+    index = pd.MultiIndex.from_arrays([antibodies.loc[ids].values, chains.loc[ids].values], names=['Antibody', 'Chain'])
+    return curves.set_axis(index, axis=0)
+
+
+def get_percentile_table(curves):
+    """
+    Get percentile of each OASis identity step (0-100%) among given curves at each prevalence threshold
+
+    Same as stats.percentileofscore(values, step / 100 + DELTA) (kind='rank') for each threshold and step,
+    computed for all steps at once using np.searchsorted on sorted values of each threshold. NaN values are ignored.
+
+    :param curves: DataFrame with one row per antibody and one column per threshold ('1%', '2%', ...)
+    :return: DataFrame indexed by humanness step with one column per threshold
+    """
+    columns = get_threshold_columns(curves)
+    scores = STEPS / 100 + DELTA
+    table = {}
+    for column in columns:
+        values = np.sort(curves[column].dropna().values)
+        left = np.searchsorted(values, scores, side='left')
+        right = np.searchsorted(values, scores, side='right')
+        table[column] = (left + right + (right > left)) * 0.5 / max(len(values), 1)
+    table = pd.DataFrame(table, index=pd.Index(STEPS, name='humanness'))
+    return table
+
+
+def get_chain_percentile_tables(curves):
+    """
+    Get heavy, light and mean percentile tables from per-chain OASis curves (index levels Antibody and Chain)
+
+    Curves of antibodies with multiple heavy or light chains are averaged, the mean table uses the average
+    of heavy and light chain curves of each antibody.
+
+    :return: dict of table name ('heavy', 'light', 'mean') -> percentile table
+    """
+    curves = curves[get_threshold_columns(curves)]
+    chain_curves = curves.groupby(level=[0, 1], sort=False).mean()
+    chains = chain_curves.index.get_level_values(1)
+    tables = {name: get_percentile_table(chain_curves[chains == chain]) for name, chain in CHAIN_TABLES.items()}
+    tables['mean'] = get_percentile_table(chain_curves.groupby(level=0, sort=False).mean())
+    return tables
+
+
+def save_percentile_table(table, path):
+    """
+    Save percentile table as TSV, or as compact binary .npz file (float32 values)
+    """
+    if path.endswith('.npz'):
+        np.savez(path, values=table.values.astype(np.float32), columns=np.array(table.columns, dtype=str), steps=table.index.values)
+    else:
+        table.to_csv(path, sep='\t')
+
+
+def load_percentile_table(path):
+    """
+    Load percentile table saved by save_percentile_table or created by notebooks/processing/08_oasis_percentile.ipynb
+    """
+    if path.endswith('.npz'):
+        data = np.load(path)
+        return pd.DataFrame(data['values'].astype(np.float64), index=pd.Index(data['steps'], name='humanness'),
+                            columns=data['columns'].tolist())
+    return pd.read_csv(path, sep='\t', index_col=0)
+
+
+def get_percentiles(curves, table):
+    """
+    Get OASis percentile of each antibody at each threshold, interpolating between identity steps of the percentile table
+
+    Vectorized equivalent of get_oasis_percentile in notebooks/reports/04_oasis_immunogenicity.ipynb for all antibodies and thresholds.
+
+    :param curves: DataFrame with OASis identity of each antibody (rows) at each threshold (columns)
+    :param table: percentile table (see get_percentile_table)
+    :return: DataFrame with same index as curves and one column for each threshold in both curves and table
+    """
+    columns = [column for column in get_threshold_columns(curves) if column in table.columns]
+    identity = curves[columns].values.astype(np.float64) * 100
+    missing = np.isnan(identity)
+    identity = np.where(missing, 0, identity)
+    lower = np.floor(identity).astype(np.int64)
+    upper = np.ceil(identity - 1e-8).astype(np.int64)
+    # row of each step, columns in order of curves
+    values = table.reindex(STEPS)[columns].values
+    column_idx = np.arange(len(columns))[None, :]
+    lower_values = values[lower, column_idx]
+    upper_values = values[upper, column_idx]
+    percentiles = lower_values + (upper_values - lower_values) * (identity - lower)
+    return pd.DataFrame(np.where(missing, np.nan, percentiles), index=curves.index, columns=columns)
+
+
+if __name__ == "__main__":
+    # Parse command line
+    parser = argparse.ArgumentParser(description='Build OASis percentile tables from reference OASis curves, or score OASis curves using a percentile table.')
+    parser.add_argument("curves", help="OASis curves TSV (bin/oasis_curves.py, use --per-chain for heavy and light tables) or OASis xlsx report.")
+    parser.add_argument("output", help="Output path prefix of percentile tables (<output>.tsv, <output>_heavy.tsv, <output>_light.tsv), "
+                                       "or output TSV path with percentiles with --table.")
+    parser.add_argument("--table", help="Percentile table (TSV or .npz) used to score the curves.")
+    parser.add_argument("--binary", action="store_true", help="Save percentile tables as compact .npz files instead of TSV.")
+    parser.add_argument("--mapping", help="TSV with id, Antibody and Chain (H or L) of each sequence, "
+                                          "used to build tables from curves of single sequences (without Chain column).")
+    parser.add_argument("--antibody-separator", help="Use part of sequence id before this separator as antibody name (e.g. '_' for '8659_seq1') "
+                                                     "and chain types from the OASis xlsx report, instead of --mapping.")
+    options = parser.parse_args()
+
+    curves = read_curves(options.curves)
+    if options.table:
+        percentiles = get_percentiles(curves, load_percentile_table(options.table))
+        percentiles.to_csv(options.output, sep='\t')
+        print(f'Saved percentiles of {len(percentiles)} rows to: {options.output}')
+    else:
+        # tables are built from curves of heavy and light chains of each antibody, same as notebooks/processing/08_oasis_percentile.ipynb
+        if not isinstance(curves.index, pd.MultiIndex):
+            if options.mapping:
+                antibodies, chains = read_chain_mapping(options.mapping)
+            elif options.antibody_separator and options.curves.endswith('.xlsx'):
+                ids = curves.index.astype(str)
+                antibodies = pd.Series(ids.str.split(options.antibody_separator).str[0], index=ids)
+                chains = get_report_chains(options.curves)
+            else:
+                parser.error('Curves have no Chain column, use curves created by bin/oasis_curves.py with --per-chain, '
+                             'provide --mapping, or use --antibody-separator with an OASis xlsx report')
+            curves = set_chain_index(curves, antibodies, chains)
+        tables = get_chain_percentile_tables(curves)
+        ext = '.npz' if options.binary else '.tsv'
+        for name, table in tables.items():
+            path = options.output + ('' if name == 'mean' else f'_{name}') + ext
+            save_percentile_table(table, path)
+            print(f'Saved {name} percentile table to: {path}')
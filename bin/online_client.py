@@ -0,0 +1,192 @@
+import asyncio
+import os
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import requests
+from tqdm import tqdm
+
+DEFAULT_CONCURRENCY = 4
+# Requests per second (including retries)
+DEFAULT_RATE = 1.0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+DEFAULT_TIMEOUT = 120
+# Responses with these status codes are retried, other errors fail the sequence
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, allows 'rate' requests per second on average and bursts of up to 'capacity' requests
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OnlineClient:
+    """
+    Asyncio HTTP client with limited concurrency, token bucket rate limit and retries with exponential backoff
+
+    Requests are made using the requests library in a thread pool, one thread per concurrent request.
+    """
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE, burst=1, max_retries=DEFAULT_MAX_RETRIES,
+                 backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def get_backoff(self, retry, response=None):
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return float(response.headers['Retry-After'])
+        delay = min(MAX_BACKOFF, self.backoff * 2 ** retry)
+        return delay * (0.5 + random.random() / 2)
+
+    async def fetch(self, url, executor, semaphore, bucket):
+        """
+        Get text of url, retrying failed requests with exponential backoff
+        """
+        loop = asyncio.get_running_loop()
+        error = None
+        for retry in range(self.max_retries + 1):
+            response = None
+            async with semaphore:
+                await bucket.acquire()
+                try:
+                    response = await loop.run_in_executor(executor, lambda: requests.get(url, timeout=self.timeout))
+                    if response.ok:
+                        return response.text
+                    error = f'HTTP {response.status_code}'
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        break
+                except requests.RequestException as e:
+                    error = str(e)
+            if retry < self.max_retries:
+                await asyncio.sleep(self.get_backoff(retry, response))
+        raise ValueError(f'Error calling url {url}: {error}')
+
+    async def _fetch_all(self, urls, callback):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        bucket = TokenBucket(self.rate, capacity=self.burst)
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            async def fetch_one(key, url):
+                try:
+                    callback(key, await self.fetch(url, executor, semaphore, bucket), None)
+                except ValueError as e:
+                    callback(key, None, e)
+            await asyncio.gather(*[fetch_one(key, url) for key, url in urls.items()])
+
+    def fetch_all(self, urls, callback):
+        """
+        Fetch all urls, calling callback(key, text, error) as soon as each of them finishes
+
+        :param urls: dict of key -> url
+        """
+        asyncio.run(self._fetch_all(urls, callback))
+
+
+def get_multiple_online(queries, get_url, parse, column, output=None, client=None):
+    """
+    Get score of each query from an online service, saving each score to output as soon as it is received
+
+    Queries with a score in an existing output (e.g. from an interrupted run) are not requested again.
+    If any query fails, the remaining queries are still processed and a ValueError is raised at the end.
+
+    :param queries: list of Bio.SeqRecord
+    :param get_url: function that returns url for a sequence
+    :param parse: function that returns score parsed from html, raises ValueError on error
+    :param column: score column name
+    :param output: TSV file path with id, description and score column, appended to after each query
+    :param client: OnlineClient, default settings if None
+    :return: DataFrame with id, description and score of each query, in order of queries
+    """
+    queries = list(queries)
+    client = client or OnlineClient()
+    done = {}
+    if output and os.path.exists(output) and os.path.getsize(output):
+        previous = pd.read_csv(output, sep='\t', dtype={'id': str, 'description': str})
+        done = {row['id']: row for row in previous.to_dict('records')}
+        print(f'Skipping {sum(query.id in done for query in queries)} sequences already saved in: {output}')
+
+    failed = {}
+    urls = OrderedDict()
+    for query in queries:
+        if query.id in done or query.id in urls:
+            continue
+        try:
+            urls[query.id] = get_url(str(query.seq))
+        except Exception as e:
+            failed[query.id] = e
+    descriptions = {query.id: query.description for query in queries}
+
+    f = open(output, 'a') if output else None
+    # header is only written to a new file, an existing file can also have just the header (no results yet)
+    if f is not None and not f.tell():
+        f.write(f'id\tdescription\t{column}\n')
+    progress = tqdm(total=len(urls))
+
+    def save(query_id, html, error):
+        progress.update()
+        if error is None:
+            try:
+                value = parse(html)
+            except ValueError as e:
+                error = e
+        if error is not None:
+            print(f'Failed {query_id}: {error}')
+            failed[query_id] = error
+            return
+        done[query_id] = OrderedDict(id=query_id, description=descriptions[query_id], **{column: value})
+        if f is not None:
+            f.write(f'{query_id}\t{descriptions[query_id]}\t{value}\n')
+            f.flush()
+
+    try:
+        client.fetch_all(urls, save)
+    finally:
+        progress.close()
+        if f is not None:
+            f.close()
+    if failed:
+        raise ValueError(f'Failed to get {column} of {len(failed)} sequences: {", ".join(failed)}. '
+                         f'Run again to retry, other results are saved.')
+    return pd.DataFrame([done[query.id] for query in queries], columns=['id', 'description', column])
+
+
+def add_client_arguments(parser, url):
+    """
+    Add command line options of OnlineClient and online service url template to an argparse parser
+    """
+    parser.add_argument("--url", default=url, help="Online service url template with {seq} and {chain_type} fields (e.g. a local test server).")
+    parser.add_argument("--concurrency", default=DEFAULT_CONCURRENCY, type=int, help="Maximum number of requests sent at the same time.")
+    parser.add_argument("--rate", default=DEFAULT_RATE, type=float, help="Maximum number of requests per second (including retries).")
+    parser.add_argument("--burst", default=1, type=int, help="Maximum number of requests sent at once after waiting.")
+    parser.add_argument("--max-retries", default=DEFAULT_MAX_RETRIES, type=int, help="Number of retries of each failed request.")
+    parser.add_argument("--backoff", default=DEFAULT_BACKOFF, type=float, help="Seconds to wait before first retry, doubled with each retry.")
+    parser.add_argument("--wait", default=10, type=float, help="Seconds to wait before sending sequences, to allow cancelling.")
+
+
+def get_client(options):
+    return OnlineClient(concurrency=options.concurrency, rate=options.rate, burst=options.burst,
+                        max_retries=options.max_retries, backoff=options.backoff)
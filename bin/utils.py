@@ -1,4 +1,8 @@
 from Bio import SeqIO
+import gzip
+import io
+import mmap
+import multiprocessing
 import os
 import pandas as pd
 import itertools
@@ -14,46 +18,223 @@ def heading(text, level=2):
     display(HTML(f'<h{level}>{text}</h{level}>'))
 
 def iterate_fasta_index(records, idx):
+    idx = iter(idx)
+    next_idx = next(idx, None)
     for i, record in enumerate(records):
-        if i == idx[0]:
+        if next_idx is None:
+            break
+        if i == next_idx:
             yield record
-            idx = idx[1:]
-            if not len(idx):
+            next_idx = next(idx, None)
+
+def filter_max_length(records, max_length):
+    return (record for record in records if len(record.seq) <= max_length)
+
+def parse_fasta(path):
+    """
+    Parse (gzipped) fasta file, return generator of records
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rt') as f:
+            yield from SeqIO.parse(f, 'fasta')
+    else:
+        yield from SeqIO.parse(path, 'fasta')
+
+def reservoir_sample(records, size, seed=None):
+    """
+    Uniformly sample size records in a single pass without knowing the total number of records (Algorithm L)
+
+    :return: list of sampled records in their original order, all records if there are fewer than size
+    """
+    rng = np.random.default_rng(seed)
+    indexed = enumerate(records)
+    sample = list(itertools.islice(indexed, size))
+    if len(sample) == size and size > 0:
+        # 1 - random() is in (0, 1], avoiding log(0)
+        w = np.exp(np.log(1 - rng.random()) / size)
+        while True:
+            skip = int(np.log(1 - rng.random()) // np.log1p(-w)) if w < 1 else 0
+            item = next(itertools.islice(indexed, skip, None), None)
+            if item is None:
                 break
-        
-def iterate_single_fasta(path, limit=None, random=False, max_length=None, random_sample_from_limit=None):
-    records = SeqIO.parse(path, 'fasta')
+            sample[rng.integers(size)] = item
+            w *= np.exp(np.log(1 - rng.random()) / size)
+    return [record for _, record in sorted(sample, key=lambda item: item[0])]
+
+FASTA_INDEX_SUFFIX = '.fidx.npz'
+
+class FastaIndex:
+    """
+    Byte-offset index of an uncompressed fasta file, saved as <path>.fidx.npz next to it (similar to .fai)
+
+    Holds start offset, end offset, sequence length and ID of each record. The index is built in one pass
+    and rebuilt when size or modification time of the fasta file changes. Records are read from a memory map,
+    only the path is pickled so that the index can be passed to worker processes.
+    """
+    def __init__(self, path, rebuild=False):
+        if path.endswith('.gz'):
+            raise ValueError(f'Gzipped fasta files cannot be indexed, decompress first: {path}')
+        self.path = path
+        self.index_path = path + FASTA_INDEX_SUFFIX
+        stat = os.stat(path)
+        if rebuild or not self._load(stat):
+            self._build(stat)
+        self._id_index = None
+        self._data = None
+
+    def _load(self, stat):
+        if not os.path.exists(self.index_path):
+            return False
+        data = np.load(self.index_path)
+        if data['mtime_ns'] != stat.st_mtime_ns or data['size'] != stat.st_size:
+            return False
+        self.starts, self.ends, self.lengths, self.ids = data['starts'], data['ends'], data['lengths'], data['ids']
+        return True
+
+    def _build(self, stat):
+        starts, ends, lengths, ids = [], [], [], []
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if line.startswith(b'>'):
+                    if starts:
+                        ends.append(offset)
+                    starts.append(offset)
+                    lengths.append(0)
+                    ids.append(line[1:].split(maxsplit=1)[0].decode() if line[1:].strip() else '')
+                elif starts:
+                    lengths[-1] += len(line.strip())
+                offset += len(line)
+        if starts:
+            ends.append(offset)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        self.ids = np.array(ids, dtype=str)
+        tmp_path = self.index_path + '.tmp.npz'
+        np.savez(tmp_path, starts=self.starts, ends=self.ends, lengths=self.lengths, ids=self.ids,
+                 mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        os.replace(tmp_path, self.index_path)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def data(self):
+        if self._data is None:
+            with open(self.path, 'rb') as f:
+                # mmap cannot map empty files
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if len(self) else b''
+        return self._data
+
+    def get_index(self, record_id):
+        if self._id_index is None:
+            self._id_index = {record_id: i for i, record_id in enumerate(self.ids.tolist())}
+        return self._id_index[record_id]
+
+    def __getitem__(self, key):
+        """
+        Get record by position in file (int) or by ID (str)
+        """
+        i = self.get_index(key) if isinstance(key, str) else key
+        text = self.data[self.starts[i]:self.ends[i]].decode()
+        return SeqIO.read(io.StringIO(text), 'fasta')
+
+    def __contains__(self, record_id):
+        try:
+            self.get_index(record_id)
+            return True
+        except KeyError:
+            return False
+
+    def get_shard_range(self, i, n, limit=None):
+        """
+        Get range of record positions of shard i out of n, shards cover disjoint byte ranges of similar size
+        """
+        num_records = min(len(self), limit) if limit else len(self)
+        if not num_records:
+            return range(0, 0)
+        start_offset, end_offset = self.starts[0], self.ends[num_records - 1]
+        bounds = start_offset + (end_offset - start_offset) * np.array([i, i + 1]) // n
+        start, end = np.searchsorted(self.starts[:num_records], bounds)
+        return range(int(start), int(end) if i + 1 < n else num_records)
+
+    def iter_records(self, idxs, max_length=None):
+        for i in idxs:
+            if max_length and self.lengths[i] > max_length:
+                continue
+            yield self[i]
+
+    def iter_shard(self, i, n, limit=None, max_length=None):
+        """
+        Iterate through records of shard i out of n, so that n processes can each read a disjoint part of the file
+
+        :param limit: only consider first N records of the file (before splitting into shards)
+        :param max_length: skip sequences longer than max_length
+        """
+        return self.iter_records(self.get_shard_range(i, n, limit=limit), max_length=max_length)
+
+    def sample(self, size, max_length=None, seed=None):
+        """
+        Get uniform random sample of size record positions in file order, only considering sequences up to max_length
+        """
+        idxs = np.arange(len(self)) if not max_length else np.flatnonzero(self.lengths <= max_length)
+        rng = np.random.default_rng(seed)
+        return np.sort(rng.choice(idxs, min(size, len(idxs)), replace=False))
+
+def iterate_single_fasta(path, limit=None, random=False, max_length=None, seed=None, shard=None):
+    """
+    Iterate through (gzipped) fasta sequence file(s), return generator of records
+
+    :param path: fasta file path or list of paths, random sample is drawn from all files together
+    :param limit: return only first N records of each file, or N random records with random
+    :param random: return uniform random sample of limit records (reservoir sampling, single pass)
+    :param max_length: skip sequences longer than max_length (before sampling with random)
+    :param seed: random seed
+    :param shard: tuple (i, n) to only return shard i out of n of each file using its FastaIndex
+    """
+    paths = [path] if isinstance(path, str) else path
     if limit == 0:
         return []
+    if shard is not None:
+        if random:
+            raise ValueError('Random cannot be used together with shard')
+        i, n = shard
+        # limit is applied before max_length, same as without shards
+        return itertools.chain.from_iterable(
+            FastaIndex(p).iter_shard(i, n, limit=limit, max_length=max_length) for p in paths
+        )
     if random:
         if limit is None:
             raise ValueError('Random can only be used together with limit')
-        if random_sample_from_limit:
-            size = random_sample_from_limit
-        else:
-            # size = ...
-            raise NotImplementedError('TODO: Count total number of sequences')
-        limit = min(size, limit)
-        random_idx = np.array(sorted(np.random.choice(size, limit, replace=False)))
-        records = iterate_fasta_index(records, random_idx)
-    elif limit:
-        records = itertools.islice(records, limit)
-        
+        records = itertools.chain.from_iterable(parse_fasta(p) for p in paths)
+        if max_length:
+            records = filter_max_length(records, max_length)
+        return iter(reservoir_sample(records, limit, seed=seed))
+
+    records = itertools.chain.from_iterable(
+        itertools.islice(parse_fasta(p), limit) if limit else parse_fasta(p) for p in paths
+    )
     if max_length:
         return filter_max_length(records, max_length)
 
     return records
     
     
-def iterate_fasta(paths, limit=None, max_length=None, random=False, random_sample_from_limit=None):
+def iterate_fasta(paths, limit=None, max_length=None, random=False, seed=None, shard=None):
     """
     Iterate through fasta sequence file(s), return generator of records
+
+    With random, limit records are sampled uniformly from all files together instead of from each file.
+    With shard=(i, n), only shard i out of n of each file is returned (see FastaIndex.iter_shard).
     """
-    if isinstance(paths, str):
-        paths = [paths]
-    for path in paths:
-        for record in iterate_single_fasta(path, limit=limit, max_length=max_length, random=random, random_sample_from_limit=random_sample_from_limit):
-            yield record
+    yield from iterate_single_fasta(paths, limit=limit, max_length=max_length, random=random, seed=seed, shard=shard)
 
             
 def barplot(series, ax=None, limit=None, limit_agg_func='sum', remaining_label='(remaining {})', title=None, neglog=False, fmt='{}', na_label='N/A', xlogtickstep=2, padding=1.3, **kwargs):
@@ -110,26 +291,117 @@ def series2records(series, description=''):
         description = [description] * len(series)
     return [SeqRecord(Seq(seq), id=name, description=d) for (name, seq), d in zip(series.items(), description)]
 
-def parse_netMHCIIpan_table(paths, rank_strong, rank_weak):
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+# Gaps and unknown residues are encoded as the last code, which never matches
+GAP_CODE = len(AMINO_ACIDS)
+AMINO_ACID_CODES = np.full(256, GAP_CODE, dtype=np.int64)
+AMINO_ACID_CODES[np.frombuffer(AMINO_ACIDS.encode(), dtype=np.uint8)] = np.arange(len(AMINO_ACIDS))
+
+def encode_chains(chains, position_index):
+    """
+    Encode residues of abnumber Chains as (chains x positions) matrix of amino acid codes
+
+    :param position_index: dict of position label without chain type (e.g. '111A') -> column, residues at other positions are ignored
+    """
+    codes = np.full((len(chains), len(position_index)), GAP_CODE, dtype=np.int64)
+    for i, chain in enumerate(chains):
+        for pos, aa in chain.positions.items():
+            idx = position_index.get(pos.format(chain_type=False))
+            if idx is not None:
+                codes[i, idx] = AMINO_ACID_CODES[ord(aa)]
+    return codes
+
+NETMHCIIPAN_CHUNK_SIZE = 1000000
+
+def read_netMHCIIpan_alleles(f):
+    """
+    Read alleles from the first header line of an open netMHCIIpan xls table, skipping the second header line
+    """
+    alleles = [allele for allele in f.readline().strip().split('\t') if allele]
+    f.readline()
+    return alleles
+
+def iterate_netMHCIIpan_chunks(path, rank_strong, rank_weak, chunk_size=NETMHCIIPAN_CHUNK_SIZE):
+    """
+    Iterate through netMHCIIpan xls table in chunks, reading only Peptide, ID and allele .Rank columns
+
+    :return: generator of DataFrames with SB_Alleles, WB+SB_Alleles, Peptide, ID and <allele>.Rank columns
+    """
+    assert rank_strong >= 1 or rank_weak >= 1, 'Ranks should be from 1-100'
+    with open(path, 'rt') as f:
+        alleles = read_netMHCIIpan_alleles(f)
+        rank_columns = [f'{allele}.Rank' for allele in alleles]
+        # Pos, Peptide, ID, then 1-log50k, nM and Rank of each allele
+        names = ['Peptide', 'ID'] + rank_columns
+        usecols = [1, 2] + [3 + 3 * i + 2 for i in range(len(alleles))]
+        dtype = {'Peptide': str, 'ID': str, **{column: np.float32 for column in rank_columns}}
+        for chunk in pd.read_csv(f, sep='\t', header=None, usecols=usecols, names=names, dtype=dtype,
+                                 engine='c', chunksize=chunk_size):
+            ranks = chunk[rank_columns].values
+            chunk.insert(0, 'SB_Alleles', (ranks <= rank_strong).sum(axis=1))
+            chunk.insert(1, 'WB+SB_Alleles', (ranks <= rank_weak).sum(axis=1))
+            yield chunk
+
+def parse_netMHCIIpan_table(paths, rank_strong, rank_weak, chunk_size=NETMHCIIPAN_CHUNK_SIZE):
+    """
+    Parse netMHCIIpan xls table(s), return DataFrame indexed by Peptide with number of strongly and weakly binding alleles,
+    source sequence ID and rank of each allele
+
+    Use aggregate_netMHCIIpan_tables for large tables, to avoid keeping all rows in memory.
+    """
     if isinstance(paths, str):
         paths = [paths]
-    assert rank_strong >= 1 or rank_weak >= 1, 'Ranks should be from 1-100'
-    results = []
-    for path in paths:
-        result = pd.read_csv(path, sep='\t', skiprows=1, engine='python')
-        with open(path, 'rt') as f:
-            alleles = [allele for allele in f.readline().strip().split('\t') if allele]
-            
-        columns = ['Pos', 'Peptide', 'ID']
-        for allele in alleles:
-            columns += [f'{allele}.1-log50k', f'{allele}.nM', f'{allele}.Rank']
-        columns += ['Ave', 'NB']
-        result.columns = columns
-        ranks = result[[f'{allele}.Rank' for allele in alleles]]
-        result.insert(0, 'SB_Alleles', (ranks <= rank_strong).sum(axis=1))
-        result.insert(1, 'WB+SB_Alleles', (ranks <= rank_weak).sum(axis=1))
-        
-        result.drop(columns=['Pos', 'NB'], inplace=True)
-        results.append(result)
-        
-    return pd.concat(results, ignore_index=True).set_index('Peptide')
\ No newline at end of file
+    results = [chunk for path in paths for chunk in iterate_netMHCIIpan_chunks(path, rank_strong, rank_weak, chunk_size=chunk_size)]
+    return pd.concat(results, ignore_index=True).set_index('Peptide')
+
+def merge_netMHCIIpan_aggregates(peptide_tables, id_tables):
+    peptides = pd.concat(peptide_tables).groupby(level=0, sort=False).agg(
+        {'SB_Alleles': 'max', 'WB+SB_Alleles': 'max', 'num_occurrences': 'sum'})
+    ids = pd.concat(id_tables).groupby(level=0, sort=False).sum()
+    return peptides, ids
+
+def aggregate_netMHCIIpan_table(path, rank_strong, rank_weak, chunk_size=NETMHCIIPAN_CHUNK_SIZE):
+    """
+    Aggregate binder counts of a single netMHCIIpan xls table, see aggregate_netMHCIIpan_tables
+    """
+    peptide_tables, id_tables = [], []
+    for chunk in iterate_netMHCIIpan_chunks(path, rank_strong, rank_weak, chunk_size=chunk_size):
+        chunk = chunk[['Peptide', 'ID', 'SB_Alleles', 'WB+SB_Alleles']].assign(
+            num_occurrences=1,
+            SB_Peptides=chunk['SB_Alleles'] >= 1,
+            **{'WB+SB_Peptides': chunk['WB+SB_Alleles'] >= 1}
+        )
+        peptide_tables.append(chunk.groupby('Peptide', sort=False).agg(
+            {'SB_Alleles': 'max', 'WB+SB_Alleles': 'max', 'num_occurrences': 'sum'}))
+        id_tables.append(chunk.rename(columns={'num_occurrences': 'num_peptides'}).groupby('ID', sort=False)[
+            ['num_peptides', 'SB_Peptides', 'WB+SB_Peptides', 'SB_Alleles', 'WB+SB_Alleles']].sum())
+        # merge as we go so that memory depends on number of unique peptides rather than number of rows
+        peptides, ids = merge_netMHCIIpan_aggregates(peptide_tables, id_tables)
+        peptide_tables, id_tables = [peptides], [ids]
+    return merge_netMHCIIpan_aggregates(peptide_tables, id_tables)
+
+def _aggregate_netMHCIIpan_table(args):
+    return aggregate_netMHCIIpan_table(*args)
+
+def aggregate_netMHCIIpan_tables(paths, rank_strong, rank_weak, chunk_size=NETMHCIIPAN_CHUNK_SIZE, workers=1):
+    """
+    Stream netMHCIIpan xls table(s) in chunks and count strong and weak binders per peptide and per source sequence ID
+
+    :param workers: number of tables parsed in parallel
+    :return: tuple of DataFrames:
+        peptides indexed by Peptide with SB_Alleles, WB+SB_Alleles and num_occurrences,
+        IDs indexed by ID with num_peptides, SB_Peptides and WB+SB_Peptides (peptides binding at least one allele)
+        and SB_Alleles and WB+SB_Alleles (summed over peptides)
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    tasks = [(path, rank_strong, rank_weak, chunk_size) for path in paths]
+    if workers == 1:
+        results = [_aggregate_netMHCIIpan_table(task) for task in tasks]
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_aggregate_netMHCIIpan_table, tasks)
+    peptides, ids = merge_netMHCIIpan_aggregates([p for p, _ in results], [i for _, i in results])
+    peptides.index.name = 'Peptide'
+    ids.index.name = 'ID'
+    return peptides, ids